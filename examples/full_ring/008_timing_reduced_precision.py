@@ -0,0 +1,54 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import pathlib
+import json
+import time
+import numpy as np
+
+import xtrack as xt
+import xobjects as xo
+import xpart as xp
+
+test_data_folder = pathlib.Path(
+        __file__).parent.joinpath('../../test_data').absolute()
+fname_line_particles = test_data_folder.joinpath(
+                                        'sps_w_spacecharge/line_no_spacecharge_and_particle.json')
+
+num_turns = 100
+n_part = 2000
+# Reduced precision is not available on ContextCpu
+context = xo.ContextCupy()
+
+with open(fname_line_particles, 'r') as fid:
+    input_data = json.load(fid)
+
+part_ref = xp.Particles(**input_data['particle'])
+particles = xp.build_particles(_context=context, particle_ref=part_ref,
+    x=np.linspace(-1e-3, 1e-3, n_part), y=np.linspace(-1e-3, 1e-3, n_part))
+
+for precision in ['double', 'float32', 'mixed']:
+    line = xt.Line.from_dict(input_data['line'])
+    tracker = line.build_tracker(_context=context, precision=precision)
+
+    # Timing
+    part = particles.copy()
+    tracker.track(part, num_turns=1) # warm up
+    part = particles.copy()
+    t1 = time.time()
+    tracker.track(part, num_turns=num_turns)
+    context.synchronize()
+    t2 = time.time()
+    print(f'{precision:8s}: {(t2-t1)*1e6/num_turns/n_part:.3f} us/part/turn')
+
+    # Accuracy
+    if precision != 'double':
+        diff = tracker.compare_with_double_precision(particles,
+                                                     num_turns=num_turns)
+        print('          max. deviation from double after '
+              f'{num_turns} turns: '
+              + ', '.join(f'{nn}={diff[nn]:.2e}'
+                          for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta']))
+        print(f'          state mismatches: {diff["num_state_mismatch"]}')
@@ -3,6 +3,7 @@ import time
 import pathlib
 
 import numpy as np
+import pytest
 
 import xtrack as xt
 import xpart as xp
@@ -113,4 +114,366 @@ def test_match_tune_chromaticity():
         assert np.isclose(tw_final['qx'], 62.29, atol=1e-7)
         assert np.isclose(tw_final['qy'], 60.31, atol=1e-7)
         assert np.isclose(tw_final['dqx'],  6.0, atol=1e-4)
-        assert np.isclose(tw_final['dqy'],  4.0, atol=1e-4)
\ No newline at end of file
+        assert np.isclose(tw_final['dqy'],  4.0, atol=1e-4)
+
+def test_twiss_cache():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker = line.build_tracker(_context=context)
+
+        tw0 = tracker.twiss()
+        tw0_again = tracker.twiss()
+        assert tw0_again is not tw0
+        assert tw0_again.betx is not tw0.betx
+        assert np.isclose(tw0_again['qx'], tw0['qx'], atol=1e-12, rtol=0)
+
+        # Change through the knobs invalidates the cache and the new closed
+        # orbit is found from the previous one
+        line.vars['on_x1'] = 250
+        tw1 = tracker.twiss()
+        assert tw1.particle_on_co._fsolve_info == 'jacobian_guess'
+
+        tracker.use_twiss_cache = False
+        tw1_ref = tracker.twiss()
+        tracker.use_twiss_cache = True
+
+        assert not np.allclose(tw1.py, tw0.py, atol=1e-9, rtol=0)
+        assert np.allclose(tw1.py, tw1_ref.py, atol=1e-9, rtol=0)
+        assert np.allclose(tw1.betx, tw1_ref.betx, atol=0, rtol=1e-8)
+        assert np.isclose(tw1['qx'], tw1_ref['qx'], atol=1e-8, rtol=0)
+        assert np.isclose(tw1['dqx'], tw1_ref['dqx'], atol=1e-3, rtol=0)
+
+        # Restoring the knob gives back the initial optics
+        line.vars['on_x1'] = 0
+        tw2 = tracker.twiss()
+        assert np.allclose(tw2.py, tw0.py, atol=1e-11, rtol=0)
+
+        # Different arguments are not served from the cache
+        tw_4d = tracker.twiss(method='4d')
+        assert tw_4d.qs == 0
+        key_4d = tracker._twiss_cache['key']
+        tracker.twiss(method='4d', continue_on_closed_orbit_error=True)
+        assert tracker._twiss_cache['key'] != key_4d
+
+        # Twiss at given s positions is cached as well
+        at_s = [10., 1000.7]
+        tw_s = tracker.twiss(at_s=at_s)
+        cache_before = tracker._twiss_cache
+        tw_s_again = tracker.twiss(at_s=at_s)
+        assert tracker._twiss_cache is cache_before
+        assert np.all(tw_s_again.betx == tw_s.betx)
+
+        # Direct assignment of an element field invalidates the cache
+        name_mb = [nn for nn in line.element_names if nn.startswith('mb.')][0]
+        line[name_mb].hxl = line[name_mb].hxl
+        tracker.twiss(at_s=at_s)
+        assert tracker._twiss_cache is not cache_before
+
+        # In-place write of an array item invalidates the cache
+        tw_before = tracker.twiss()
+        name_mq = [nn for nn in line.element_names if nn.startswith('mq.')][0]
+        knl_before = line[name_mq].knl[1]
+        line[name_mq].knl[1] = knl_before * 1.01
+        tw_after = tracker.twiss()
+        tracker.use_twiss_cache = False
+        tw_ref = tracker.twiss()
+        tracker.use_twiss_cache = True
+        line[name_mq].knl[1] = knl_before
+        assert not np.isclose(tw_after.qx, tw_before.qx, atol=1e-6, rtol=0)
+        assert np.isclose(tw_after.qx, tw_ref.qx, atol=1e-9, rtol=0)
+
+
+def test_twiss_delta_scan():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker = line.build_tracker(_context=context)
+        tracker.use_twiss_cache = False
+
+        deltas = [-5e-4, 0, 3e-4]
+        tw_scan = tracker.twiss_delta_scan(deltas)
+
+        assert tw_scan.betx.shape == (len(deltas), len(tw_scan.name))
+        assert tw_scan.qx.shape == (len(deltas),)
+
+        for ii, dd in enumerate(deltas):
+            tw = tracker.twiss(method='4d', delta0=dd)
+            assert np.isclose(tw_scan.qx[ii], tw.qx, atol=1e-7, rtol=0)
+            assert np.isclose(tw_scan.qy[ii], tw.qy, atol=1e-7, rtol=0)
+            assert np.allclose(tw_scan.x[ii], tw.x, atol=1e-9, rtol=0)
+            assert np.allclose(tw_scan.betx[ii], tw.betx, atol=0, rtol=1e-6)
+            assert np.allclose(tw_scan.bety[ii], tw.bety, atol=0, rtol=1e-6)
+            assert np.allclose(tw_scan.dx[ii], tw.dx, atol=1e-4, rtol=0)
+
+
+def test_twiss_at_s_in_drifts():
+
+    from xtrack.twiss import _build_auxiliary_tracker_with_extra_markers
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker = line.build_tracker(_context=context)
+
+        at_s = np.linspace(0, line.get_length(), 50)
+        tw = tracker.twiss(at_s=at_s)
+
+        auxtracker, names = _build_auxiliary_tracker_with_extra_markers(
+            tracker=tracker, at_s=at_s, marker_prefix='inserted_twiss_marker')
+        tw_ref = auxtracker.twiss(at_elements=names)
+
+        assert tuple(tw.name) == tuple(tw_ref.name)
+        assert np.allclose(tw.s, at_s, atol=1e-10, rtol=0)
+        for nn in ['x', 'px', 'y', 'py', 'dx', 'dy', 'dpx', 'dpy']:
+            assert np.allclose(tw[nn], tw_ref[nn], atol=1e-9, rtol=0)
+        for nn in ['betx', 'bety']:
+            assert np.allclose(tw[nn], tw_ref[nn], atol=0, rtol=1e-7)
+        for nn in ['alfx', 'alfy', 'mux', 'muy']:
+            assert np.allclose(tw[nn], tw_ref[nn], atol=1e-7, rtol=0)
+        assert np.isclose(tw.qx, tw_ref.qx, atol=1e-9, rtol=0)
+
+
+def test_twiss_matrix_engine():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker = line.build_tracker(_context=context)
+
+        for on_x1 in [0, 250]:
+            line.vars['on_x1'] = on_x1
+            tw = tracker.twiss()
+            tw_mat = tracker.twiss(engine='matrix')
+
+            for nn in ['x', 'px', 'y', 'py']:
+                assert np.allclose(tw_mat[nn], tw[nn], atol=1e-12, rtol=0)
+            for nn in ['betx', 'bety']:
+                assert np.allclose(tw_mat[nn], tw[nn], atol=0, rtol=1e-6)
+            for nn in ['dx', 'dy', 'alfx', 'alfy', 'mux', 'muy']:
+                assert np.allclose(tw_mat[nn], tw[nn], atol=1e-5, rtol=0)
+            assert np.isclose(tw_mat.qx, tw.qx, atol=1e-7, rtol=0)
+            assert np.isclose(tw_mat.qy, tw.qy, atol=1e-7, rtol=0)
+
+
+def test_one_turn_matrix_at():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker = line.build_tracker(_context=context)
+
+        for on_x1 in [0, 250]:
+            line.vars['on_x1'] = on_x1
+            tw = tracker.twiss()
+
+            # The crossing angle changes the closed orbit
+            RR = tracker.one_turn_matrix_at(0, particle_on_co=tw.particle_on_co)
+            assert np.allclose(RR, tw.R_matrix, atol=1e-5, rtol=1e-5)
+
+            name = 'ip5'
+            RR_ip5 = tracker.one_turn_matrix_at(name)
+            RR_ip5_ref = tracker.compute_one_turn_matrix_finite_differences(
+                particle_on_co=tw.get_twiss_init(name).particle_on_co)
+            assert np.allclose(RR_ip5, RR_ip5_ref, atol=1e-5, rtol=1e-5)
+
+def test_match_least_squares():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker=line.build_tracker(_context=context)
+
+        vary = ['kqtf.b1', 'kqtd.b1','ksf.b1', 'ksd.b1']
+        targets = [
+            ('qx', 62.315),
+            (lambda tw: tw['qx'] - tw['qy'], 1.99),
+            ('dqx', 10.0),
+            ('dqy', 12.0),]
+
+        t1 = time.time()
+        # The tolerance applies to the weighted residuals: 1e-7 on the tunes
+        # and 1e-4 on the chromaticities
+        info = tracker.match(vary=vary, targets=targets,
+                             solver='least_squares', weights=[1, 1, 1e-3, 1e-3],
+                             tol=1e-7)
+        assert info['ier'] == 1
+        t2 = time.time()
+        print('\nTime least squares: ', t2-t1)
+        print(info['mesg'], info['info']['nfev'], info['info']['njev'])
+
+        tw_final = tracker.twiss()
+        assert np.isclose(tw_final['qx'], 62.315, atol=1e-7)
+        assert np.isclose(tw_final['qy'], 60.325, atol=1e-7)
+        assert np.isclose(tw_final['dqx'], 10.0, atol=1e-4)
+        assert np.isclose(tw_final['dqy'], 12.0, atol=1e-4)
+
+        # Lowering dqx needs a lower ksf.b1, which is prevented by its limit.
+        # The match stops at the limit with an explicit status.
+        ksf_limit = line.vars['ksf.b1']._value
+        info = tracker.match(vary=vary,
+            targets=[('qx', 62.27), ('qy', 60.28),
+                     ('dqx', -5.0), ('dqy', -7.0)],
+            solver='least_squares', weights=[1, 1, 1e-3, 1e-3], tol=1e-7,
+            limits={'ksf.b1': (ksf_limit, None)})
+        assert info['ier'] == 2
+        assert line.vars['ksf.b1']._value == ksf_limit
+        tw_bounded = tracker.twiss()
+        assert not np.isclose(tw_bounded['dqx'], -5.0, atol=1e-4)
+
+        # Failures restore the knobs
+        knobs_before = [line.vars[vv]._value for vv in vary]
+        with pytest.raises(RuntimeError):
+            tracker.match(vary=vary,
+                targets=[('qx', 62.27), ('qy', 60.28),
+                         ('dqx', -5.0), ('dqy', -7.0)],
+                solver='least_squares', tol=1e-7, max_iterations=1)
+        assert np.all(np.array([line.vars[vv]._value for vv in vary])
+                      == np.array(knobs_before))
+
+def test_twiss_only_global_quantities():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker=line.build_tracker(_context=context)
+        tracker.use_twiss_cache = False
+
+        for method in ['6d', '4d']:
+            tw = tracker.twiss(method=method)
+            tw_glob = tracker.twiss(method=method, only_global_quantities=True)
+
+            assert 'betx' not in tw_glob
+            assert np.isclose(tw_glob.qx, tw.qx, rtol=0, atol=1e-9)
+            assert np.isclose(tw_glob.qy, tw.qy, rtol=0, atol=1e-9)
+            assert np.isclose(tw_glob.qs, tw.qs, rtol=0, atol=1e-7)
+            assert np.isclose(tw_glob.dqx, tw.dqx, rtol=0, atol=1e-4)
+            assert np.isclose(tw_glob.dqy, tw.dqy, rtol=0, atol=1e-4)
+            assert np.isclose(tw_glob.slip_factor, tw.slip_factor,
+                              rtol=1e-3, atol=0)
+            assert np.isclose(tw_glob.momentum_compaction_factor,
+                              tw.momentum_compaction_factor, rtol=1e-3, atol=0)
+
+def test_match_only_global_quantities():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker=line.build_tracker(_context=context)
+        tracker.use_twiss_cache = False
+
+        vary = ['kqtf.b1', 'kqtd.b1','ksf.b1', 'ksd.b1']
+        targets = [('qx', 62.315), ('qy', 60.325),
+                   ('dqx', 10.0), ('dqy', 12.0)]
+        x0 = [line.vars[vv]._value for vv in vary]
+
+        twiss_kwargs = []
+        twiss = tracker.twiss
+        def twiss_recording_kwargs(**kwargs):
+            twiss_kwargs.append(kwargs)
+            return twiss(**kwargs)
+        tracker.twiss = twiss_recording_kwargs
+
+        # Explicit choice of the full computation
+        tracker.match(vary=vary, targets=targets, only_global_quantities=False)
+        x_full = [line.vars[vv]._value for vv in vary]
+        assert all(not kk['only_global_quantities'] for kk in twiss_kwargs)
+
+        # Chosen automatically, as all targets are global quantities
+        twiss_kwargs.clear()
+        for vv, xx in zip(vary, x0):
+            line.vars[vv] = xx
+        tracker.match(vary=vary, targets=targets)
+        x_glob = [line.vars[vv]._value for vv in vary]
+        assert all(kk['only_global_quantities'] for kk in twiss_kwargs)
+        tracker.twiss = twiss
+
+        assert np.allclose(x_glob, x_full, rtol=1e-4, atol=1e-9)
+
+        # The integer tunes follow the global results
+        tw_glob = tracker.twiss(only_global_quantities=True)
+        assert np.isclose(tw_glob.qx, 62.315, atol=1e-7)
+        assert np.isclose(tw_glob.qy, 60.325, atol=1e-7)
+
+def test_match_with_knob_response():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line.from_dict(dct['line'])
+        line.particle_ref = xp.Particles.from_dict(dct['particle'])
+
+        tracker=line.build_tracker(_context=context)
+
+        vary = ['kqtf.b1', 'kqtd.b1','ksf.b1', 'ksd.b1']
+        resp = tracker.compute_knob_response(vary=vary,
+                                observables=['qx', 'qy', 'dqx', 'dqy'])
+        assert resp.matrix.shape == (4, 4)
+
+        # Knobs are restored after the computation
+        assert np.allclose([line.vars[vv]._value for vv in vary],
+                           resp.knob_values, rtol=0, atol=1e-15)
+
+        info = tracker.match_with_knob_response(
+            targets = [
+                ('qx', 62.315),
+                ('qy', 60.325),
+                ('dqx', 10.0),
+                ('dqy', 12.0),], tol=1e-8, n_iterations=10)
+        print(info['n_iterations'], info['residuals'])
+        assert info['success']
+
+        tw_final = tracker.twiss()
+        assert np.isclose(tw_final['qx'], 62.315, atol=1e-7)
+        assert np.isclose(tw_final['qy'], 60.325, atol=1e-7)
+        assert np.isclose(tw_final['dqx'], 10.0, atol=1e-4)
+        assert np.isclose(tw_final['dqy'], 12.0, atol=1e-4)
+
+        # Not converged: the knobs stay at the best values found
+        x_matched = [line.vars[vv]._value for vv in vary]
+        info = tracker.match_with_knob_response(
+            targets = [('qx', 62.4), ('qy', 60.4)], tol=1e-8, n_iterations=0)
+        assert not info['success']
+        assert np.allclose([line.vars[vv]._value for vv in vary], x_matched,
+                           rtol=0, atol=1e-15)
+
+        # Element-by-element observables
+        resp_ip = tracker.compute_knob_response(vary=['on_x1'],
+                        observables=[('px', 'ip1'), ('x', ['ip1', 'ip5'])])
+        assert resp_ip.matrix.shape == (3, 1)
+        assert resp_ip.rows(('x', ['ip1', 'ip5'])) == slice(1, 3)
+
+        on_x1 = line.vars['on_x1']._value
+        tw0 = tracker.twiss()
+        line.vars['on_x1'] = on_x1 + 1
+        tw1 = tracker.twiss()
+        line.vars['on_x1'] = on_x1
+        i_ip1 = tw0.name.index('ip1')
+        assert np.isclose(resp_ip.matrix[0, 0],
+                          tw1.px[i_ip1] - tw0.px[i_ip1], rtol=1e-4, atol=1e-12)
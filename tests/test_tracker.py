@@ -3,6 +3,7 @@
 # Copyright (c) CERN, 2021.                 #
 # ######################################### #
 
+import pytest
 import numpy as np
 import xobjects as xo
 import xtrack as xt
@@ -292,3 +293,1073 @@ def _get_at_turn_element(particles):
     all_together = len(at_turn)==1 and len(at_element)==1 and len(at_s)==1
     return all_together, at_turn[0], at_element[0], at_s[0]
 
+
+def test_kernel_cache(tmp_path, monkeypatch):
+
+    monkeypatch.setenv('XTRACK_KERNEL_CACHE_DIR', str(tmp_path))
+
+    context = xo.ContextCpu()
+
+    def make_tracker(context):
+        line = xt.Line(elements=[xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, 1e-2]),
+                                 xt.Drift(length=1.)])
+        return line.build_tracker(_context=context)
+
+    tracker1 = make_tracker(context)
+    so_files = [ff for ff in tmp_path.iterdir() if ff.suffix == '.so']
+    assert len(so_files) == 1
+    mtime = so_files[0].stat().st_mtime_ns
+
+    # Same element classes on a new context (not covered by the in-process
+    # kernel registry) -> loaded from cache, no recompilation
+    build_kernels = xo.ContextCpu.build_kernels
+    def build_kernels_without_compiling(self, *args, **kwargs):
+        assert not kwargs.get('compile', True), 'Unexpected compilation'
+        return build_kernels(self, *args, **kwargs)
+    monkeypatch.setattr(xo.ContextCpu, 'build_kernels',
+                        build_kernels_without_compiling)
+
+    context2 = xo.ContextCpu()
+    tracker2 = make_tracker(context2)
+    assert tracker2.track_kernel is not tracker1.track_kernel
+    so_files = [ff for ff in tmp_path.iterdir() if ff.suffix == '.so']
+    assert len(so_files) == 1
+    assert so_files[0].stat().st_mtime_ns == mtime
+
+    monkeypatch.setattr(xo.ContextCpu, 'build_kernels', build_kernels)
+
+    p1 = xp.Particles(x=[1e-3, -2e-3], px=[1e-5, 0], p0c=7e12,
+                      _context=context)
+    p2 = xp.Particles(x=[1e-3, -2e-3], px=[1e-5, 0], p0c=7e12,
+                      _context=context2)
+    tracker1.track(p1, num_turns=3)
+    tracker2.track(p2, num_turns=3)
+    assert np.all(p1.x == p2.x)
+    assert np.all(p1.px == p2.px)
+
+    # Different global aperture -> different source -> new entry
+    line = xt.Line(elements=[xt.Drift(length=1.)])
+    line.build_tracker(_context=context, global_xy_limit=2.)
+    so_files = [ff for ff in tmp_path.iterdir() if ff.suffix == '.so']
+    assert len(so_files) == 2
+
+def test_unrolled_line():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        def make_line():
+            return xt.Line(elements=[xt.Multipole(knl=[0, 1.]),
+                                     xt.Drift(length=0.5),
+                                     xt.LimitRect(min_x=-2e-2, max_x=2e-2,
+                                                  min_y=-2e-2, max_y=2e-2),
+                                     xt.Multipole(knl=[0, -1]),
+                                     xt.Cavity(frequency=400e7, voltage=6e6),
+                                     xt.Drift(length=.5),
+                                     xt.Drift(length=0)])
+
+        tracker = make_line().build_tracker(_context=context)
+        tracker_unrolled = make_line().build_tracker(_context=context,
+                                                     unroll_line=True)
+        assert tracker_unrolled.track_kernel is not tracker.track_kernel
+
+        particles = xp.Particles(x=[1e-3, -2e-3, 5e-3], y=[2e-3, -4e-3, 3e-3],
+                                 zeta=1e-2, p0c=7e12, mass0=xp.PROTON_MASS_EV,
+                                 _context=context)
+
+        for kwargs in [{'num_turns': 10},
+                       {'ele_start': 2, 'ele_stop': 5, 'num_turns': 3},
+                       {'ele_start': 4, 'num_elements': 2},
+                       {'turn_by_turn_monitor': 'ONE_TURN_EBE'}]:
+            p_ref = particles.copy()
+            p_test = particles.copy()
+            tracker.track(p_ref, **kwargs)
+            tracker_unrolled.track(p_test, **kwargs)
+            p_ref.move(_context=xo.ContextCpu())
+            p_test.move(_context=xo.ContextCpu())
+            for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta', 'state',
+                       'at_element', 'at_turn', 's']:
+                assert np.all(getattr(p_ref, nn) == getattr(p_test, nn))
+
+        # Derived trackers do not share the line-specific kernel
+        ctracker = tracker_unrolled.cycle(index_first_element=2)
+        assert ctracker.track_kernel is not tracker_unrolled.track_kernel
+
+def test_kernel_registry():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        tracker_a = xt.Tracker(_context=context, line=xt.Line(
+            elements=[xt.Drift(length=1.), xt.Multipole(knl=[0, 1e-2]),
+                      xt.Cavity(voltage=1e6, frequency=400e6)]))
+
+        # Subset of the classes -> kernel is reused
+        tracker_b = xt.Tracker(_context=context, line=xt.Line(
+            elements=[xt.Multipole(knl=[0, -1e-2]), xt.Drift(length=2.)]))
+        assert tracker_b.track_kernel is tracker_a.track_kernel
+        assert tracker_b.element_classes is tracker_a.element_classes
+
+        # Different settings -> new kernel
+        tracker_c = xt.Tracker(_context=context, global_xy_limit=2.,
+                            line=xt.Line(elements=[xt.Drift(length=1.)]))
+        assert tracker_c.track_kernel is not tracker_a.track_kernel
+
+        # New class -> new kernel including also the previous classes
+        tracker_d = xt.Tracker(_context=context, line=xt.Line(
+            elements=[xt.SRotation(angle=10.), xt.Drift(length=1.)]))
+        assert tracker_d.track_kernel is not tracker_a.track_kernel
+        assert set(tracker_a.element_classes).issubset(
+                                                tracker_d.element_classes)
+        tracker_e = xt.Tracker(_context=context, line=xt.Line(
+            elements=[xt.Cavity(voltage=1e6, frequency=400e6),
+                      xt.SRotation(angle=-10.)]))
+        assert tracker_e.track_kernel is tracker_d.track_kernel
+
+        # Tracking with remapped type ids gives the same result
+        p_ref = xp.Particles(x=[1e-3, -1e-3], y=[2e-3, 0], p0c=7e12,
+                             _context=context)
+        p_test = p_ref.copy()
+        tracker_b.track(p_ref, num_turns=5)
+        tracker_b_new = xt.Tracker(_context=context, line=xt.Line(
+            elements=[xt.Multipole(knl=[0, -1e-2]), xt.Drift(length=2.)]))
+        assert tracker_b_new.track_kernel is tracker_d.track_kernel
+        tracker_b_new.track(p_test, num_turns=5)
+        p_ref.move(_context=xo.ContextCpu())
+        p_test.move(_context=xo.ContextCpu())
+        assert np.all(p_ref.x == p_test.x)
+        assert np.all(p_ref.y == p_test.y)
+
+    # The registered kernels do not keep their context alive
+    import gc
+    import weakref
+    context = xo.ContextCpu()
+    tracker = xt.Tracker(_context=context,
+                         line=xt.Line(elements=[xt.Drift(length=1.)]))
+    context_ref = weakref.ref(context)
+    del tracker, context
+    gc.collect()
+    assert context_ref() is None
+
+def test_checkpoint_and_resume(tmp_path, monkeypatch):
+
+    import xtrack.tracker as xttracker
+
+    context = xo.ContextCpu()
+
+    line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5]),
+                             xt.Drift(length=1.),
+                             xt.LimitRect(min_x=-1e-2, max_x=1e-2,
+                                          min_y=-1e-2, max_y=1e-2),
+                             xt.Multipole(knl=[0, -0.6], ksl=[0, 0.1]),
+                             xt.Drift(length=1.)])
+    tracker = line.build_tracker(_context=context)
+
+    def make_particles():
+        return xp.Particles(x=[1e-3, -2e-3, 8e-3, 9.9e-3],
+                            px=[0, 1e-4, 0, 1e-3], p0c=7e12,
+                            _context=context)
+
+    p_ref = make_particles()
+    tracker.track(p_ref, num_turns=23, turn_by_turn_monitor=True)
+    mon_ref = tracker.record_last_track
+
+    checkpoint_path = tmp_path / 'checkpoint.pkl'
+
+    # Simulate a job killed after the second checkpoint
+    class Killed(Exception):
+        pass
+    n_saved = []
+    def save_and_kill(*args, **kwargs):
+        xt.checkpoint.save_checkpoint(*args, **kwargs)
+        n_saved.append(1)
+        if len(n_saved) == 2:
+            raise Killed
+    monkeypatch.setattr(xttracker, 'save_checkpoint', save_and_kill)
+
+    p_test = make_particles()
+    try:
+        tracker.track(p_test, num_turns=23, turn_by_turn_monitor=True,
+                      checkpoint_every=5, checkpoint_path=checkpoint_path)
+    except Killed:
+        pass
+    assert np.all(p_test.at_turn[p_test.state > 0] == 11)
+    monkeypatch.undo()
+
+    # Restart from a fresh particles object
+    p_test = make_particles()
+    tracker.track(p_test, num_turns=23, turn_by_turn_monitor=True,
+                  checkpoint_every=5, checkpoint_path=checkpoint_path,
+                  resume_from=checkpoint_path)
+    mon_test = tracker.record_last_track
+
+    for nn in ['x', 'px', 'y', 'py', 'zeta', 'state', 'at_turn',
+               'at_element']:
+        assert np.all(getattr(p_ref, nn) == getattr(p_test, nn))
+        assert np.all(getattr(mon_ref, nn) == getattr(mon_test, nn))
+
+    # Resuming with different settings is not allowed
+    with pytest.raises(ValueError):
+        tracker.track(make_particles(), num_turns=30,
+                      turn_by_turn_monitor=True, resume_from=checkpoint_path)
+
+    # Not available for lines with collective elements
+    coll_line = xt.Line(elements=[xt.Drift(length=1.), xt.Drift(length=1.)])
+    coll_line.elements[1].iscollective = True
+    coll_tracker = coll_line.build_tracker(_context=context)
+    assert coll_tracker.iscollective
+    with pytest.raises(NotImplementedError):
+        coll_tracker.track(make_particles(), num_turns=30,
+                           checkpoint_every=10, checkpoint_path=checkpoint_path)
+    with pytest.raises(NotImplementedError):
+        coll_tracker.track(make_particles(), num_turns=30,
+                           resume_from=checkpoint_path)
+
+def test_compact_lost_particles():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                                 xt.Drift(length=1.),
+                                 xt.LimitEllipse(a=1e-2, b=1e-2),
+                                 xt.Multipole(knl=[0, -0.6], ksl=[0, 0.1]),
+                                 xt.Drift(length=1.)])
+        tracker = line.build_tracker(_context=context)
+
+        x = np.linspace(-1e-2, 1e-2, 41)
+        p_ref = xp.Particles(x=x, y=0.5*x, p0c=7e12, _context=context)
+        p_test = p_ref.copy()
+
+        tracker.track(p_ref, num_turns=50, turn_by_turn_monitor=True)
+        mon_ref = tracker.record_last_track
+
+        if isinstance(context, xo.ContextPyopencl):
+            with pytest.raises(NotImplementedError):
+                tracker.track(p_test, num_turns=50, compact_every=7)
+            continue
+
+        tracker.track(p_test, num_turns=50, turn_by_turn_monitor=True,
+                      compact_every=7)
+        mon_test = tracker.record_last_track
+
+        # The kernel is shared, the number of threads is passed per launch
+        assert tracker.track_kernel.description.n_threads == 'num_threads'
+
+        p_ref.move(_context=xo.ContextCpu())
+        p_test.move(_context=xo.ContextCpu())
+        p_ref.sort(interleave_lost_particles=True)
+        p_test.sort(interleave_lost_particles=True)
+
+        assert np.sum(p_ref.state > 0) < len(x)
+        for nn in ['x', 'px', 'y', 'py', 'state', 'at_turn', 'at_element']:
+            assert np.all(getattr(p_ref, nn) == getattr(p_test, nn))
+            assert np.all(getattr(mon_ref, nn) == getattr(mon_test, nn))
+
+def test_track_parallel():
+
+    context = xo.ContextCpu()
+
+    line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                             xt.Drift(length=1.),
+                             xt.LimitEllipse(a=1e-2, b=1e-2),
+                             xt.Multipole(knl=[0, -0.6], ksl=[0, 0.1]),
+                             xt.Drift(length=1.)])
+    tracker = line.build_tracker(_context=context)
+
+    x = np.linspace(-1e-2, 1e-2, 41)
+    p_ref = xp.Particles(x=x, y=0.5*x, p0c=7e12, _context=context)
+    p_test = p_ref.copy()
+
+    tracker.track(p_ref, num_turns=20, turn_by_turn_monitor=True)
+    mon_ref = tracker.record_last_track
+    tracker.track_parallel(p_test, num_turns=20, n_workers=3,
+                           turn_by_turn_monitor=True)
+    mon_test = tracker.record_last_track
+
+    assert np.sum(p_ref.state > 0) < len(x)
+    assert p_test._num_active_particles == np.sum(p_ref.state > 0)
+
+    p_ref.sort(interleave_lost_particles=True)
+    p_test.sort(interleave_lost_particles=True)
+    for nn in ['x', 'px', 'y', 'py', 'state', 'at_turn', 'at_element',
+               'particle_id']:
+        assert np.all(getattr(p_ref, nn) == getattr(p_test, nn))
+        assert np.all(getattr(mon_ref, nn) == getattr(mon_test, nn))
+
+def test_track_parallel_async_compile_and_all_lost():
+
+    context = xo.ContextCpu()
+
+    line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                             xt.Drift(length=1.),
+                             xt.LimitEllipse(a=1e-2, b=1e-2),
+                             xt.Multipole(knl=[0, -0.6], ksl=[0, 0.1]),
+                             xt.Drift(length=1.)])
+    line_ref = xt.Line.from_dict(line.to_dict())
+
+    tracker = line.build_tracker(_context=context, compile='async')
+    assert tracker._track_kernel_future is not None
+
+    # Called while the kernel may still be compiling
+    x = np.linspace(-5e-3, 5e-3, 11)
+    p_ref = xp.Particles(x=x, p0c=7e12, _context=context)
+    p_test = p_ref.copy()
+    tracker.track_parallel(p_test, num_turns=5, n_workers=2)
+    line_ref.build_tracker(_context=context).track(p_ref, num_turns=5)
+    assert np.all(p_test.x == p_ref.x)
+    assert np.all(p_test.at_turn == p_ref.at_turn)
+
+    # All particles lost
+    p_lost = xp.Particles(x=[1., 2.], p0c=7e12, _context=context)
+    p_lost.state[:] = 0
+    tracker.track_parallel(p_lost, num_turns=5, n_workers=2)
+    assert np.all(p_lost.state == 0)
+    assert np.all(p_lost.at_turn == 0)
+
+def test_tracker_ensemble():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        k1_values = [0.1, 0.3, -0.2]
+        lines = [xt.Line(elements=[xt.Multipole(knl=[0, k1, 2.]),
+                                   xt.Drift(length=1.),
+                                   xt.LimitRect(min_x=-2e-2, max_x=2e-2,
+                                                min_y=-1, max_y=1),
+                                   xt.Drift(length=1.)])
+                 for k1 in k1_values]
+
+        ensemble = xt.TrackerEnsemble(lines=[xt.Line.from_dict(ll.to_dict())
+                                             for ll in lines],
+                                      _context=context)
+        assert ensemble.num_variants == 3
+        for tt in ensemble.trackers[1:]:
+            assert tt.track_kernel is ensemble.trackers[0].track_kernel
+            assert tt._buffer is ensemble.trackers[0]._buffer
+
+        x = np.linspace(-1e-2, 1e-2, 30)
+        variant_index = np.arange(len(x)) % 3
+        particles = xp.Particles(x=x, p0c=7e12, _context=context)
+        # Two calls, the second one starting from interleaved lost particles
+        ensemble.track(particles, variant_index=variant_index, num_turns=10)
+        ensemble.track(particles, variant_index=variant_index, num_turns=5)
+
+        if isinstance(context, xo.ContextCpu):
+            assert particles._num_active_particles == -1
+            assert particles._num_lost_particles == -1
+
+        particles.move(_context=xo.ContextCpu())
+        for iv, line in enumerate(lines):
+            p_ref = xp.Particles(x=x[variant_index == iv], p0c=7e12,
+                                 _context=context)
+            line.build_tracker(_context=context).track(p_ref, num_turns=15)
+            p_ref.move(_context=xo.ContextCpu())
+            p_ref.sort(interleave_lost_particles=True)
+
+            mask = variant_index == iv
+            ids = particles.particle_id[mask]
+            isort = np.argsort(ids)
+            for nn in ['x', 'px', 'state', 'at_turn']:
+                assert np.allclose(getattr(particles, nn)[mask][isort],
+                                   getattr(p_ref, nn), rtol=0, atol=1e-14)
+        assert np.any(particles.state < 1)
+        assert np.any(particles.state > 0)
+
+def test_profile():
+
+    context = xo.ContextCpu()
+
+    line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                             xt.Drift(length=1.),
+                             xt.LimitEllipse(a=1e-2, b=1e-2),
+                             xt.Multipole(knl=[0, -0.6]),
+                             xt.Drift(length=1.)],
+                   element_names=['mq1', 'd1', 'ap', 'mq2', 'd2'])
+    tracker = line.build_tracker(_context=context, profile=True)
+
+    x = np.linspace(-1e-2, 1e-2, 41)
+    particles = xp.Particles(x=x, p0c=7e12, _context=context)
+    tracker.track(particles, num_turns=10)
+
+    # Profiled kernel gives the same physics
+    p_ref = xp.Particles(x=x, p0c=7e12, _context=context)
+    xt.Line.from_dict(line.to_dict()).build_tracker(_context=context).track(
+                                                        p_ref, num_turns=10)
+    particles.sort(interleave_lost_particles=True)
+    p_ref.sort(interleave_lost_particles=True)
+    assert np.all(particles.x == p_ref.x)
+    assert np.all(particles.state == p_ref.state)
+
+    n_lost = np.sum(p_ref.state < 1)
+    assert n_lost > 0
+
+    prof = tracker.get_profile()
+    assert np.all(prof.name == np.array(['mq1', 'd1', 'ap', 'mq2', 'd2']))
+    # Lost particles reach the first element once more than their at_turn
+    assert prof.num_particle_visits[0] == np.sum(
+                        np.where(p_ref.state > 0, 10, p_ref.at_turn + 1))
+    assert np.sum(prof.num_lost) == n_lost
+    assert prof.num_lost[2] == n_lost
+    assert np.all(prof.time >= 0)
+    assert prof.time.sum() > 0
+
+    prof_type = tracker.get_profile(by='type')
+    assert set(prof_type.element_type) == {'Multipole', 'Drift', 'LimitEllipse'}
+    i_mult = list(prof_type.element_type).index('Multipole')
+    assert prof_type.num_elements[i_mult] == 2
+    assert prof_type.num_particle_visits[i_mult] == (
+                        prof.num_particle_visits[0] + prof.num_particle_visits[3])
+
+    tracker.reset_profile()
+    assert np.all(tracker.get_profile().num_particle_visits == 0)
+
+    # Derived trackers do not inherit the instrumented kernel
+    assert tracker.cycle(index_first_element=1).profile is False
+
+def test_async_compile():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                                 xt.Drift(length=1.),
+                                 xt.SRotation(angle=5.),
+                                 xt.Drift(length=1.)])
+        line_ref = xt.Line.from_dict(line.to_dict())
+
+        tracker = line.build_tracker(_context=context, compile='async')
+        assert tracker._track_kernel_future is not None
+
+        # Python-side work can proceed while compiling
+        x = np.linspace(-1e-3, 1e-3, 11)
+        particles = xp.Particles(x=x, y=0.1*x, p0c=7e12, _context=context)
+        p_ref = particles.copy()
+
+        tracker.track(particles, num_turns=10)
+        assert tracker.kernel_is_ready
+        assert tracker._track_kernel_future is None
+
+        line_ref.build_tracker(_context=context).track(p_ref, num_turns=10)
+
+        particles.move(_context=xo.ContextCpu())
+        p_ref.move(_context=xo.ContextCpu())
+        assert np.all(particles.x == p_ref.x)
+        assert np.all(particles.y == p_ref.y)
+
+_tracker_for_fork_test = None
+
+def _track_in_forked_process(x):
+    particles = xp.Particles(x=x, p0c=7e12)
+    _tracker_for_fork_test.track(particles, num_turns=10)
+    return particles.x[0]
+
+def test_async_compile_and_fork():
+
+    global _tracker_for_fork_test
+    import multiprocessing
+
+    context = xo.ContextCpu()
+    line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                             xt.Drift(length=1.),
+                             xt.SRotation(angle=5.),
+                             xt.Drift(length=1.)])
+    line_ref = xt.Line.from_dict(line.to_dict())
+
+    # Tracker used in forked processes while its kernel may still be
+    # compiling in the background
+    _tracker_for_fork_test = line.build_tracker(_context=context,
+                                                compile='async')
+    try:
+        with multiprocessing.get_context('fork').Pool(2) as pool:
+            x_test = pool.map(_track_in_forked_process, [1e-3, -2e-3])
+    finally:
+        _tracker_for_fork_test = None
+
+    p_ref = xp.Particles(x=[1e-3, -2e-3], p0c=7e12)
+    line_ref.build_tracker(_context=context).track(p_ref, num_turns=10)
+    assert np.all(np.array(x_test) == p_ref.x)
+
+    # Trackers built from this one wait for the pending compilation
+    tracker = xt.Line.from_dict(line_ref.to_dict()).build_tracker(
+                                    _context=xo.ContextCpu(), compile='async')
+    assert tracker._track_kernel_future is not None
+    backtracker = tracker.get_backtracker()
+    assert tracker._track_kernel_future is None
+    assert backtracker.track_kernel is tracker.track_kernel
+
+def test_optimize_line():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(
+            elements=[xt.Drift(length=1.),
+                      xt.Drift(length=0.),  # marker
+                      xt.Drift(length=2.),
+                      xt.Multipole(knl=[0, 0.5, 1.]),
+                      xt.Multipole(knl=[0, 0], ksl=[0, 0]),  # inactive
+                      xt.XYShift(dx=1e-4),
+                      xt.XYShift(dy=2e-4),
+                      xt.Drift(length=1.),
+                      xt.Multipole(knl=[0, -0.5]),
+                      xt.SRotation(angle=5.),
+                      xt.SRotation(angle=-5.),
+                      xt.Drift(length=1.),
+                      xt.Drift(length=1.),
+                      xt.LimitEllipse(a=1e-2, b=1e-2),
+                      xt.Drift(length=0.)], # marker
+            element_names=['d0', 'm0', 'd1', 'qf', 'mz', 'sh0', 'sh1', 'dm',
+                           'qd', 'rot0', 'rot1', 'd2', 'd3', 'ap', 'm1'])
+        line_ref = xt.Line.from_dict(line.to_dict())
+
+        tracker = line.build_tracker(_context=context, optimize_line=True)
+        tracker_ref = line_ref.build_tracker(_context=context)
+
+        assert tracker.original_line is line
+        assert tracker.line is not line
+        assert tracker.line.element_names == (
+                    'd0', 'm0', 'd1', 'qf', 'sh0', 'dm', 'qd', 'd2', 'ap', 'm1')
+        assert np.all(tracker.original_element_index
+                      == [0, 1, 2, 3, 5, 7, 8, 11, 13, 14, 15])
+        assert np.isclose(tracker.line.get_length(), line.get_length())
+
+        # Original elements are untouched
+        assert line['d2'].length == 1.
+        assert line['sh0'].dy == 0
+
+        # Multi-turn tracking with monitor and aperture losses
+        x = np.linspace(-2e-2, 2e-2, 21)
+        particles = xp.Particles(x=x, px=1e-4, y=0.1*x, p0c=7e12,
+                                 _context=context)
+        p_ref = particles.copy()
+
+        tracker.track(particles, num_turns=20, turn_by_turn_monitor=True)
+        tracker_ref.track(p_ref, num_turns=20, turn_by_turn_monitor=True)
+        mon = tracker.record_last_track
+        mon_ref = tracker_ref.record_last_track
+
+        particles.move(_context=xo.ContextCpu())
+        p_ref.move(_context=xo.ContextCpu())
+        particles.sort(interleave_lost_particles=True)
+        p_ref.sort(interleave_lost_particles=True)
+
+        assert np.any(p_ref.state < 1) and np.any(p_ref.state > 0)
+        for nn in ['state', 'at_turn', 'at_element']:
+            assert np.all(getattr(particles, nn) == getattr(p_ref, nn))
+            assert np.all(getattr(mon, nn) == getattr(mon_ref, nn))
+        for nn in ['x', 'px', 'y', 'py', 's']:
+            assert np.allclose(getattr(particles, nn), getattr(p_ref, nn),
+                               rtol=0, atol=1e-14)
+            assert np.allclose(getattr(mon, nn), getattr(mon_ref, nn),
+                               rtol=0, atol=1e-14)
+        lost_names = set(line.element_names[ii]
+                         for ii in particles.at_element[particles.state < 1])
+        assert lost_names == {'ap'}
+
+        # Markers can be used as start and stop points
+        particles = xp.Particles(x=x, p0c=7e12, _context=context)
+        p_ref = particles.copy()
+        tracker.track(particles, ele_start='m0', ele_stop='qd')
+        tracker_ref.track(p_ref, ele_start='m0', ele_stop='qd')
+        particles.move(_context=xo.ContextCpu())
+        p_ref.move(_context=xo.ContextCpu())
+        assert np.all(particles.at_element == p_ref.at_element)
+        assert np.allclose(particles.x, p_ref.x, rtol=0, atol=1e-14)
+
+        # Integer and string start and stop points refer to the original line
+        for ele_start, ele_stop in [(7, 11), ('dm', 'ap'), (3, 'd2')]:
+            particles = xp.Particles(x=x, px=1e-4, p0c=7e12, _context=context)
+            p_ref = particles.copy()
+            tracker.track(particles, ele_start=ele_start, ele_stop=ele_stop)
+            tracker_ref.track(p_ref, ele_start=ele_start, ele_stop=ele_stop)
+            particles.move(_context=xo.ContextCpu())
+            p_ref.move(_context=xo.ContextCpu())
+            assert np.all(particles.at_element == p_ref.at_element)
+            assert np.allclose(particles.x, p_ref.x, rtol=0, atol=1e-14)
+            assert np.allclose(particles.s, p_ref.s, rtol=0, atol=1e-14)
+
+        # Elements removed by the optimization cannot be used as start point
+        with pytest.raises(ValueError):
+            tracker.track(xp.Particles(p0c=7e12, _context=context),
+                          ele_start='mz')
+
+        # Element-by-element monitor is indexed by the original line
+        x = np.linspace(-2e-2, 2e-2, 21)
+        particles = xp.Particles(x=x, px=1e-4, p0c=7e12, _context=context)
+        p_ref = particles.copy()
+        tracker.track(particles, turn_by_turn_monitor='ONE_TURN_EBE')
+        tracker_ref.track(p_ref, turn_by_turn_monitor='ONE_TURN_EBE')
+        mon = tracker.record_last_track
+        mon_ref = tracker_ref.record_last_track
+        assert mon.x.shape == mon_ref.x.shape == (21, len(line.elements) + 1)
+        i_kept = tracker.original_element_index
+        assert np.all(mon.at_element[:, i_kept]
+                      == mon_ref.at_element[:, i_kept])
+        assert np.allclose(mon.x[:, i_kept], mon_ref.x[:, i_kept],
+                           rtol=0, atol=1e-14)
+        # Records at the aperture and at the end of the line are kept
+        assert np.all(mon.at_element[:, 13] == 13)
+        assert np.all(mon.at_element[:, -1] == len(line.elements))
+
+def test_reduced_precision():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        for precision in ['float32', 'mixed']:
+            line = xt.Line(elements=[xt.Multipole(knl=[0, 0.1]),
+                                     xt.Drift(length=1.),
+                                     xt.Multipole(knl=[0, -0.1, 0.5]),
+                                     xt.Drift(length=1.)])
+
+            if isinstance(context, xo.ContextCpu):
+                # Slower than double on CPU, not available
+                with pytest.raises(NotImplementedError):
+                    line.build_tracker(_context=context, precision=precision)
+                continue
+
+            tracker = line.build_tracker(_context=context, precision=precision)
+            assert tracker.precision == precision
+
+            x = np.linspace(-1e-3, 1e-3, 11)
+            particles = xp.Particles(x=x, y=0.1*x, delta=1e-4, p0c=7e12,
+                                     _context=context)
+
+            diff = tracker.compare_with_double_precision(particles,
+                                                         num_turns=100)
+            assert diff['num_state_mismatch'] == 0
+            for nn in ['x', 'px', 'y', 'py']:
+                assert diff[nn] < 1e-8
+            assert diff['x'] > 0 # single precision is actually used
+
+def test_streaming_monitor(tmp_path):
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                                 xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, -0.5]),
+                                 xt.Drift(length=1.)])
+        tracker = line.build_tracker(_context=context)
+
+        x = np.linspace(-1e-3, 1e-3, 11)
+        particles = xp.Particles(x=x, y=0.1*x, p0c=7e12, _context=context)
+        p_ref = particles.copy()
+
+        num_turns = 25
+        monitor_ref = xt.ParticlesMonitor(_context=context, start_at_turn=0,
+                                          stop_at_turn=num_turns,
+                                          num_particles=len(x))
+        tracker.track(p_ref, num_turns=num_turns,
+                      turn_by_turn_monitor=monitor_ref)
+
+        monitor = xt.StreamingParticlesMonitor(
+                        path=tmp_path / context.__class__.__name__,
+                        _context=context, start_at_turn=0,
+                        stop_at_turn=num_turns, ring_turns=7,
+                        num_particles=len(x))
+        assert monitor.device_monitor.stop_at_turn == 7
+
+        # Tracking split in two calls
+        tracker.track(particles, num_turns=10, turn_by_turn_monitor=monitor)
+        tracker.track(particles, num_turns=15, turn_by_turn_monitor=monitor)
+        assert tracker.record_last_track is monitor
+
+        assert isinstance(monitor.x, np.memmap)
+        assert monitor.x.shape == (len(x), num_turns)
+        for nn in ['x', 'px', 'y', 'at_turn', 'particle_id']:
+            assert np.all(getattr(monitor, nn) == getattr(monitor_ref, nn))
+
+        # Data is on disk
+        x_disk = np.load(tmp_path / context.__class__.__name__ / 'x.npy')
+        assert np.all(x_disk == monitor_ref.x)
+
+def test_moments_monitor():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                                 xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, -0.5]),
+                                 xt.Drift(length=1.)])
+        tracker = line.build_tracker(_context=context)
+        # Compiled in the kernel only when used
+        assert xt.MomentsMonitor._XoStruct not in tracker.element_classes
+
+        n_part = 1000
+        particles = xp.Particles(_context=context, p0c=7e12,
+                                 x=np.random.normal(0, 1e-3, n_part),
+                                 px=np.random.normal(0, 1e-5, n_part),
+                                 y=np.random.normal(0, 2e-3, n_part),
+                                 py=np.random.normal(0, 2e-5, n_part),
+                                 zeta=np.random.normal(0, 1e-2, n_part),
+                                 delta=np.random.normal(0, 1e-4, n_part))
+        p_ref = particles.copy()
+
+        num_turns = 20
+        moments = xt.MomentsMonitor(_context=context, start_at_turn=0,
+                                    stop_at_turn=num_turns)
+        tracker.track(particles, num_turns=num_turns,
+                      turn_by_turn_monitor=moments)
+        assert tracker.record_last_track is moments
+        assert xt.MomentsMonitor._XoStruct in tracker.element_classes
+
+        monitor_ref = xt.ParticlesMonitor(_context=context, start_at_turn=0,
+                                          stop_at_turn=num_turns,
+                                          num_particles=n_part)
+        tracker.track(p_ref, num_turns=num_turns,
+                      turn_by_turn_monitor=monitor_ref)
+
+        assert np.allclose(moments.num_particles, n_part, rtol=0, atol=1e-9)
+
+        coords = np.array([getattr(monitor_ref, nn)
+                           for nn in xt.MomentsMonitor.coordinates])
+        # coords shape: (6, n_part, n_turns)
+        mean_ref = coords.mean(axis=1).T
+        assert np.allclose(moments.centroid, mean_ref, rtol=1e-9, atol=1e-15)
+
+        for i_turn in [0, 10, num_turns - 1]:
+            sigma_ref = np.cov(coords[:, :, i_turn], bias=True)
+            assert np.allclose(moments.sigma_matrix[i_turn], sigma_ref,
+                               rtol=1e-6, atol=1e-20)
+            assert np.isclose(moments.gemitt_x[i_turn],
+                    np.sqrt(np.linalg.det(sigma_ref[:2, :2])), rtol=1e-6)
+
+def test_moments_monitor_offset_beam():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        # Beam far from the origin compared to its size, for which the raw
+        # second order sums would cancel
+        n_part = 1000
+        x_part = 0.1 + np.random.normal(0, 1e-9, n_part)
+        px_part = 1e-5 + np.random.normal(0, 1e-11, n_part)
+
+        in_line = xt.MomentsMonitor(_context=context, start_at_turn=0,
+                                    stop_at_turn=1)
+        line = xt.Line(elements=[xt.Drift(length=1.), in_line])
+        tracker = line.build_tracker(_context=context)
+        assert xt.MomentsMonitor._XoStruct in tracker.element_classes
+
+        particles = xp.Particles(_context=context, p0c=7e12,
+                                 x=x_part, px=px_part)
+        moments = xt.MomentsMonitor(_context=context, start_at_turn=0,
+                                    stop_at_turn=1)
+        tracker.track(particles, turn_by_turn_monitor=moments)
+
+        # The in-line monitor records at the end of the turn
+        x_end = context.nparray_from_context_array(particles.x)
+        for mm, xx in [(moments, x_part), (in_line, x_end)]:
+            assert mm.has_reference
+            assert np.isclose(mm.centroid[0, 0], xx.mean(),
+                              rtol=0, atol=1e-15)
+            assert np.isclose(mm.sigma_matrix[0, 0, 0],
+                              np.var(xx), rtol=1e-6, atol=0)
+            assert np.isclose(mm.sigma_matrix[0, 1, 1],
+                              np.var(px_part), rtol=1e-6, atol=0)
+
+def test_compact_monitor():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                                 xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, -0.5]),
+                                 xt.Drift(length=1.)])
+        tracker = line.build_tracker(_context=context)
+
+        x = np.linspace(-1e-3, 1e-3, 11)
+        particles = xp.Particles(x=x, y=0.1*x, p0c=7e12, _context=context)
+
+        num_turns = 100
+        monitor_ref = xt.ParticlesMonitor(_context=context, start_at_turn=0,
+                                          stop_at_turn=num_turns,
+                                          num_particles=len(x))
+        tracker.track(particles.copy(), num_turns=num_turns,
+                      turn_by_turn_monitor=monitor_ref)
+
+        for kwargs in [dict(every=7, stop_at_turn=num_turns),
+                       dict(num_log_turns=10, stop_at_turn=num_turns),
+                       dict(turns=[3, 0, 50, 99])]:
+            monitor = xt.CompactParticlesMonitor(_context=context,
+                                                 fields=('x', 'py'),
+                                                 num_particles=len(x),
+                                                 **kwargs)
+            turns = context.nparray_from_context_array(monitor.turns)
+            assert np.all(np.diff(turns) > 0)
+            assert monitor.fields == ('x', 'py')
+            assert len(monitor.rec_zeta) == 0
+            with pytest.raises(AttributeError):
+                monitor.zeta
+
+            tracker.track(particles.copy(), num_turns=num_turns,
+                          turn_by_turn_monitor=monitor)
+
+            assert monitor.x.shape == (len(x), len(turns))
+            assert np.all(monitor.x == monitor_ref.x[:, turns])
+            assert np.all(monitor.py == monitor_ref.py[:, turns])
+
+def test_compact_monitor_ebe():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.5, 5.]),
+                                 xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, -0.5]),
+                                 xt.Drift(length=1.)])
+        tracker = line.build_tracker(_context=context)
+
+        x = np.linspace(-1e-3, 1e-3, 9)
+        particles = xp.Particles(x=x, y=0.1*x, delta=1e-4, p0c=7e12,
+                                 _context=context)
+
+        p_ref = particles.copy()
+        tracker.track(p_ref, turn_by_turn_monitor='ONE_TURN_EBE')
+        mon_ref = tracker.record_last_track
+
+        fields = ('x', 'px', 'y', 'py', 'zeta', 'ptau', 's')
+        probe = xt.CompactParticlesMonitor(_context=context, fields=fields,
+                                           turns=np.arange(len(line) + 1),
+                                           num_particles=len(x),
+                                           ebe_mode=True)
+        tracker.track(particles.copy(), turn_by_turn_monitor=probe)
+
+        for nn in fields:
+            assert np.all(getattr(probe, nn) == getattr(mon_ref, nn))
+
+def test_closed_orbit_batched_newton():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[1e-5, 0.3], ksl=[-2e-5]),
+                                 xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, -0.3]),
+                                 xt.Drift(length=1.)])
+        line.particle_ref = xp.Particles(p0c=7e12, _context=context)
+        tracker = line.build_tracker(_context=context)
+
+        part_co = tracker.find_closed_orbit(delta0=0)
+        assert part_co._fsolve_info == 'batched_newton'
+        part_co.move(_context=xo.context_default)
+        assert np.abs(part_co.x[0]) > 1e-6
+        assert np.abs(part_co.y[0]) > 1e-6
+
+        part = part_co.copy(_context=context)
+        tracker.track(part)
+        part.move(_context=xo.context_default)
+        for nn in ['x', 'px', 'y', 'py']:
+            assert np.isclose(getattr(part, nn)[0], getattr(part_co, nn)[0],
+                              atol=1e-12, rtol=0)
+
+def test_batched_one_turn_matrices():
+
+    from xtrack.twiss import _compute_one_turn_matrices_finite_differences
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.3, 0.5]),
+                                 xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, -0.3, -0.5]),
+                                 xt.Drift(length=1.)])
+        line.particle_ref = xp.Particles(p0c=7e12, _context=context)
+        tracker = line.build_tracker(_context=context)
+
+        parts = [xp.Particles(p0c=7e12, x=1e-4, delta=dd, _context=context)
+                 for dd in [1e-4, -1e-4]]
+        RRs = _compute_one_turn_matrices_finite_differences(
+                                        tracker, particles_on_co=parts)
+        assert len(RRs) == 2
+        assert not np.allclose(RRs[0], RRs[1], atol=1e-10, rtol=0)
+        for pp, RR in zip(parts, RRs):
+            RR_single = tracker.compute_one_turn_matrix_finite_differences(
+                                                        particle_on_co=pp)
+            assert np.allclose(RR, RR_single, atol=1e-12, rtol=0)
+
+def test_element_transfer_matrices():
+
+    from xtrack.transfer_matrices import (get_element_transfer_matrices,
+                                          _tracked_matrix)
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[
+                    xt.Drift(length=2.),
+                    xt.Multipole(knl=[1e-3, 0.1, 0.5], ksl=[0, 0.02],
+                                 hxl=1e-3, length=1.),
+                    xt.SRotation(angle=10.),
+                    xt.DipoleEdge(h=0.05, e1=0.1, hgap=0.03, fint=0.4),
+                    xt.XYShift(dx=1e-3),
+                    xt.Cavity(voltage=1e6, frequency=400e6, lag=30)])
+        line.particle_ref = xp.Particles(p0c=1e9, _context=context)
+        tracker = line.build_tracker(_context=context)
+
+        particle_on_co = xp.Particles(p0c=1e9, _context=context)
+        co = np.array([[1e-3, 2e-4, -1e-3, 1e-4, 1e-2, 3e-4]] * 6).T
+        i_elements = np.arange(6)
+        mats = get_element_transfer_matrices(tracker, i_elements=i_elements,
+                                    co=co, particle_on_co=particle_on_co)
+        for ii in i_elements:
+            mat_ref = _tracked_matrix(tracker, ii, co[:, ii], particle_on_co)
+            assert np.allclose(mats[ii], mat_ref, atol=1e-7, rtol=1e-6)
+
+        # Only the modified element is recomputed
+        cache_before = dict(tracker._element_matrix_cache)
+        line.elements[1].knl[1] = 0.2
+        get_element_transfer_matrices(tracker, i_elements=i_elements,
+                                      co=co, particle_on_co=particle_on_co)
+        for ii in i_elements:
+            if ii == 1:
+                assert tracker._element_matrix_cache[ii] is not cache_before[ii]
+            else:
+                assert tracker._element_matrix_cache[ii] is cache_before[ii]
+
+def test_one_turn_matrix_at_incremental_update():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        line = xt.Line(elements=[xt.Multipole(knl=[0, 0.3]),
+                                 xt.Drift(length=1.),
+                                 xt.Multipole(knl=[0, -0.3]),
+                                 xt.Drift(length=1.)])
+        line.particle_ref = xp.Particles(p0c=7e12, _context=context)
+        tracker = line.build_tracker(_context=context)
+
+        part_co = tracker.find_closed_orbit(delta0=0)
+        RR = tracker.one_turn_matrix_at(0, particle_on_co=part_co)
+        RR_ref = tracker.compute_one_turn_matrix_finite_differences(
+                                                    particle_on_co=part_co)
+        assert np.allclose(RR, RR_ref, atol=1e-7, rtol=1e-6)
+
+        # Nothing has changed, the tree is queried without any tracking
+        track = tracker.track
+        tracker.track = None
+        RR_2 = tracker.one_turn_matrix_at(2)
+        RR_2_same_co = tracker.one_turn_matrix_at(2, particle_on_co=part_co)
+        tracker.track = track
+        assert np.all(RR_2 == RR_2_same_co)
+
+        # Only the modified element is recomputed
+        cache_before = dict(tracker._element_matrix_cache)
+        line.elements[2].knl = [0, -0.31]
+        part_co = tracker.find_closed_orbit(delta0=0)
+        RR = tracker.one_turn_matrix_at(0, particle_on_co=part_co)
+        RR_ref = tracker.compute_one_turn_matrix_finite_differences(
+                                                    particle_on_co=part_co)
+        assert np.allclose(RR, RR_ref, atol=1e-7, rtol=1e-6)
+        for ii in range(4):
+            if ii == 2:
+                assert tracker._element_matrix_cache[ii] is not cache_before[ii]
+            else:
+                assert tracker._element_matrix_cache[ii] is cache_before[ii]
+
+        # In-place writes are detected from the element data, without any
+        # tracking (no closed orbit in this line)
+        cache_before = dict(tracker._element_matrix_cache)
+        line.elements[0].knl[1] = 0.32
+        tracker.track = None
+        RR = tracker.one_turn_matrix_at(0)
+        tracker.track = track
+        RR_ref = tracker.compute_one_turn_matrix_finite_differences(
+                                                    particle_on_co=part_co)
+        assert np.allclose(RR, RR_ref, atol=1e-7, rtol=1e-6)
+        for ii in range(4):
+            if ii == 0:
+                assert tracker._element_matrix_cache[ii] is not cache_before[ii]
+            else:
+                assert tracker._element_matrix_cache[ii] is cache_before[ii]
+
+        part_co.at_element = 1
+        with pytest.raises(ValueError):
+            tracker.one_turn_matrix_at(0, particle_on_co=part_co)
+
+def test_twiss_cache_in_place_write():
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        elements = []
+        for _ in range(20):
+            elements += [xt.Multipole(knl=[0, 0.05]), xt.Drift(length=1.),
+                         xt.Multipole(knl=[0, -0.05]), xt.Drift(length=1.)]
+        line = xt.Line(elements=elements)
+        line.particle_ref = xp.Particles(p0c=1e9, mass0=xp.PROTON_MASS_EV)
+        tracker = line.build_tracker(_context=context)
+
+        tw0 = tracker.twiss(method='4d')
+        cache_before = tracker._twiss_cache
+        tracker.twiss(method='4d')
+        assert tracker._twiss_cache is cache_before
+
+        # In-place write of an array item, not seen by the version counter
+        line.elements[0].knl[1] = 0.03
+        tw1 = tracker.twiss(method='4d')
+        tracker.use_twiss_cache = False
+        tw1_ref = tracker.twiss(method='4d')
+
+        assert not np.isclose(tw1.qx, tw0.qx, atol=1e-3, rtol=0)
+        assert np.isclose(tw1.qx, tw1_ref.qx, atol=1e-10, rtol=0)
+
+def test_twiss_at_s_drift_and_tracked_points(monkeypatch):
+
+    import xtrack.twiss as xttwiss
+
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        elements = []
+        for _ in range(20):
+            elements += [xt.Multipole(knl=[0, 0.05]), xt.Drift(length=1.),
+                         xt.Multipole(knl=[0, -0.05]), xt.Drift(length=1.)]
+        line = xt.Line(elements=elements)
+        line.particle_ref = xp.Particles(p0c=1e9, mass0=xp.PROTON_MASS_EV)
+        tracker = line.build_tracker(_context=context)
+        tracker.use_twiss_cache = False
+
+        at_s = np.linspace(0.1, 39.7, 45)
+        tw_drift = tracker.twiss(method='4d', at_s=at_s)
+
+        # Points in drifts 5 and 7 are treated as inside non-drift elements
+        locate = xttwiss._locate_points_in_drifts
+        def locate_with_thick(line, at_s):
+            i_ele, ds, mask = locate(line, at_s)
+            mask[(i_ele == 5) | (i_ele == 7)] = False
+            return i_ele, ds, mask
+        build_aux = xttwiss._build_auxiliary_tracker_with_extra_markers
+        n_aux_points = []
+        def build_aux_and_count(tracker, at_s, **kwargs):
+            n_aux_points.append(len(at_s))
+            return build_aux(tracker=tracker, at_s=at_s, **kwargs)
+        monkeypatch.setattr(xttwiss, '_locate_points_in_drifts',
+                            locate_with_thick)
+        monkeypatch.setattr(xttwiss,
+                            '_build_auxiliary_tracker_with_extra_markers',
+                            build_aux_and_count)
+        tw_mixed = tracker.twiss(method='4d', at_s=at_s)
+        monkeypatch.undo()
+
+        # Only the points in drifts 5 and 7 go through the auxiliary tracker
+        s_ele = np.array(line.get_s_elements())
+        n_tracked = np.sum(((at_s > s_ele[5]) & (at_s < s_ele[6]))
+                           | ((at_s > s_ele[7]) & (at_s < s_ele[8])))
+        assert n_aux_points == [n_tracked]
+        assert 0 < n_tracked < len(at_s)
+
+        assert tuple(tw_mixed.name) == tuple(tw_drift.name)
+        assert np.allclose(tw_mixed.s, at_s, atol=1e-10, rtol=0)
+        for nn in ['x', 'px', 'dx', 'dpx']:
+            assert np.allclose(tw_mixed[nn], tw_drift[nn], atol=1e-9, rtol=0)
+        for nn in ['betx', 'bety']:
+            assert np.allclose(tw_mixed[nn], tw_drift[nn], atol=0, rtol=1e-7)
+        for nn in ['alfx', 'alfy', 'mux', 'muy']:
+            assert np.allclose(tw_mixed[nn], tw_drift[nn], atol=1e-7, rtol=0)
@@ -10,13 +10,15 @@ from .beam_elements import *
 from .line_frozen import LineFrozen
 from .line import Line
 from .tracker import Tracker
+from .ensemble import TrackerEnsemble
 from .loss_location_refinement import LossLocationRefinement
 from .internal_record import (RecordIdentifier, RecordIndex, new_io_buffer,
                              start_internal_logging, stop_internal_logging)
 from .pipeline import (PipelineStatus, PipelineMultiTracker, PipelineBranch,
                         PipelineManager)
 
-from .monitors import generate_monitor_class
+from .monitors import (generate_monitor_class, StreamingParticlesMonitor,
+                       MomentsMonitor, CompactParticlesMonitor)
 from . import linear_normal_form
 
 from .mad_loader import MadLoader
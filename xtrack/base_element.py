@@ -36,6 +36,21 @@ end_part_part_block = """
    }   //only_for_context cpu_serial cpu_openmp
 """
 
+# Counter of the modifications of element parameters, incremented by the
+# assignment of element fields (e.g. `element.k1 = 0.1`), by `vars` and
+# `element_refs` and by `MultiSetter`. It is used by the trackers to
+# invalidate cached results (e.g. twiss). In-place changes of array items
+# (e.g. `element.knl[1] = 0.1`) are not counted, the trackers check also the
+# content of the element data (see Tracker._get_lattice_fingerprint).
+_lattice_version = 0
+
+def _increment_lattice_version():
+    global _lattice_version
+    _lattice_version += 1
+
+def _get_lattice_version():
+    return _lattice_version
+
 def _handle_per_particle_blocks(sources, local_particle_src):
 
     if isinstance(sources, str):
@@ -220,6 +235,11 @@ class BeamElement(xo.HybridClass, metaclass=MetaBeamElement):
 
     iscollective = None
 
+    def __setattr__(self, name, value):
+        if name in self._xofields:
+            _increment_lattice_version()
+        super().__setattr__(name, value)
+
     def init_pipeline(self,pipeline_manager,name,partners_names=[]):
         self._pipeline_manager = pipeline_manager
         self.name = name
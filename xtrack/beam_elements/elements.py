@@ -42,7 +42,9 @@ class Drift(BeamElement):
     isthick=True
     behaves_like_drift=True
 
-    _extra_c_sources = [_pkg_root.joinpath('beam_elements/elements_src/drift.h')]
+    _extra_c_sources = [
+        _pkg_root.joinpath('headers/real_types.h'),
+        _pkg_root.joinpath('beam_elements/elements_src/drift.h')]
 
     def get_backtrack_element(self, _context=None, _buffer=None, _offset=None):
         return self.__class__(length=-self.length,
@@ -89,6 +91,7 @@ class XYShift(BeamElement):
         }
 
     _extra_c_sources = [
+        _pkg_root.joinpath('headers/real_types.h'),
         _pkg_root.joinpath('beam_elements/elements_src/xyshift.h')]
 
     def get_backtrack_element(self, _context=None, _buffer=None, _offset=None):
@@ -215,6 +218,7 @@ class SRotation(BeamElement):
         }
 
     _extra_c_sources = [
+        _pkg_root.joinpath('headers/real_types.h'),
         _pkg_root.joinpath('beam_elements/elements_src/srotation.h')]
 
     _store_in_to_dict = ['angle']
@@ -280,6 +284,7 @@ class Multipole(BeamElement):
         xp.general._pkg_root.joinpath('random_number_generator/rng_src/local_particle_rng.h'),
         _pkg_root.joinpath('headers/constants.h'),
         _pkg_root.joinpath('headers/synrad_spectrum.h'),
+        _pkg_root.joinpath('headers/real_types.h'),
         _pkg_root.joinpath('beam_elements/elements_src/multipole.h')]
 
     _internal_record_class = SynchrotronRadiationRecord
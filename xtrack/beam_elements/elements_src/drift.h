@@ -9,15 +9,15 @@
 /*gpufun*/
 void Drift_track_local_particle(DriftData el, LocalParticle* part0){
 
-    double const length = DriftData_get_length(el);
+    XT_REAL_LONG const length = DriftData_get_length(el);
 
     //start_per_particle_block (part0->part)
 
-        double const rpp    = LocalParticle_get_rpp(part);
-        double const rv0v    = 1./LocalParticle_get_rvv(part);
-        double const xp     = LocalParticle_get_px(part) * rpp;
-        double const yp     = LocalParticle_get_py(part) * rpp;
-        double const dzeta  = 1 - rv0v * ( 1. + ( xp*xp + yp*yp ) / 2. );
+        XT_REAL_LONG const rpp    = LocalParticle_get_rpp(part);
+        XT_REAL_LONG const rv0v    = 1./LocalParticle_get_rvv(part);
+        XT_REAL const xp     = LocalParticle_get_px(part) * rpp;
+        XT_REAL const yp     = LocalParticle_get_py(part) * rpp;
+        XT_REAL_LONG const dzeta  = 1 - rv0v * ( 1. + ( xp*xp + yp*yp ) / 2. );
 
         LocalParticle_add_to_x(part, xp * length );
         LocalParticle_add_to_y(part, yp * length );
@@ -27,22 +27,22 @@ void Multipole_track_local_particle(MultipoleData el, LocalParticle* part0){
         int64_t order = MultipoleData_get_order(el);
         int64_t index = order;
 
-        double inv_factorial = MultipoleData_get_inv_factorial_order(el);
+        XT_REAL inv_factorial = MultipoleData_get_inv_factorial_order(el);
 
-        double dpx = MultipoleData_get_knl(el, index) * inv_factorial;
-        double dpy = MultipoleData_get_ksl(el, index) * inv_factorial;
+        XT_REAL dpx = MultipoleData_get_knl(el, index) * inv_factorial;
+        XT_REAL dpy = MultipoleData_get_ksl(el, index) * inv_factorial;
 
-        double const x   = LocalParticle_get_x(part);
-        double const y   = LocalParticle_get_y(part);
-        double const chi = LocalParticle_get_chi(part);
+        XT_REAL const x   = LocalParticle_get_x(part);
+        XT_REAL const y   = LocalParticle_get_y(part);
+        XT_REAL const chi = LocalParticle_get_chi(part);
 
-        double const hxl = MultipoleData_get_hxl(el);
-        double const hyl = MultipoleData_get_hyl(el);
+        XT_REAL const hxl = MultipoleData_get_hxl(el);
+        XT_REAL const hyl = MultipoleData_get_hyl(el);
 
         while( index > 0 )
         {
-            double const zre = dpx * x - dpy * y;
-            double const zim = dpx * y + dpy * x;
+            XT_REAL const zre = dpx * x - dpy * y;
+            XT_REAL const zim = dpx * y + dpy * x;
 
             inv_factorial *= index;
             index -= 1;
@@ -73,12 +73,12 @@ void Multipole_track_local_particle(MultipoleData el, LocalParticle* part0){
 
         if( ( hxl > 0) || ( hyl > 0) || ( hxl < 0 ) || ( hyl < 0 ) )
         {
-            double const delta  = LocalParticle_get_delta(part);
+            XT_REAL_LONG const delta  = LocalParticle_get_delta(part);
 
-            double const hxlx   = x * hxl;
-            double const hyly   = y * hyl;
+            XT_REAL const hxlx   = x * hxl;
+            XT_REAL const hyly   = y * hyl;
 
-            double const rv0v = 1./LocalParticle_get_rvv(part);
+            XT_REAL_LONG const rv0v = 1./LocalParticle_get_rvv(part);
 
             LocalParticle_add_to_zeta(part, rv0v*chi * ( hyly - hxlx ) );
 
@@ -87,8 +87,8 @@ void Multipole_track_local_particle(MultipoleData el, LocalParticle* part0){
 
             if( length != 0)
             {
-                double const b1l = chi * MultipoleData_get_knl(el, 0 );
-                double const a1l = chi * MultipoleData_get_ksl(el, 0 );
+                XT_REAL const b1l = chi * MultipoleData_get_knl(el, 0 );
+                XT_REAL const a1l = chi * MultipoleData_get_ksl(el, 0 );
 
                 dpx -= b1l * hxlx / length;
                 dpy += a1l * hyly / length;
@@ -10,19 +10,19 @@
 void SRotation_track_local_particle(SRotationData el, LocalParticle* part0){
 
     //start_per_particle_block (part0->part)
-    	double const sin_z = SRotationData_get_sin_z(el);
-    	double const cos_z = SRotationData_get_cos_z(el);
+    	XT_REAL const sin_z = SRotationData_get_sin_z(el);
+    	XT_REAL const cos_z = SRotationData_get_cos_z(el);
 
-    	double const x  = LocalParticle_get_x(part);
-    	double const y  = LocalParticle_get_y(part);
-    	double const px = LocalParticle_get_px(part);
-    	double const py = LocalParticle_get_py(part);
+    	XT_REAL const x  = LocalParticle_get_x(part);
+    	XT_REAL const y  = LocalParticle_get_y(part);
+    	XT_REAL const px = LocalParticle_get_px(part);
+    	XT_REAL const py = LocalParticle_get_py(part);
 
-    	double const x_hat  =  cos_z * x  + sin_z * y;
-    	double const y_hat  = -sin_z * x  + cos_z * y;
+    	XT_REAL const x_hat  =  cos_z * x  + sin_z * y;
+    	XT_REAL const y_hat  = -sin_z * x  + cos_z * y;
 
-    	double const px_hat =  cos_z * px + sin_z * py;
-    	double const py_hat = -sin_z * px + cos_z * py;
+    	XT_REAL const px_hat =  cos_z * px + sin_z * py;
+    	XT_REAL const py_hat = -sin_z * px + cos_z * py;
 
 
     	LocalParticle_set_x(part, x_hat);
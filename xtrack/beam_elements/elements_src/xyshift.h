@@ -9,8 +9,8 @@
 /*gpufun*/
 void XYShift_track_local_particle(XYShiftData el, LocalParticle* part0){
 
-    double const minus_dx = -(XYShiftData_get_dx(el));
-    double const minus_dy = -(XYShiftData_get_dy(el));
+    XT_REAL const minus_dx = -(XYShiftData_get_dx(el));
+    XT_REAL const minus_dy = -(XYShiftData_get_dy(el));
 
     //start_per_particle_block (part0->part)
     	LocalParticle_add_to_x(part, minus_dx );
@@ -0,0 +1,78 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+_monitor_settings = ('start_at_turn', 'stop_at_turn', 'part_id_start',
+                     'part_id_end', 'ebe_mode', 'n_records', 'n_repetitions',
+                     'repetition_period')
+
+def _get_particles_state(particles):
+    ctx2np = particles._buffer.context.nparray_from_context_array
+    state = {'_capacity': particles._capacity,
+             '_num_active_particles': particles._num_active_particles,
+             '_num_lost_particles': particles._num_lost_particles}
+    for tt, nn in particles._structure['scalar_vars']:
+        state[nn] = getattr(particles, nn)
+    for tt, nn in particles._structure['per_particle_vars']:
+        state[nn] = ctx2np(getattr(particles, nn)).copy()
+    return state
+
+def _set_particles_state(particles, state):
+    if particles._capacity != state['_capacity']:
+        raise ValueError('The particles object has capacity '
+                         f'{particles._capacity} while the checkpoint has '
+                         f'{state["_capacity"]}')
+    np2ctx = particles._buffer.context.nparray_to_context_array
+    for tt, nn in particles._structure['scalar_vars']:
+        setattr(particles, nn, state[nn])
+    with particles._bypass_linked_vars():
+        for tt, nn in particles._structure['per_particle_vars']:
+            getattr(particles, nn)[:] = np2ctx(state[nn])
+    particles._num_active_particles = state['_num_active_particles']
+    particles._num_lost_particles = state['_num_lost_particles']
+
+def save_checkpoint(path, particles, monitor, track_info):
+
+    checkpoint = {
+        'track_info': track_info,
+        'particles': _get_particles_state(particles),
+        'monitor': None,
+    }
+    if monitor is not None:
+        checkpoint['monitor'] = {
+            'settings': {nn: int(getattr(monitor, nn))
+                         for nn in _monitor_settings},
+            'data': _get_particles_state(monitor.data),
+        }
+
+    # Write to a temporary file and rename, such that an interrupted job
+    # never leaves a corrupted checkpoint behind
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as fid:
+        pickle.dump(checkpoint, fid, protocol=pickle.HIGHEST_PROTOCOL)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    with open(path, 'rb') as fid:
+        return pickle.load(fid)
+
+def restore_particles(particles, checkpoint):
+    _set_particles_state(particles, checkpoint['particles'])
+
+def restore_monitor(monitor, checkpoint):
+    settings = checkpoint['monitor']['settings']
+    for nn in _monitor_settings:
+        if int(getattr(monitor, nn)) != settings[nn]:
+            raise ValueError(
+                f'Monitor setting `{nn}` does not match the checkpoint')
+    _set_particles_state(monitor.data, checkpoint['monitor']['data'])
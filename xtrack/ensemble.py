@@ -0,0 +1,119 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import numpy as np
+
+import xobjects as xo
+
+from .tracker import Tracker
+
+
+class TrackerEnsemble:
+
+    '''
+    Tracks particles against several variants of the same line (same element
+    names and types, different parameter values). All variants are stored in
+    a single buffer and share one compiled track kernel. Each particle is
+    tracked through the variant selected by `variant_index`.
+    '''
+
+    def __init__(self, lines, _context=None, _buffer=None, **kwargs):
+
+        lines = list(lines)
+        assert len(lines) > 0
+
+        if kwargs.get('optimize_line', False):
+            raise NotImplementedError(
+                'Line optimization is not available for tracker ensembles')
+
+        ref_line = lines[0]
+        for iv, line in enumerate(lines[1:], start=1):
+            if tuple(line.element_names) != tuple(ref_line.element_names):
+                raise ValueError(
+                    f'Variant {iv} has different element names than variant 0')
+            for nn, e0, ee in zip(line.element_names, ref_line.elements,
+                                  line.elements):
+                if ee.__class__ is not e0.__class__:
+                    raise ValueError(
+                        f'Element `{nn}` has type {ee.__class__.__name__} in '
+                        f'variant {iv} and {e0.__class__.__name__} in '
+                        'variant 0')
+
+        if _buffer is None:
+            if _context is None:
+                _context = xo.context_default
+            _buffer = _context.new_buffer()
+
+        self.trackers = []
+        for line in lines:
+            if len(self.trackers) == 0:
+                tracker = Tracker(_buffer=_buffer, line=line, **kwargs)
+            else:
+                tracker = Tracker(_buffer=_buffer, line=line,
+                        track_kernel=self.trackers[0].track_kernel,
+                        element_classes=self.trackers[0].element_classes,
+                        **kwargs)
+            self.trackers.append(tracker)
+
+        # All variants are tracked in a single launch of a dedicated kernel
+        # selecting the element offsets of each particle's variant
+        ctx2np = _buffer.context.nparray_from_context_array
+        self._ele_offsets_dev = _buffer.context.nparray_to_context_array(
+            np.concatenate([ctx2np(tt.ele_offsets_dev) for tt in self.trackers]))
+        self._track_kernel = self.trackers[0]._build_kernel(
+                                save_source_as=None, compile=True, ensemble=True)
+
+    @property
+    def num_variants(self):
+        return len(self.trackers)
+
+    @property
+    def _buffer(self):
+        return self.trackers[0]._buffer
+
+    def track(self, particles, variant_index, num_turns=1):
+
+        '''
+        Track `particles` for `num_turns` turns. `variant_index` gives, for
+        each particle slot, the index of the variant to be used. On exit the
+        slots still correspond to `variant_index`, hence lost particles may be
+        interleaved with active ones (as after
+        `particles.sort(interleave_lost_particles=True)`). On CPU,
+        `particles.reorganize()` needs to be called before tracking the
+        particles with a single tracker.
+        '''
+
+        context = particles._buffer.context
+        variant_index = np.atleast_1d(
+                    context.nparray_from_context_array(variant_index))
+        assert len(variant_index) == particles._capacity
+        if np.any((variant_index < 0) | (variant_index >= self.num_variants)):
+            raise ValueError('`variant_index` out of range')
+        variant_index_dev = context.nparray_to_context_array(
+                                        variant_index.astype(np.int64))
+
+        tracker = self.trackers[0]
+        if (any(tt.line._needs_rng for tt in self.trackers)
+                and not particles._has_valid_rng_state()):
+            particles._init_random_number_generator()
+
+        self._track_kernel(
+            buffer=self._buffer.buffer,
+            ele_offsets=self._ele_offsets_dev,
+            ele_typeids=tracker.ele_typeids_dev,
+            particles=particles._xobject,
+            num_turns=num_turns,
+            ele_start=0,
+            num_ele_track=tracker.num_elements,
+            flag_end_turn_actions=not tracker.skip_end_turn_actions,
+            flag_reset_s_at_end_turn=tracker.reset_s_at_end_turn,
+            flag_monitor=0,
+            buffer_tbt_monitor=particles._buffer.buffer,
+            offset_tbt_monitor=0,
+            io_buffer=tracker.io_buffer.buffer,
+            num_threads=particles._capacity,
+            variant_index=variant_index_dev,
+            num_elements_variant=tracker.num_elements,
+        )
@@ -0,0 +1,23 @@
+// copyright ############################### //
+// This file is part of the Xtrack Package.  //
+// Copyright (c) CERN, 2021.                 //
+// ######################################### //
+
+#ifndef XTRACK_REAL_TYPES_H
+#define XTRACK_REAL_TYPES_H
+
+// Types of the local variables of the element kernels supporting reduced
+// precision: XT_REAL for transverse quantities, XT_REAL_LONG for longitudinal
+// and energy quantities. Both are double unless defined by the tracker
+// (precision='float32' or 'mixed'). Particle and element data are always
+// stored in double.
+
+#if !defined( XT_REAL )
+    #define XT_REAL double
+#endif /* !defined( XT_REAL ) */
+
+#if !defined( XT_REAL_LONG )
+    #define XT_REAL_LONG double
+#endif /* !defined( XT_REAL_LONG ) */
+
+#endif /* XTRACK_REAL_TYPES_H */
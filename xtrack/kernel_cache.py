@@ -0,0 +1,159 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import os
+import sys
+import shutil
+import hashlib
+import logging
+import sysconfig
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import xobjects as xo
+
+try:
+    import fcntl
+except ImportError: # not available on windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_COMPILE_ARGS = ("-O3", "-Wno-unused-function")
+DEFAULT_LINK_ARGS = ("-O3",)
+
+def get_kernel_cache_dir():
+    cache_dir = os.environ.get('XTRACK_KERNEL_CACHE_DIR', None)
+    if cache_dir is None:
+        cache_dir = Path.home().joinpath('.cache', 'xtrack', 'kernels')
+    return Path(cache_dir).absolute()
+
+def clear_kernel_cache(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = get_kernel_cache_dir()
+    cache_dir = Path(cache_dir)
+    if cache_dir.exists():
+        shutil.rmtree(cache_dir)
+
+def _so_path(cache_dir, module_name):
+    return Path(cache_dir) / (module_name
+                              + sysconfig.get_config_var("EXT_SUFFIX"))
+
+def _kernel_hash(context, specialized_source, extra_compile_args,
+                 extra_link_args):
+    hh = hashlib.sha256()
+    for item in [specialized_source,
+                 repr(tuple(extra_compile_args)),
+                 repr(tuple(extra_link_args)),
+                 repr(context.omp_num_threads),
+                 xo.__version__,
+                 sys.version,
+                 sysconfig.get_config_var("EXT_SUFFIX"),
+                 os.environ.get('CC', ''),
+                 os.environ.get('CFLAGS', ''),
+                 str(sysconfig.get_config_var('CC'))]:
+        hh.update(item.encode())
+        hh.update(b'\0')
+    return 'xtrack_' + hh.hexdigest()[:32]
+
+@contextmanager
+def _file_lock(path):
+    with open(path, 'a') as fid:
+        if fcntl is not None:
+            fcntl.flock(fid.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fid.fileno(), fcntl.LOCK_UN)
+
+def add_kernels_with_cache(context, sources, kernels, extra_headers=(),
+                           extra_classes=(), apply_to_source=(),
+                           save_source_as=None, cache_dir=None,
+                           extra_compile_args=DEFAULT_COMPILE_ARGS,
+                           extra_link_args=DEFAULT_LINK_ARGS):
+
+    '''
+    Equivalent to `context.add_kernels(...)` for a ContextCpu, but the
+    compiled shared object is stored in (and loaded from) an on-disk cache
+    keyed on the specialized source and on the compiler settings.
+    '''
+
+    assert isinstance(context, xo.ContextCpu)
+
+    if cache_dir is None:
+        cache_dir = get_kernel_cache_dir()
+    cache_dir = Path(cache_dir)
+
+    # Generate the source only (cheap compared to the compilation)
+    src_kernels = context.build_kernels(
+        kernel_descriptions=kernels,
+        sources=sources,
+        specialize=True,
+        apply_to_source=apply_to_source,
+        save_source_as=save_source_as,
+        extra_classes=extra_classes,
+        extra_headers=extra_headers,
+        compile=False)
+    first = src_kernels[next(iter(src_kernels.keys()))]
+    source = first.source
+    specialized_source = first.specialized_source
+
+    module_name = _kernel_hash(context, specialized_source,
+                               extra_compile_args, extra_link_args)
+    so_path = _so_path(cache_dir, module_name)
+
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        log.warning(f'Kernel cache directory {cache_dir} is not writable, '
+                    'kernels will not be cached')
+        context.add_kernels(sources, kernels, extra_headers=extra_headers,
+                            extra_classes=extra_classes,
+                            apply_to_source=apply_to_source, specialize=True,
+                            extra_compile_args=extra_compile_args,
+                            extra_link_args=extra_link_args)
+        return
+
+    if not so_path.exists():
+        with _file_lock(cache_dir / (module_name + '.lock')):
+            # Another process might have compiled while we were waiting
+            if not so_path.exists():
+                log.info(f'Compiling kernel {module_name} into cache')
+                tmp_dir = cache_dir / f'tmp_{uuid.uuid4().hex}'
+                tmp_dir.mkdir()
+                try:
+                    context.build_kernels(
+                        kernel_descriptions=kernels,
+                        module_name=module_name,
+                        containing_dir=tmp_dir,
+                        sources=sources,
+                        specialize=True,
+                        apply_to_source=apply_to_source,
+                        extra_compile_args=extra_compile_args,
+                        extra_link_args=extra_link_args,
+                        extra_classes=extra_classes,
+                        extra_headers=extra_headers,
+                        compile=True)
+                    # Atomic on POSIX, readers never see a partial file
+                    os.replace(_so_path(tmp_dir, module_name), so_path)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        log.info(f'Loading kernel {module_name} from cache')
+
+    for pyname, kk in kernels.items():
+        if kk.c_name is None:
+            kk.c_name = pyname
+
+    out_kernels = context.kernels_from_file(module_name, kernels,
+                                            containing_dir=cache_dir)
+    for pyname in kernels.keys():
+        out_kernels[pyname].source = source
+        out_kernels[pyname].specialized_source = specialized_source
+        out_kernels[pyname].description.pyname = pyname
+
+    context.kernels.update(out_kernels)
@@ -0,0 +1,206 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+from functools import partial
+
+import numpy as np
+
+from .twiss import (_fork_pool_for_knob_evaluations,
+                    _close_pool_for_knob_evaluations,
+                    _call_function_for_workers)
+
+# Observables are either global quantities of the twiss table (e.g. 'qx') or
+# tuples (column, element_name) or (column, list_of_element_names) selecting
+# element-by-element quantities (e.g. ('x', ['bpm.1', 'bpm.2'])).
+
+def _observable_key(obs):
+    if isinstance(obs, str):
+        return obs
+    column, names = obs
+    if isinstance(names, str):
+        return (column, names)
+    return (column, tuple(names))
+
+def _observable_size(obs):
+    key = _observable_key(obs)
+    if isinstance(key, str) or isinstance(key[1], str):
+        return 1
+    return len(key[1])
+
+def _observables_from_twiss(tw, observables):
+    name_to_index = None
+    out = []
+    for obs in observables:
+        key = _observable_key(obs)
+        if isinstance(key, str):
+            out.append(np.atleast_1d(tw[key]))
+            continue
+        if name_to_index is None:
+            name_to_index = {nn: ii for ii, nn in enumerate(tw.name)}
+        column, names = key
+        if isinstance(names, str):
+            names = [names]
+        out.append(np.array(tw[column])[[name_to_index[nn] for nn in names]])
+    return np.concatenate(out).astype(np.float64)
+
+def _twiss_observables_for_knobs(knob_values, vary, observables, tracker,
+                                 tw_kwargs):
+    for kk, vv in zip(vary, knob_values):
+        tracker.vars[kk] = vv
+    tw = tracker.twiss(**tw_kwargs)
+    return _observables_from_twiss(tw, observables)
+
+
+class KnobResponse:
+
+    '''
+    Linear response of twiss observables to knob variations, computed around
+    the knob values `knob_values` where the observables are `values`.
+    `matrix[i, j]` is the derivative of the i-th observable row with respect
+    to the j-th knob.
+    '''
+
+    def __init__(self, vary, observables, knob_values, values, matrix,
+                 tw_kwargs):
+        self.vary = list(vary)
+        self.observables = list(observables)
+        self.knob_values = knob_values
+        self.values = values
+        self.matrix = matrix
+        self.tw_kwargs = tw_kwargs
+
+        self._rows = {}
+        i_row = 0
+        for obs in self.observables:
+            nn = _observable_size(obs)
+            self._rows[_observable_key(obs)] = slice(i_row, i_row + nn)
+            i_row += nn
+
+    def rows(self, observable):
+        return self._rows[_observable_key(observable)]
+
+    def get_observables(self, tw):
+        return _observables_from_twiss(tw, self.observables)
+
+    def solve(self, residuals, weights=None, rcond=None, rows=None):
+
+        '''
+        Knob changes minimizing, in the least squares sense, the weighted
+        `residuals` (observed minus target) predicted by the linear model.
+        `rcond` is the cut on the relative singular values.
+        '''
+
+        matrix = self.matrix
+        if rows is not None:
+            matrix = matrix[rows, :]
+        if weights is not None:
+            matrix = matrix * weights[:, None]
+            residuals = residuals * weights
+        return np.linalg.lstsq(matrix, -residuals, rcond=rcond)[0]
+
+
+def compute_knob_response(tracker, vary, observables, steps=None,
+                          n_workers=None, **kwargs):
+
+    _obs = partial(_twiss_observables_for_knobs, vary=vary,
+                   observables=observables, tracker=tracker, tw_kwargs=kwargs)
+
+    x0 = np.array([tracker.vars[vv]._value for vv in vary], dtype=np.float64)
+    if steps is None:
+        steps = np.sqrt(np.finfo(np.float64).eps) * np.maximum(np.abs(x0), 1.)
+    steps = np.broadcast_to(np.array(steps, dtype=np.float64), x0.shape)
+
+    # The perturbed knob settings are evaluated in parallel worker processes
+    x_cols = [x0 + np.eye(len(x0))[jj] * steps[jj] for jj in range(len(x0))]
+    try:
+        y0 = _obs(x0)
+        pool = _fork_pool_for_knob_evaluations(_obs, tracker,
+                                    n_tasks=len(vary), n_workers=n_workers)
+        try:
+            if pool is not None:
+                y_cols = pool.map(_call_function_for_workers, x_cols)
+            else:
+                y_cols = [_obs(xc) for xc in x_cols]
+        finally:
+            _close_pool_for_knob_evaluations(pool)
+    finally:
+        for kk, vv in zip(vary, x0):
+            tracker.vars[kk] = vv
+
+    matrix = np.array([(yc - y0) / hh for yc, hh in zip(y_cols, steps)]).T
+
+    return KnobResponse(vary=vary, observables=observables, knob_values=x0,
+                        values=y0, matrix=matrix, tw_kwargs=kwargs)
+
+
+def match_with_knob_response(tracker, targets, response, n_iterations=5,
+                             tol=None, weights=None, rcond=None):
+
+    '''
+    Iterative correction using the linear model in `response`. At each
+    iteration the knob changes are obtained by least squares on the response
+    matrix and a twiss is computed to measure the residuals. The knobs are
+    left at the values giving the smallest weighted residuals; `success` in
+    the returned dictionary tells whether all residuals are below `tol`.
+    '''
+
+    if weights is None:
+        weights = [1.] * len(targets)
+    assert len(weights) == len(targets)
+
+    # Observables not appearing in the targets are left free
+    rows = []
+    target_values = []
+    row_weights = []
+    for (obs, val), ww in zip(targets, weights):
+        sl = response.rows(obs)
+        nn = sl.stop - sl.start
+        rows.append(np.arange(sl.start, sl.stop))
+        target_values.append(np.broadcast_to(
+                                    np.array(val, dtype=np.float64), (nn,)))
+        row_weights.append(np.broadcast_to(
+                                    np.array(ww, dtype=np.float64), (nn,)))
+    rows = np.concatenate(rows)
+    target_values = np.concatenate(target_values)
+    row_weights = np.concatenate(row_weights)
+
+    vary = response.vary
+    x0 = np.array([tracker.vars[vv]._value for vv in vary], dtype=np.float64)
+    xx = x0.copy()
+    try:
+        tw = tracker.twiss(**response.tw_kwargs)
+        residuals = response.get_observables(tw)[rows] - target_values
+
+        # The knobs giving the smallest weighted residuals are kept, the
+        # linear model can make the residuals grow far from the linear regime
+        best = (np.linalg.norm(residuals * row_weights), xx, residuals, tw)
+        i_iter = 0
+        for i_iter in range(n_iterations):
+            if tol is not None and np.all(np.abs(residuals) < tol):
+                break
+            xx = xx + response.solve(residuals, weights=row_weights,
+                                     rcond=rcond, rows=rows)
+            for kk, vv in zip(vary, xx):
+                tracker.vars[kk] = vv
+            tw = tracker.twiss(**response.tw_kwargs)
+            residuals = response.get_observables(tw)[rows] - target_values
+            norm = np.linalg.norm(residuals * row_weights)
+            if norm < best[0]:
+                best = (norm, xx, residuals, tw)
+        else:
+            i_iter = n_iterations
+    except Exception as err:
+        for kk, vv in zip(vary, x0):
+            tracker.vars[kk] = vv
+        raise err
+
+    _, xx, residuals, tw = best
+    for kk, vv in zip(vary, xx):
+        tracker.vars[kk] = vv
+
+    success = tol is None or bool(np.all(np.abs(residuals) < tol))
+
+    return {'res': xx, 'residuals': residuals, 'n_iterations': i_iter,
+            'twiss': tw, 'success': success}
@@ -17,6 +17,7 @@ from .mad_loader import MadLoader
 from .beam_elements import element_classes
 from . import beam_elements
 from .beam_elements import Drift
+from .base_element import _increment_lattice_version
 
 log=logging.getLogger(__name__)
 
@@ -145,6 +146,15 @@ class Line:
         _var_values.default_factory = None
 
         _ref_manager = manager=xd.Manager()
+
+        # Writes through `vars` and `element_refs` invalidate the results
+        # cached by the trackers
+        _manager_set_value = manager.set_value
+        def _set_value(ref, value):
+            _manager_set_value(ref, value)
+            _increment_lattice_version()
+        manager.set_value = _set_value
+
         _vref=manager.ref(_var_values,'vars')
         _fref=manager.ref(mathfunctions,'f')
         _lref = manager.ref(self.element_dict, 'element_refs')
@@ -0,0 +1,109 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import numpy as np
+
+from . import beam_elements
+from .line import Line, _is_drift
+
+# Each pass takes and returns a list of (element, name, original_index)
+# tuples. Elements that are kept or produced by fusion carry the name and the
+# index of the first original element they represent, so that tracking results
+# on the optimized line can be reported in terms of the original line.
+# Markers (zero-length drifts) are kept by the default passes, such that they
+# can still be used as observation and start points.
+
+def _is_inactive_multipole(ee):
+    if ee.__class__ is not beam_elements.Multipole:
+        return False
+    aux = [ee.hxl, ee.hyl] + list(ee.knl) + list(ee.ksl)
+    return np.sum(np.abs(np.array(aux))) == 0.0
+
+def drop_inactive_multipoles(items):
+    return [it for it in items if not _is_inactive_multipole(it[0])]
+
+def _is_marker(ee):
+    # Markers are imported as zero-length drifts
+    return _is_drift(ee) and ee.length == 0
+
+def drop_markers(items):
+    return [it for it in items if not _is_marker(it[0])]
+
+def fold_shifts_and_rotations(items):
+    out = []
+    for ee, nn, ii in items:
+        if out and ee.__class__ is out[-1][0].__class__:
+            prev_ee, prev_nn, prev_ii = out[-1]
+            if isinstance(ee, beam_elements.XYShift):
+                out[-1] = (beam_elements.XYShift(
+                                dx=prev_ee.dx + ee.dx, dy=prev_ee.dy + ee.dy,
+                                _buffer=prev_ee._buffer),
+                           prev_nn, prev_ii)
+                continue
+            if isinstance(ee, beam_elements.SRotation):
+                # Compose sin and cos directly such that opposite rotations
+                # cancel exactly
+                newee = beam_elements.SRotation(_buffer=prev_ee._buffer)
+                newee.cos_z = prev_ee.cos_z * ee.cos_z - prev_ee.sin_z * ee.sin_z
+                newee.sin_z = prev_ee.sin_z * ee.cos_z + prev_ee.cos_z * ee.sin_z
+                out[-1] = (newee, prev_nn, prev_ii)
+                continue
+        out.append((ee, nn, ii))
+
+    # Drop pairs that cancel each other
+    return [it for it in out
+            if not (isinstance(it[0], beam_elements.XYShift)
+                        and it[0].dx == 0 and it[0].dy == 0)
+            and not (isinstance(it[0], beam_elements.SRotation)
+                        and it[0].sin_z == 0 and it[0].cos_z > 0)]
+
+def fuse_drifts(items):
+    out = []
+    for ee, nn, ii in items:
+        if out and ee.__class__ is beam_elements.Drift and (
+                out[-1][0].__class__ is beam_elements.Drift) and not (
+                _is_marker(ee) or _is_marker(out[-1][0])):
+            prev_ee, prev_nn, prev_ii = out[-1]
+            out[-1] = (beam_elements.Drift(length=prev_ee.length + ee.length,
+                                           _buffer=prev_ee._buffer),
+                       prev_nn, prev_ii)
+        else:
+            out.append((ee, nn, ii))
+    return out
+
+DEFAULT_PASSES = (drop_inactive_multipoles, fold_shifts_and_rotations,
+                  fuse_drifts)
+
+def run_line_passes(line, passes=None):
+
+    '''
+    Build an optimized copy of `line` for tracking. The elements are copied,
+    hence the original line is not modified and later changes to it are not
+    seen by the optimized line. Returns the optimized line and an array
+    giving, for each element of the optimized line (plus one entry for the end
+    of the line), the index of the corresponding element in the original line.
+    '''
+
+    if passes is None:
+        passes = DEFAULT_PASSES
+
+    if line._var_management is not None:
+        raise NotImplementedError('Line passes are not available when '
+                                  'deferred expressions are used')
+
+    items = [(ee.copy(), nn, ii) for ii, (ee, nn) in enumerate(
+                                zip(line.elements, line.element_names))]
+    for pp in passes:
+        items = pp(items)
+
+    newline = Line(elements=[it[0] for it in items],
+                   element_names=[it[1] for it in items],
+                   particle_ref=line.particle_ref)
+    newline._needs_rng = line._needs_rng
+
+    original_element_index = np.array(
+        [it[2] for it in items] + [len(line.element_names)], dtype=np.int64)
+
+    return newline, original_element_index
@@ -3,6 +3,10 @@
 # Copyright (c) CERN, 2021.                 #
 # ######################################### #
 
+from pathlib import Path
+
+import numpy as np
+
 import xobjects as xo
 
 from .base_element import BeamElement
@@ -133,3 +137,295 @@ def generate_monitor_class(ParticlesClass):
         setattr(ParticlesMonitorClass, nn, _FieldOfMonitor(name=nn))
 
     return ParticlesMonitorClass
+
+
+class StreamingParticlesMonitor:
+
+    '''
+    Turn-by-turn monitor with bounded memory on the tracking context. Records
+    are collected in a ParticlesMonitor covering `ring_turns` turns, which is
+    flushed to memory-mapped `.npy` files in `path` during tracking. The
+    recorded variables are available as memory-mapped arrays with shape
+    (n_particles, n_turns) (e.g. `monitor.x`).
+    '''
+
+    def __init__(self, path, start_at_turn, stop_at_turn, ring_turns,
+                 num_particles=None, particle_id_range=None, _context=None,
+                 particles_monitor_class=None):
+
+        if particles_monitor_class is None:
+            import xtrack as xt # avoid circular import
+            particles_monitor_class = xt.ParticlesMonitor
+
+        assert ring_turns > 0
+        self.start_at_turn = int(start_at_turn)
+        self.stop_at_turn = int(stop_at_turn)
+        self.ring_turns = min(int(ring_turns),
+                              self.stop_at_turn - self.start_at_turn)
+
+        self.device_monitor = particles_monitor_class(
+                _context=_context,
+                start_at_turn=self.start_at_turn,
+                stop_at_turn=self.start_at_turn + self.ring_turns,
+                num_particles=num_particles,
+                particle_id_range=particle_id_range)
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        mon = self.device_monitor
+        ctx2np = mon._buffer.context.nparray_from_context_array
+        shape = (mon.part_id_end - mon.part_id_start,
+                 self.stop_at_turn - self.start_at_turn)
+        self._data = {}
+        for tt, nn in mon._ParticlesClass._structure["per_particle_vars"]:
+            dtype = ctx2np(getattr(mon.data, nn)).dtype
+            self._data[nn] = np.lib.format.open_memmap(
+                self.path / f'{nn}.npy', mode='w+', dtype=dtype, shape=shape)
+
+    def __getattr__(self, name):
+        data = self.__dict__.get('_data', {})
+        if name in data:
+            return data[name]
+        raise AttributeError(name)
+
+    def flush(self, at_turn=None):
+
+        '''
+        Write the records collected on the context to disk. If `at_turn` is
+        past the end of the window covered by the context monitor, the window
+        is moved to the following turns.
+        '''
+
+        mon = self.device_monitor
+        i_start = int(mon.start_at_turn) - self.start_at_turn
+        n_turns = min(self.ring_turns, self.stop_at_turn - int(mon.start_at_turn))
+        if n_turns <= 0:
+            return
+
+        for nn, mm in self._data.items():
+            mm[:, i_start:i_start + n_turns] = getattr(mon, nn)[:, :n_turns]
+            mm.flush()
+
+        if at_turn is not None and at_turn >= mon.stop_at_turn:
+            mon.start_at_turn += self.ring_turns
+            mon.stop_at_turn += self.ring_turns
+            with mon.data._bypass_linked_vars():
+                for nn in self._data.keys():
+                    getattr(mon.data, nn)[:] = 0
+
+
+class MomentsMonitor(BeamElement):
+
+    '''
+    Accumulates, for each turn in [start_at_turn, stop_at_turn), the first
+    and second moments of (x, px, y, py, zeta, delta) over the active
+    particles (weighted by `particles.weight`), without storing the particles.
+    It can be placed in a line or passed as `turn_by_turn_monitor` to
+    `Tracker.track` (records at the start of each turn).
+    The sums are accumulated on the coordinates minus `reference`, such that
+    the covariances do not suffer from cancellation for beams far from the
+    origin. If not given, the reference is set by the tracker to the
+    centroid of the particles at the start of the first tracking. For
+    monitors placed where the beam is far from its position at the start of
+    the line, the reference should be provided (e.g. the closed orbit).
+    '''
+
+    _xofields = {
+        'start_at_turn': xo.Int64,
+        'stop_at_turn': xo.Int64,
+        'has_reference': xo.Int64,
+        'reference': xo.Float64[6],
+        'sums': xo.Float64[:],
+    }
+
+    _extra_c_sources = [
+        _pkg_root.joinpath("monitors_src/moments_monitor.h")
+    ]
+
+    coordinates = ('x', 'px', 'y', 'py', 'zeta', 'delta')
+
+    def __init__(self, start_at_turn=0, stop_at_turn=None, reference=None,
+                 _xobject=None, **kwargs):
+
+        if _xobject is not None:
+            super().__init__(_xobject=_xobject)
+        else:
+            n_turns = int(stop_at_turn) - int(start_at_turn)
+            assert n_turns >= 0
+            super().__init__(start_at_turn=start_at_turn,
+                             stop_at_turn=stop_at_turn,
+                             has_reference=int(reference is not None),
+                             reference=(np.zeros(6) if reference is None
+                                        else np.array(reference, dtype=float)),
+                             sums=28 * n_turns, **kwargs)
+            self.sums[:] = 0
+
+    def _set_reference_from_particles(self, particles):
+        ctx2np = particles._buffer.context.nparray_from_context_array
+        mask = ctx2np(particles.state) > 0
+        if not np.any(mask):
+            return
+        self.reference[:] = self._arr2ctx(np.array(
+            [ctx2np(getattr(particles, nn))[mask].mean()
+             for nn in self.coordinates]))
+        self.has_reference = 1
+
+    def _get_sums(self):
+        ctx2np = self._buffer.context.nparray_from_context_array
+        return ctx2np(self.sums).reshape(-1, 28)
+
+    @property
+    def num_particles(self):
+        '''Sum of the weights of the recorded particles for each turn'''
+        return self._get_sums()[:, 0].copy()
+
+    def _shifted_centroid(self):
+        sums = self._get_sums()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums[:, 1:7] / sums[:, 0:1]
+
+    @property
+    def centroid(self):
+        '''Mean of (x, px, y, py, zeta, delta), shape (n_turns, 6)'''
+        ctx2np = self._buffer.context.nparray_from_context_array
+        return self._shifted_centroid() + ctx2np(self.reference)[None, :]
+
+    @property
+    def sigma_matrix(self):
+        '''Covariance matrix of the coordinates, shape (n_turns, 6, 6)'''
+        sums = self._get_sums()
+        i_upper, j_upper = np.triu_indices(6)
+        second = np.zeros((sums.shape[0], 6, 6))
+        second[:, i_upper, j_upper] = sums[:, 7:]
+        second[:, j_upper, i_upper] = sums[:, 7:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            second /= sums[:, 0][:, None, None]
+        # The covariance does not depend on the reference
+        mean = self._shifted_centroid()
+        return second - mean[:, :, None] * mean[:, None, :]
+
+    def _emittance(self, ii):
+        sigma = self.sigma_matrix[:, ii:ii+2, ii:ii+2]
+        return np.sqrt(np.linalg.det(sigma))
+
+    @property
+    def gemitt_x(self):
+        return self._emittance(0)
+
+    @property
+    def gemitt_y(self):
+        return self._emittance(2)
+
+    @property
+    def gemitt_zeta(self):
+        return self._emittance(4)
+
+    def reset(self):
+        self.sums[:] = 0
+
+
+_compact_monitor_fields = {
+    'x': xo.Float64,
+    'px': xo.Float64,
+    'y': xo.Float64,
+    'py': xo.Float64,
+    'zeta': xo.Float64,
+    'delta': xo.Float64,
+    'ptau': xo.Float64,
+    's': xo.Float64,
+    'state': xo.Int64,
+    'at_element': xo.Int64,
+}
+
+class _FieldOfCompactMonitor:
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, container, ContainerType=None):
+        if self.name not in container.fields:
+            raise AttributeError(f'`{self.name}` is not recorded by this '
+                                 'monitor')
+        ctx2np = container._buffer.context.nparray_from_context_array
+        vv = ctx2np(getattr(container, 'rec_' + self.name))
+        return vv.reshape(container.part_id_end - container.part_id_start,
+                          len(container.turns))
+
+
+class CompactParticlesMonitor(BeamElement):
+
+    '''
+    Turn-by-turn monitor recording only a subset of the particle coordinates
+    (`fields`) on a selection of turns. The turns are given explicitly
+    (`turns`), or from `start_at_turn` to `stop_at_turn` either every `every`
+    turns or on `num_log_turns` logarithmically spaced turns. It can be
+    placed in a line or passed as `turn_by_turn_monitor` to `Tracker.track`
+    (records at the start of each turn). With `ebe_mode=True` the entries of
+    `turns` are element indices and, when used as `turn_by_turn_monitor`,
+    the monitor records at each element. Recorded coordinates have shape
+    (n_particles, n_turns), e.g. `monitor.x`.
+    '''
+
+    _xofields = {
+        'part_id_start': xo.Int64,
+        'part_id_end': xo.Int64,
+        'ebe_mode': xo.Int64,
+        'turns': xo.Int64[:],
+        **{'rec_' + nn: tt[:] for nn, tt in _compact_monitor_fields.items()},
+    }
+
+    _extra_c_sources = [
+        _pkg_root.joinpath("monitors_src/compact_monitor.h")
+    ]
+
+    def __init__(self, fields=('x', 'px', 'y', 'py'), turns=None,
+                 start_at_turn=0, stop_at_turn=None, every=1,
+                 num_log_turns=None, num_particles=None,
+                 particle_id_range=None, ebe_mode=False, _xobject=None,
+                 **kwargs):
+
+        if _xobject is not None:
+            super().__init__(_xobject=_xobject)
+            return
+
+        for nn in fields:
+            if nn not in _compact_monitor_fields:
+                raise ValueError(f'Field `{nn}` cannot be recorded, available'
+                                 f' fields are {list(_compact_monitor_fields)}')
+
+        if turns is None:
+            assert stop_at_turn is not None
+            if num_log_turns is not None:
+                turns = start_at_turn - 1 + np.round(np.geomspace(
+                    1, stop_at_turn - start_at_turn, num_log_turns))
+            else:
+                turns = np.arange(start_at_turn, stop_at_turn, every)
+        turns = np.unique(np.array(turns, dtype=np.int64))
+
+        if particle_id_range is not None:
+            assert num_particles is None
+            part_id_start, part_id_end = particle_id_range
+        else:
+            assert num_particles is not None
+            part_id_start = 0
+            part_id_end = num_particles
+
+        n_records = len(turns) * (part_id_end - part_id_start)
+        arrays_init = {'rec_' + nn: (n_records if nn in fields else 0)
+                       for nn in _compact_monitor_fields}
+
+        super().__init__(part_id_start=part_id_start,
+                         part_id_end=part_id_end,
+                         ebe_mode=int(ebe_mode),
+                         turns=len(turns), **arrays_init, **kwargs)
+        self.turns[:] = self._arr2ctx(turns)
+        for nn in fields:
+            getattr(self, 'rec_' + nn)[:] = 0
+
+    @property
+    def fields(self):
+        return tuple(nn for nn in _compact_monitor_fields
+                     if len(getattr(self, 'rec_' + nn)) > 0)
+
+for nn in _compact_monitor_fields:
+    setattr(CompactParticlesMonitor, nn, _FieldOfCompactMonitor(name=nn))
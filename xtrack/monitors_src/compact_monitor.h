@@ -0,0 +1,105 @@
+// copyright ############################### //
+// This file is part of the Xtrack Package.  //
+// Copyright (c) CERN, 2021.                 //
+// ######################################### //
+
+#ifndef XTRACK_COMPACT_MONITOR_H
+#define XTRACK_COMPACT_MONITOR_H
+
+/*gpufun*/
+void CompactParticlesMonitor_track_local_particle(
+                       CompactParticlesMonitorData el, LocalParticle* part0){
+
+    int64_t const part_id_start =
+                        CompactParticlesMonitorData_get_part_id_start(el);
+    int64_t const part_id_end = CompactParticlesMonitorData_get_part_id_end(el);
+    int64_t const ebe_mode = CompactParticlesMonitorData_get_ebe_mode(el);
+    int64_t const n_turns = CompactParticlesMonitorData_len_turns(el);
+    /*gpuglmem*/ int64_t* turns = CompactParticlesMonitorData_getp1_turns(el, 0);
+
+    // Only the selected fields have non-empty arrays
+    int64_t const record_x = CompactParticlesMonitorData_len_rec_x(el) > 0;
+    int64_t const record_px = CompactParticlesMonitorData_len_rec_px(el) > 0;
+    int64_t const record_y = CompactParticlesMonitorData_len_rec_y(el) > 0;
+    int64_t const record_py = CompactParticlesMonitorData_len_rec_py(el) > 0;
+    int64_t const record_zeta = CompactParticlesMonitorData_len_rec_zeta(el) > 0;
+    int64_t const record_delta = CompactParticlesMonitorData_len_rec_delta(el) > 0;
+    int64_t const record_ptau = CompactParticlesMonitorData_len_rec_ptau(el) > 0;
+    int64_t const record_s = CompactParticlesMonitorData_len_rec_s(el) > 0;
+    int64_t const record_state = CompactParticlesMonitorData_len_rec_state(el) > 0;
+    int64_t const record_at_element = CompactParticlesMonitorData_len_rec_at_element(el) > 0;
+
+    //start_per_particle_block (part0->part)
+    int64_t const particle_id = LocalParticle_get_particle_id(part);
+    if (n_turns > 0 && particle_id<part_id_end && particle_id>=part_id_start){
+        int64_t at_turn;
+        if (ebe_mode){
+            at_turn = LocalParticle_get_at_element(part);
+        }
+        else{
+            at_turn = LocalParticle_get_at_turn(part);
+        }
+
+        // Binary search in the (sorted) recorded turns
+        int64_t i_lo = 0;
+        int64_t i_hi = n_turns - 1;
+        while (i_lo < i_hi){
+            int64_t const i_mid = (i_lo + i_hi) / 2;
+            if (turns[i_mid] < at_turn){
+                i_lo = i_mid + 1;
+            }
+            else{
+                i_hi = i_mid;
+            }
+        }
+
+        if (turns[i_lo] == at_turn){
+            int64_t const store_at =
+                    n_turns * (particle_id - part_id_start) + i_lo;
+                if (record_x){
+                    CompactParticlesMonitorData_set_rec_x(el, store_at,
+                                            LocalParticle_get_x(part));
+                }
+                if (record_px){
+                    CompactParticlesMonitorData_set_rec_px(el, store_at,
+                                            LocalParticle_get_px(part));
+                }
+                if (record_y){
+                    CompactParticlesMonitorData_set_rec_y(el, store_at,
+                                            LocalParticle_get_y(part));
+                }
+                if (record_py){
+                    CompactParticlesMonitorData_set_rec_py(el, store_at,
+                                            LocalParticle_get_py(part));
+                }
+                if (record_zeta){
+                    CompactParticlesMonitorData_set_rec_zeta(el, store_at,
+                                            LocalParticle_get_zeta(part));
+                }
+                if (record_delta){
+                    CompactParticlesMonitorData_set_rec_delta(el, store_at,
+                                            LocalParticle_get_delta(part));
+                }
+                if (record_ptau){
+                    CompactParticlesMonitorData_set_rec_ptau(el, store_at,
+                                            LocalParticle_get_ptau(part));
+                }
+                if (record_s){
+                    CompactParticlesMonitorData_set_rec_s(el, store_at,
+                                            LocalParticle_get_s(part));
+                }
+                if (record_state){
+                    CompactParticlesMonitorData_set_rec_state(el, store_at,
+                                            LocalParticle_get_state(part));
+                }
+                if (record_at_element){
+                    CompactParticlesMonitorData_set_rec_at_element(el, store_at,
+                                            LocalParticle_get_at_element(part));
+                }
+        }
+    }
+    //end_per_particle_block
+
+}
+
+#endif
@@ -0,0 +1,71 @@
+// copyright ############################### //
+// This file is part of the Xtrack Package.  //
+// Copyright (c) CERN, 2021.                 //
+// ######################################### //
+
+#ifndef XTRACK_MOMENTS_MONITOR_H
+#define XTRACK_MOMENTS_MONITOR_H
+
+#pragma OPENCL EXTENSION cl_khr_int64_base_atomics : enable //only_for_context opencl
+
+/*gpufun*/
+void MomentsMonitor_atomic_add(/*gpuglmem*/ double* addr, double val){
+    #pragma omp atomic                                       //only_for_context cpu_openmp
+    *addr += val;                                            //only_for_context cpu_serial cpu_openmp
+    atomicAdd(addr, val);                                    //only_for_context cuda
+    union {double d; long l;} old_val, new_val;              //only_for_context opencl
+    do {                                                     //only_for_context opencl
+        old_val.d = *addr;                                   //only_for_context opencl
+        new_val.d = old_val.d + val;                         //only_for_context opencl
+    } while (atom_cmpxchg((volatile /*gpuglmem*/ long*) addr,//only_for_context opencl
+                          old_val.l, new_val.l) != old_val.l);//only_for_context opencl
+}
+
+/*gpufun*/
+void MomentsMonitor_track_local_particle(MomentsMonitorData el,
+                       LocalParticle* part0){
+
+    int64_t const start_at_turn = MomentsMonitorData_get_start_at_turn(el);
+    int64_t const stop_at_turn = MomentsMonitorData_get_stop_at_turn(el);
+    /*gpuglmem*/ double* sums = MomentsMonitorData_getp1_sums(el, 0);
+    double reference[6];
+    for (int64_t ii=0; ii<6; ii++){
+        reference[ii] = MomentsMonitorData_get_reference(el, ii);
+    }
+
+    //start_per_particle_block (part0->part)
+    int64_t const at_turn = LocalParticle_get_at_turn(part);
+    if (at_turn>=start_at_turn && at_turn<stop_at_turn){
+
+        double const weight = LocalParticle_get_weight(part);
+        double coords[6];
+        coords[0] = LocalParticle_get_x(part);
+        coords[1] = LocalParticle_get_px(part);
+        coords[2] = LocalParticle_get_y(part);
+        coords[3] = LocalParticle_get_py(part);
+        coords[4] = LocalParticle_get_zeta(part);
+        coords[5] = LocalParticle_get_delta(part);
+        // Shifted sums, avoiding cancellation in the covariances
+        for (int64_t ii=0; ii<6; ii++){
+            coords[ii] -= reference[ii];
+        }
+
+        // Per turn: sum of weights, 6 first-order sums,
+        // 21 second-order sums (upper triangle, row by row)
+        /*gpuglmem*/ double* ss = sums + 28 * (at_turn - start_at_turn);
+        MomentsMonitor_atomic_add(&ss[0], weight);
+        int64_t kk = 7;
+        for (int64_t ii=0; ii<6; ii++){
+            MomentsMonitor_atomic_add(&ss[1 + ii], weight * coords[ii]);
+            for (int64_t jj=ii; jj<6; jj++){
+                MomentsMonitor_atomic_add(&ss[kk],
+                                          weight * coords[ii] * coords[jj]);
+                kk++;
+            }
+        }
+    }
+    //end_per_particle_block
+
+}
+
+#endif
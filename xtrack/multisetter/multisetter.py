@@ -2,6 +2,7 @@ import numpy as np
 
 import xobjects as xo
 import xtrack as xt
+from ..base_element import _increment_lattice_version
 
 source = """
 
@@ -93,6 +94,7 @@ class MultiSetter(xo.HybridClass):
         kernel.description.n_threads = len(self.offsets)
         kernel(data=self, buffer=self._tracker_buffer.buffer,
                input=xt.BeamElement._arr2ctx(self,values))
+        _increment_lattice_version()
 
 
 def _extract_offset(obj, field_name, index):
@@ -0,0 +1,139 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import os
+import multiprocessing
+
+import numpy as np
+
+import xobjects as xo
+
+from .checkpoint import _get_particles_state, _set_particles_state
+
+# Set before forking the worker processes, which inherit the tracker together
+# with its line buffer (shared copy-on-write) and its compiled kernel
+_tracker_for_workers = None
+
+def _slice_particles_state(particles, state, i_start, i_end):
+    out = state.copy()
+    out['_capacity'] = i_end - i_start
+    for tt, nn in particles._structure['per_particle_vars']:
+        out[nn] = state[nn][i_start:i_end].copy()
+    return out
+
+def _track_shard(args):
+
+    particles_state, num_turns, monitor_id_range = args
+    tracker = _tracker_for_workers
+    context = tracker._buffer.context
+
+    particles = tracker.particles_class(_context=context,
+                                        _capacity=particles_state['_capacity'])
+    _set_particles_state(particles, particles_state)
+    particles.reorganize()
+
+    if monitor_id_range is not None:
+        monitor = tracker.particles_monitor_class(_context=context,
+            start_at_turn=0, stop_at_turn=num_turns,
+            particle_id_range=monitor_id_range)
+    else:
+        monitor = None
+
+    tracker.track(particles, num_turns=num_turns,
+                  turn_by_turn_monitor=monitor)
+
+    out = {'particles': _get_particles_state(particles)}
+    if monitor is not None:
+        out['monitor'] = _get_particles_state(monitor.data)
+    return out
+
+def track_parallel(tracker, particles, num_turns=1, n_workers=None,
+                   turn_by_turn_monitor=None):
+
+    global _tracker_for_workers
+
+    if tracker.iscollective:
+        raise NotImplementedError(
+            'Parallel tracking is not available for collective trackers')
+    if not isinstance(tracker._buffer.context, xo.ContextCpu):
+        raise NotImplementedError(
+            'Parallel tracking is available only on ContextCpu')
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise NotImplementedError(
+            'Parallel tracking needs the `fork` start method')
+    for ee in tracker.line.elements:
+        if (isinstance(ee, tracker.particles_monitor_class)
+                or getattr(ee, 'io_buffer', None) is not None):
+            raise NotImplementedError(
+                'Parallel tracking is not available for lines containing '
+                'monitors or elements with active internal logging')
+    if turn_by_turn_monitor not in (None, False, True):
+        raise ValueError(
+            'Only `turn_by_turn_monitor=True` is supported in parallel mode')
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    n_active, _ = particles.reorganize()
+    if n_active == 0:
+        # Nothing to distribute (all particles are lost)
+        tracker.track(particles, num_turns=num_turns,
+                      turn_by_turn_monitor=turn_by_turn_monitor)
+        return
+
+    state = _get_particles_state(particles)
+
+    if turn_by_turn_monitor is True:
+        monitor = tracker.particles_monitor_class(
+            _context=particles._buffer.context,
+            start_at_turn=0, stop_at_turn=num_turns,
+            particle_id_range=particles.get_active_particle_id_range())
+    else:
+        monitor = None
+
+    # Split the active particles in contiguous shards
+    shard_edges = [(ii[0], ii[-1] + 1) for ii in
+                   np.array_split(np.arange(n_active), n_workers) if len(ii) > 0]
+    shard_args = []
+    for i_start, i_end in shard_edges:
+        shard_state = _slice_particles_state(particles, state, i_start, i_end)
+        if monitor is not None:
+            ids = shard_state['particle_id']
+            monitor_id_range = (int(np.min(ids)), int(np.max(ids)) + 1)
+        else:
+            monitor_id_range = None
+        shard_args.append((shard_state, num_turns, monitor_id_range))
+
+    # With compile='async' the kernel must be ready before forking, as the
+    # compilation thread is not inherited by the workers
+    tracker.track_kernel
+
+    _tracker_for_workers = tracker
+    try:
+        with multiprocessing.get_context('fork').Pool(
+                                min(n_workers, len(shard_args))) as pool:
+            results = pool.map(_track_shard, shard_args)
+    finally:
+        _tracker_for_workers = None
+
+    # Merge the results into the caller's objects
+    with particles._bypass_linked_vars():
+        for (i_start, i_end), res in zip(shard_edges, results):
+            for tt, nn in particles._structure['per_particle_vars']:
+                getattr(particles, nn)[i_start:i_end] = res['particles'][nn]
+    particles.reorganize()
+
+    if monitor is not None:
+        n_cols = num_turns
+        with monitor.data._bypass_linked_vars():
+            for (shard_state, _, id_range), res in zip(shard_args, results):
+                rows_shard = shard_state['particle_id'] - id_range[0]
+                rows_monitor = shard_state['particle_id'] - monitor.part_id_start
+                for tt, nn in monitor.data._structure['per_particle_vars']:
+                    vv = getattr(monitor.data, nn).reshape(-1, n_cols)
+                    vv[rows_monitor, :] = res['monitor'][nn].reshape(
+                                                        -1, n_cols)[rows_shard, :]
+
+    tracker.record_last_track = monitor
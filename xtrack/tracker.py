@@ -3,14 +3,19 @@
 # Copyright (c) CERN, 2021.                 #
 # ######################################### #
 
+import os
+import hashlib
 import numpy as np
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
-from .general import _pkg_root
+from .general import _pkg_root, Table
 from .line_frozen import LineFrozen
 from .base_element import _handle_per_particle_blocks
-from .twiss import (twiss_from_tracker,
+from .twiss import (twiss_from_tracker, twiss_delta_scan_from_tracker,
+                                 one_turn_matrix_from_element_matrices,
                                  compute_one_turn_matrix_finite_differences,
                                  find_closed_orbit, match_tracker
                                 )
@@ -19,6 +24,14 @@ from .internal_record import (new_io_buffer,
                              start_internal_logging_for_elements_of_type,
                              stop_internal_logging_for_elements_of_type)
 from .pipeline import PipelineStatus
+from .kernel_cache import add_kernels_with_cache
+from .checkpoint import (save_checkpoint, load_checkpoint, restore_particles,
+                         restore_monitor)
+from .parallel_tracking import track_parallel
+from .monitors import (StreamingParticlesMonitor, MomentsMonitor,
+                       CompactParticlesMonitor)
+from .line_passes import run_line_passes
+from .knob_response import compute_knob_response, match_with_knob_response
 
 import xobjects as xo
 import xpart as xp
@@ -34,6 +47,80 @@ def _check_is_collective(ele):
     iscoll = not hasattr(ele, 'iscollective') or ele.iscollective
     return iscoll
 
+# Track kernels compiled on each context, to be reused by trackers needing a
+# subset of the element classes. The registry is stored on the context itself,
+# as the kernels hold a reference to their context (a module-level mapping
+# would keep all contexts and kernels alive). For each context:
+# {kernel settings: [(element_classes, track_kernel), ...]}
+def _get_kernel_registry(context):
+    registry = getattr(context, '_xtrack_kernel_registry', None)
+    if registry is None:
+        registry = {}
+        context._xtrack_kernel_registry = registry
+    return registry
+
+def _kernel_registry_key(particles_class, particles_monitor_class,
+                         global_xy_limit, extra_headers, local_particle_src,
+                         precision, has_at_element_steps):
+    return (particles_class, particles_monitor_class, global_xy_limit,
+            tuple(extra_headers), local_particle_src, precision,
+            has_at_element_steps)
+
+def _find_kernel_in_registry(context, key, element_classes):
+    entries = _get_kernel_registry(context).get(key, [])
+    for registered_classes, kernel in entries:
+        if set(element_classes).issubset(registered_classes):
+            return kernel, registered_classes
+    return None, None
+
+def _register_kernel(context, key, element_classes, kernel):
+    entries = _get_kernel_registry(context).setdefault(key, [])
+    # Drop kernels made redundant by the new one
+    entries[:] = [ee for ee in entries
+                  if not set(ee[0]).issubset(element_classes)]
+    entries.append((element_classes, kernel))
+
+def _merge_with_registered_classes(context, key, element_classes,
+                                   monitor_class):
+    # The new kernel includes all classes already compiled with the same
+    # settings, such that it can replace the existing ones
+    all_classes = set(element_classes)
+    for registered_classes, _ in _get_kernel_registry(context).get(key, []):
+        all_classes.update(registered_classes)
+    all_classes.discard(monitor_class)
+    return sorted(all_classes, key=lambda cc: cc.__name__) + [monitor_class]
+
+# Compilations are serialized, as cffi patches the distutils machinery while
+# compiling. Background compilations (compile='async') run in a single thread.
+_compile_lock = threading.RLock()
+_async_compile_executor = None
+
+def _get_async_compile_executor():
+    global _async_compile_executor
+    if _async_compile_executor is None:
+        _async_compile_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='xtrack_compile')
+    return _async_compile_executor
+
+# The compilation thread is not inherited by forked processes (e.g. process
+# pools with the fork start method), where pending futures would never
+# complete and the compile lock could be left held. Forks therefore wait for
+# the background compilations, and children start with a fresh state.
+def _wait_for_async_compilations():
+    if (_async_compile_executor is not None
+            and not threading.current_thread().name.startswith(
+                                                        'xtrack_compile')):
+        _async_compile_executor.submit(lambda: None).result()
+
+def _reset_async_compile_state():
+    global _async_compile_executor, _compile_lock
+    _async_compile_executor = None
+    _compile_lock = threading.RLock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_wait_for_async_compilations,
+                        after_in_child=_reset_async_compile_state)
+
 class Tracker:
 
     def __init__(
@@ -56,6 +143,11 @@ class Tracker:
         io_buffer=None,
         compile=True,
         enable_pipeline_hold=False,
+        use_kernel_cache=True,
+        unroll_line=False,
+        profile=False,
+        optimize_line=False,
+        precision='double',
     ):
 
         if sequence is not None:
@@ -87,7 +179,12 @@ class Tracker:
                 save_source_as=save_source_as,
                 io_buffer=io_buffer,
                 compile=compile,
-                enable_pipeline_hold=enable_pipeline_hold)
+                enable_pipeline_hold=enable_pipeline_hold,
+                use_kernel_cache=use_kernel_cache,
+                unroll_line=unroll_line,
+                profile=profile,
+                optimize_line=optimize_line,
+                precision=precision)
         else:
             self._init_track_no_collective(
                 _context=_context,
@@ -106,10 +203,22 @@ class Tracker:
                 save_source_as=save_source_as,
                 io_buffer=io_buffer,
                 compile=compile,
-                enable_pipeline_hold=enable_pipeline_hold)
+                enable_pipeline_hold=enable_pipeline_hold,
+                use_kernel_cache=use_kernel_cache,
+                unroll_line=unroll_line,
+                profile=profile,
+                optimize_line=optimize_line,
+                precision=precision)
 
         self.matrix_responsiveness_tol = lnf.DEFAULT_MATRIX_RESPONSIVENESS_TOL
         self.matrix_stability_tol = lnf.DEFAULT_MATRIX_STABILITY_TOL
+        self.use_twiss_cache = True
+        self._twiss_cache = None
+        self._element_byte_ranges = None
+        self._reference_tunes = None
+        self._knob_response = None
+        self._element_matrix_cache = {}
+        self._transfer_matrix_tree_state = None
 
     def _init_track_with_collective(
         self,
@@ -129,7 +238,12 @@ class Tracker:
         save_source_as=None,
         io_buffer=None,
         compile=True,
-        enable_pipeline_hold=False
+        enable_pipeline_hold=False,
+        use_kernel_cache=True,
+        unroll_line=False,
+        profile=False,
+        optimize_line=False,
+        precision='double'
     ):
 
         assert _offset is None
@@ -138,6 +252,33 @@ class Tracker:
             raise NotImplementedError("Skip compilation is not implemented in "
                                       "collective mode")
 
+        if compile == 'async':
+            raise NotImplementedError("Asynchronous compilation is not "
+                                      "implemented in collective mode")
+
+        if unroll_line:
+            raise NotImplementedError("Unrolled line is not implemented in "
+                                      "collective mode")
+        self.unroll_line = False
+
+        if profile:
+            raise NotImplementedError("Profiling is not implemented in "
+                                      "collective mode")
+        self.profile = False
+
+        if optimize_line:
+            raise NotImplementedError("Line optimization is not implemented "
+                                      "in collective mode")
+
+        if precision != 'double':
+            raise NotImplementedError("Reduced precision is not implemented "
+                                      "in collective mode")
+        self.precision = 'double'
+        self.original_line = line
+        self.original_element_index = np.arange(
+                            len(line.element_names) + 1, dtype=np.int64)
+        self._at_element_steps = None
+
         self.skip_end_turn_actions = skip_end_turn_actions
         self.particles_class = particles_class
         self.global_xy_limit = global_xy_limit
@@ -221,7 +362,8 @@ class Tracker:
                 reset_s_at_end_turn=reset_s_at_end_turn,
                 local_particle_src=local_particle_src,
                 save_source_as=save_source_as,
-                io_buffer=self.io_buffer
+                io_buffer=self.io_buffer,
+                use_kernel_cache=use_kernel_cache
                 )
 
         # Build trackers for non collective parts
@@ -277,11 +419,19 @@ class Tracker:
         save_source_as=None,
         io_buffer=None,
         compile=True,
-        enable_pipeline_hold=False
+        enable_pipeline_hold=False,
+        use_kernel_cache=True,
+        unroll_line=False,
+        profile=False,
+        optimize_line=False,
+        precision='double'
     ):
 
         assert not(enable_pipeline_hold), (
             "enable_pipeline_hold is not implemented in non collective mode")
+
+        assert compile in (True, False, 'async')
+        assert precision in ('double', 'float32', 'mixed')
         self._enable_pipeline_hold = False
 
         if particles_class is None:
@@ -298,12 +448,37 @@ class Tracker:
         self.global_xy_limit = global_xy_limit
         self.extra_headers = extra_headers
 
+        self.original_line = line
+        self.original_element_index = np.arange(
+                            len(line.element_names) + 1, dtype=np.int64)
+        if optimize_line:
+            # Track a simplified copy of the line, keeping the mapping to the
+            # elements of the original one. The original line is not attached
+            # to the tracker.
+            passes = None if optimize_line is True else optimize_line
+            line, self.original_element_index = run_line_passes(
+                                                        line, passes=passes)
+
+        # Increment of at_element after each element, such that at_element
+        # (in particles, monitors and loss locations) refers to the original
+        # line also when the tracked line is optimized
+        at_element_steps = np.diff(self.original_element_index)
+        if np.all(at_element_steps == 1):
+            at_element_steps = None
+
         frozenline = LineFrozen(
                     _context=_context, _buffer=_buffer, _offset=_offset,
                     line=line)
 
         context = frozenline._buffer.context
 
+        if precision != 'double' and isinstance(context, xo.ContextCpu):
+            # Only the local variables of the element kernels use the reduced
+            # precision, the data stays in double. On CPU the conversions make
+            # tracking slower, hence the mode is available only on GPUs.
+            raise NotImplementedError(
+                "Reduced precision is not available on ContextCpu")
+
         if io_buffer is None:
             io_buffer = new_io_buffer(_context=context)
         self.io_buffer = io_buffer
@@ -312,12 +487,45 @@ class Tracker:
             # Kernel relies on element_classes ordering
             assert element_classes is None
 
+        if unroll_line:
+            # Kernel is specific to this line and cannot be provided
+            assert track_kernel is None
+
+        if profile:
+            if not isinstance(context, xo.ContextCpu):
+                raise NotImplementedError(
+                    "Profiling is available only on ContextCpu")
+            if unroll_line:
+                raise NotImplementedError(
+                    "Profiling is not available for unrolled lines")
+            # Instrumented kernel has extra arguments and cannot be provided
+            assert track_kernel is None
+
         if element_classes is None:
             # Kernel relies on element_classes ordering
             assert track_kernel=='skip' or track_kernel is None
-            element_classes = frozenline._ElementRefClass._reftypes + [
-                particles_monitor_class._XoStruct,
-            ]
+            element_classes = list(frozenline._ElementRefClass._reftypes)
+            # MomentsMonitor and CompactParticlesMonitor are added only when
+            # used as turn_by_turn_monitor (see _get_monitor)
+            element_classes.append(particles_monitor_class._XoStruct)
+
+        use_kernel_registry = (track_kernel is None and compile
+                               and not unroll_line and not profile
+                               and save_source_as is None)
+        if use_kernel_registry:
+            registry_key = _kernel_registry_key(
+                particles_class, particles_monitor_class, global_xy_limit,
+                extra_headers, local_particle_src, precision,
+                at_element_steps is not None)
+            registered_kernel, registered_classes = _find_kernel_in_registry(
+                                    context, registry_key, element_classes)
+            if registered_kernel is not None:
+                track_kernel = registered_kernel
+                element_classes = registered_classes
+            else:
+                element_classes = _merge_with_registered_classes(
+                    context, registry_key, element_classes,
+                    particles_monitor_class._XoStruct)
 
         line._freeze()
         self.line = line
@@ -342,12 +550,42 @@ class Tracker:
         self.reset_s_at_end_turn = reset_s_at_end_turn
         self.local_particle_src = local_particle_src
         self.element_classes = element_classes
+        self.use_kernel_cache = use_kernel_cache
+        self.unroll_line = unroll_line
+        self.profile = profile
+        self.precision = precision
         self._buffer = frozenline._buffer
-
+        self._kernel_registry_key = (registry_key if use_kernel_registry
+                                     else None)
+        self._moments_monitors_in_line = [
+            ee for ee in line.elements if isinstance(ee, MomentsMonitor)]
+
+        self._at_element_steps = at_element_steps
+        if at_element_steps is not None:
+            self._at_element_steps_dev = context.nparray_to_context_array(
+                                                            at_element_steps)
+
+        if profile:
+            # Per element: time [ns], particle visits, lost particles
+            self._profile_data = np.zeros(
+                (self.num_elements, 3), dtype=np.int64)
+
+        self._track_kernel_future = None
         if track_kernel == 'skip':
             self.track_kernel = None
         elif track_kernel is None:
-            self._build_kernel(save_source_as, compile=compile)
+            def _build_and_register():
+                with _compile_lock:
+                    self._build_kernel(save_source_as, compile=bool(compile))
+                    if use_kernel_registry:
+                        _register_kernel(context, registry_key,
+                                         element_classes, self._track_kernel)
+            if compile == 'async':
+                # The kernel is awaited at its first use (see track_kernel)
+                self._track_kernel_future = (
+                    _get_async_compile_executor().submit(_build_and_register))
+            else:
+                _build_and_register()
         else:
             self.track_kernel = track_kernel
 
@@ -367,10 +605,60 @@ class Tracker:
             raise RuntimeError(
                 "This tracker is not anymore valid, most probably because the corresponding line has been unfrozen. "
                 "Please rebuild the tracker, for example using `line.build_tracker(...)`.")
+        # Complete a background compilation (compile='async') before any
+        # use of the tracker, including those sharing the kernel with new
+        # trackers or forking the process
+        if getattr(self, '_track_kernel_future', None) is not None:
+            self.track_kernel
+
+    def _get_element_byte_ranges(self):
+
+        '''
+        Byte ranges [start, end) of the buffer holding the data of the
+        elements, merged where contiguous. Monitors placed in the line are
+        excluded, as their data is written by the tracking.
+        '''
+
+        assert not self.iscollective
+
+        if self._element_byte_ranges is None:
+            monitor_classes = (self.particles_monitor_class, MomentsMonitor,
+                               CompactParticlesMonitor)
+            ranges = sorted(set(
+                (ee._offset, ee._offset + ee._xobject._size)
+                for ee in self._line_frozen.elements
+                if not isinstance(ee, monitor_classes)))
+            # Elements are mostly allocated contiguously
+            merged = []
+            for i_start, i_end in ranges:
+                if merged and i_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], i_end)
+                else:
+                    merged.append([i_start, i_end])
+            self._element_byte_ranges = merged
+
+        return self._element_byte_ranges
+
+    def _get_lattice_fingerprint(self):
+
+        '''
+        Hash of the element data in the buffer. It is checked together with
+        the lattice version counter (see base_element._lattice_version) to
+        validate cached results, as in-place writes of array items (e.g.
+        `element.knl[1] = 0.1`) are not counted by the version.
+        '''
+
+        buffer = self._line_frozen._buffer
+        data = buffer.context.nparray_from_context_array(buffer.buffer)
+        hh = hashlib.sha1()
+        for i_start, i_end in self._get_element_byte_ranges():
+            hh.update(data[i_start:i_end])
+        return hh.digest()
 
     def find_closed_orbit(self, particle_co_guess=None, particle_ref=None,
                           co_search_settings={}, delta_zeta=0, delta0=None,
-                          continue_on_closed_orbit_error=False):
+                          continue_on_closed_orbit_error=False,
+                          R_matrix_guess=None):
 
         self._check_invalidated()
 
@@ -389,7 +677,8 @@ class Tracker:
         return find_closed_orbit(tracker, particle_co_guess=particle_co_guess,
                                  particle_ref=particle_ref, delta0=delta0,
                                  co_search_settings=co_search_settings, delta_zeta=delta_zeta,
-                                 continue_on_closed_orbit_error=continue_on_closed_orbit_error)
+                                 continue_on_closed_orbit_error=continue_on_closed_orbit_error,
+                                 R_matrix_guess=R_matrix_guess)
 
     def compute_one_turn_matrix_finite_differences(
             self, particle_on_co,
@@ -408,6 +697,41 @@ class Tracker:
         return compute_one_turn_matrix_finite_differences(tracker, particle_on_co,
                                                    steps_r_matrix)
 
+    def one_turn_matrix_at(self, element, particle_on_co=None, co_tol=1e-9):
+
+        '''
+        One-turn matrix at the entrance of `element` (name or index), obtained
+        as product of the linear transfer matrices of the elements around the
+        closed orbit. The partial products are kept in a segment tree, such
+        that after changing a few elements only O(log N) products are updated.
+
+        The matrices are linearized around the closed orbit found at the first
+        call. Without `particle_on_co`, this orbit is kept after lattice
+        changes, i.e. the effect of the orbit change on the matrices of the
+        unchanged elements is neglected. If `particle_on_co` (at the start of
+        the line) is given, the orbit is tracked again after lattice changes
+        or if it differs by more than `co_tol` at the start, and the elements
+        where the orbit moved by more than `co_tol` are linearized again.
+        '''
+
+        self._check_invalidated()
+
+        if isinstance(element, str):
+            element = self.line.element_names.index(element)
+
+        if self.iscollective:
+            logger.warning(
+                'The tracker has collective elements.\n'
+                'In the twiss computation collective elements are'
+                ' replaced by drifts')
+            tracker = self._supertracker
+        else:
+            tracker = self
+
+        return one_turn_matrix_from_element_matrices(tracker,
+                        element_index=element, particle_on_co=particle_on_co,
+                        co_tol=co_tol)
+
     def twiss(self, particle_ref=None, delta0=None, method='6d',
         r_sigma=0.01, nemitt_x=1e-6, nemitt_y=1e-6,
         delta_disp=1e-5, delta_chrom=1e-4,
@@ -420,7 +744,9 @@ class Tracker:
         particle_on_co=None,
         matrix_responsiveness_tol=None,
         matrix_stability_tol=None,
-        symplectify=False
+        symplectify=False,
+        engine='tracking',
+        only_global_quantities=False
         ):
 
         self._check_invalidated()
@@ -430,24 +756,95 @@ class Tracker:
 
         return twiss_from_tracker(self, **kwargs)
 
+    def twiss_delta_scan(self, deltas, particle_ref=None,
+        r_sigma=0.01, nemitt_x=1e-6, nemitt_y=1e-6, delta_disp=1e-5,
+        steps_r_matrix=None, matrix_responsiveness_tol=None,
+        matrix_stability_tol=None, symplectify=False):
+
+        '''
+        Compute the 4d twiss for all the momentum offsets in `deltas` at once.
+        Element-by-element quantities in the returned table have shape
+        (len(deltas), n_points); global quantities have shape (len(deltas),).
+        '''
+
+        self._check_invalidated()
+
+        kwargs = locals().copy()
+        kwargs.pop('self')
+
+        return twiss_delta_scan_from_tracker(self, **kwargs)
+
+    def track_parallel(self, particles, num_turns=1, n_workers=None,
+                       turn_by_turn_monitor=None):
+
+        self._check_invalidated()
+
+        return track_parallel(self, particles, num_turns=num_turns,
+                              n_workers=n_workers,
+                              turn_by_turn_monitor=turn_by_turn_monitor)
+
     def survey(self,X0=0,Y0=0,Z0=0,theta0=0,phi0=0,psi0=0):
         return survey_from_tracker(self,X0=X0,Y0=Y0,Z0=Z0,theta0=theta0,phi0=phi0,psi0=psi0)
 
     def match(self, vary, targets, **kwargs):
         return match_tracker(self, vary, targets, **kwargs)
 
+    def compute_knob_response(self, vary, observables, steps=None,
+                              n_workers=None, **kwargs):
+
+        '''
+        Compute the response of the twiss `observables` to the knobs in
+        `vary` by finite differences, evaluating the perturbed knob settings
+        in parallel worker processes where possible. Observables are global
+        quantities (e.g. 'qx') or tuples (column, element_name(s)), e.g.
+        ('betx', 'ip1'). Additional arguments are passed to the twiss.
+        The response is stored in the tracker and returned.
+        '''
+
+        self._check_invalidated()
+
+        self._knob_response = compute_knob_response(self, vary=vary,
+                    observables=observables, steps=steps,
+                    n_workers=n_workers, **kwargs)
+        return self._knob_response
+
+    def match_with_knob_response(self, targets, response=None, n_iterations=5,
+                                 tol=None, weights=None, rcond=None):
+
+        '''
+        Correct the observables towards `targets`, a list of tuples
+        (observable, value), using the linear model of the knob response
+        (by default the last one computed for this tracker). A twiss is
+        computed at each iteration to measure the residuals. The knobs are
+        left at the values giving the smallest residuals and the returned
+        `success` flag tells whether all residuals are below `tol`.
+        '''
+
+        self._check_invalidated()
+
+        if response is None:
+            response = self._knob_response
+        if response is None:
+            raise ValueError('No knob response available, '
+                             'call `compute_knob_response` first')
+
+        return match_with_knob_response(self, targets=targets,
+                    response=response, n_iterations=n_iterations, tol=tol,
+                    weights=weights, rcond=rcond)
+
     def filter_elements(self, mask=None, exclude_types_starting_with=None):
 
         self._check_invalidated()
 
+        track_kernel, element_classes = self._get_shareable_kernel()
+
         return self.__class__(
                  _buffer=self._buffer,
                  line=self.line.filter_elements(mask=mask,
                      exclude_types_starting_with=exclude_types_starting_with),
-                 track_kernel=(self.track_kernel if not self.iscollective
-                                    else self._supertracker.track_kernel),
-                 element_classes=(self.element_classes if not self.iscollective
-                                    else self._supertracker.element_classes))
+                 track_kernel=track_kernel,
+                 element_classes=element_classes,
+                 precision=self.precision)
 
     def cycle(self, index_first_element=None, name_first_element=None,
               _buffer=None, _context=None):
@@ -463,19 +860,20 @@ class Tracker:
             else:
                 _buffer = _context.new_buffer()
 
+        track_kernel, element_classes = self._get_shareable_kernel()
+
         return self.__class__(
                 _buffer=_buffer,
                 line=cline,
-                track_kernel=(self.track_kernel if not self.iscollective
-                                    else self._supertracker.track_kernel),
-                element_classes=(self.element_classes if not self.iscollective
-                                    else self._supertracker.element_classes),
+                track_kernel=track_kernel,
+                element_classes=element_classes,
                 particles_class=self.particles_class,
                 skip_end_turn_actions=self.skip_end_turn_actions,
                 particles_monitor_class=self.particles_monitor_class,
                 global_xy_limit=self.global_xy_limit,
                 extra_headers=self.extra_headers,
                 local_particle_src=self.local_particle_src,
+                precision=self.precision,
             )
 
     def get_backtracker(self, _context=None, _buffer=None,
@@ -498,8 +896,7 @@ class Tracker:
 
         if global_xy_limit == 'from_tracker':
             global_xy_limit = self.global_xy_limit
-            track_kernel = self.track_kernel
-            element_classes = self.element_classes
+            track_kernel, element_classes = self._get_shareable_kernel()
         else:
             track_kernel = None
             element_classes = None
@@ -515,8 +912,152 @@ class Tracker:
                     global_xy_limit=global_xy_limit,
                     extra_headers=self.extra_headers,
                     local_particle_src=self.local_particle_src,
+                    precision=self.precision,
                 )
 
+    def _get_shareable_kernel(self):
+        # Returns the kernel and the element classes that can be passed to
+        # trackers built from this one (e.g. on a modified copy of the line)
+        tracker = self._supertracker if self.iscollective else self
+        if (tracker.unroll_line or tracker.profile
+                or tracker._at_element_steps is not None):
+            # Unrolled kernels are specific to the line they were built for,
+            # instrumented kernels and kernels of optimized lines have extra
+            # arguments
+            return None, None
+        return tracker.track_kernel, tracker.element_classes
+
+    @property
+    def track_kernel(self):
+        if getattr(self, '_track_kernel_future', None) is not None:
+            # Wait for the background compilation (errors are raised here)
+            self._track_kernel_future.result()
+            self._track_kernel_future = None
+        return self._track_kernel
+
+    @track_kernel.setter
+    def track_kernel(self, value):
+        self._track_kernel = value
+
+    @property
+    def kernel_is_ready(self):
+        future = getattr(self, '_track_kernel_future', None)
+        return future is None or future.done()
+
+    @property
+    def _extra_kernel_args(self):
+        out = {}
+        if self.profile:
+            out['profile_data'] = self._profile_data
+        if self._at_element_steps is not None and not self.unroll_line:
+            out['at_element_steps'] = self._at_element_steps_dev
+        return out
+
+    def get_profile(self, by='element'):
+
+        """
+        Return the timing and counters collected by a tracker built with
+        `profile=True`, per element (`by='element'`) or aggregated per element
+        type (`by='type'`). Times are in seconds.
+        """
+
+        self._check_invalidated()
+
+        if not self.profile:
+            raise ValueError('The tracker was not built with `profile=True`')
+
+        element_types = np.array([ee.__class__.__name__
+                                  for ee in self.line.elements])
+        time = self._profile_data[:, 0] * 1e-9
+        num_particle_visits = self._profile_data[:, 1].copy()
+        num_lost = self._profile_data[:, 2].copy()
+
+        if by == 'element':
+            out = Table()
+            out['name'] = np.array(self.line.element_names)
+            out['element_type'] = element_types
+            out['time'] = time
+            out['num_particle_visits'] = num_particle_visits
+            out['num_lost'] = num_lost
+        elif by == 'type':
+            types, i_type = np.unique(element_types, return_inverse=True)
+            out = Table()
+            out['element_type'] = types
+            out['num_elements'] = np.bincount(i_type, minlength=len(types))
+            out['time'] = np.bincount(i_type, weights=time,
+                                      minlength=len(types))
+            out['num_particle_visits'] = np.bincount(
+                i_type, weights=num_particle_visits,
+                minlength=len(types)).astype(np.int64)
+            out['num_lost'] = np.bincount(i_type, weights=num_lost,
+                                    minlength=len(types)).astype(np.int64)
+        else:
+            raise ValueError(f'Invalid value for `by`: {by}')
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['time_per_particle_visit'] = np.where(
+                out['num_particle_visits'] > 0,
+                out['time'] / out['num_particle_visits'], 0.)
+
+        return out
+
+    def reset_profile(self):
+        if not self.profile:
+            raise ValueError('The tracker was not built with `profile=True`')
+        self._profile_data[:] = 0
+
+    def compare_with_double_precision(self, particles, num_turns=1):
+
+        """
+        Track copies of `particles` for `num_turns` turns with this tracker and
+        with a double-precision tracker built on a copy of the line. Returns
+        the maximum absolute difference of each coordinate over the particles
+        surviving in both cases, and the number of particles with a different
+        state.
+        """
+
+        self._check_invalidated()
+
+        if self.iscollective:
+            raise NotImplementedError
+
+        context = self._buffer.context
+        buffer_ref = context.new_buffer()
+        tracker_ref = self.__class__(
+                    _buffer=buffer_ref,
+                    line=self.line.copy(_buffer=buffer_ref),
+                    particles_class=self.particles_class,
+                    skip_end_turn_actions=self.skip_end_turn_actions,
+                    reset_s_at_end_turn=self.reset_s_at_end_turn,
+                    particles_monitor_class=self.particles_monitor_class,
+                    global_xy_limit=self.global_xy_limit,
+                    extra_headers=self.extra_headers,
+                    local_particle_src=self.local_particle_src,
+                    precision='double')
+
+        part = particles.copy()
+        part_ref = particles.copy()
+        self.track(part, num_turns=num_turns)
+        tracker_ref.track(part_ref, num_turns=num_turns)
+        part.move(_context=xo.ContextCpu())
+        part_ref.move(_context=xo.ContextCpu())
+
+        # Particles are compared by id, as lost particles might be reordered
+        i_sort = np.argsort(part.particle_id)
+        i_sort_ref = np.argsort(part_ref.particle_id)
+        state = part.state[i_sort]
+        state_ref = part_ref.state[i_sort_ref]
+        mask_alive = (state > 0) & (state_ref > 0)
+
+        out = Table()
+        for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta']:
+            diff = np.abs(getattr(part, nn)[i_sort][mask_alive]
+                          - getattr(part_ref, nn)[i_sort_ref][mask_alive])
+            out[nn] = diff.max() if len(diff) > 0 else 0.
+        out['num_state_mismatch'] = int(np.sum((state > 0) != (state_ref > 0)))
+
+        return out
+
     @property
     def particle_ref(self):
         self._check_invalidated()
@@ -554,9 +1095,21 @@ class Tracker:
 
         self.line.configure_radiation(mode=mode)
 
-    def _build_kernel(self, save_source_as, compile):
+    def _build_kernel(self, save_source_as, compile, ensemble=False):
+
+        # With ensemble=True the kernel tracks each particle through one of
+        # several variants of the line, stored with the same element types in
+        # the same buffer. `ele_offsets` is then a flattened
+        # [n_variants, n_elements] table and `variant_index` gives the
+        # variant of each particle slot. The kernel is returned and not
+        # installed as the track kernel of the tracker.
 
         context = self._line_frozen._buffer.context
+        kernel_name = 'track_line_ensemble' if ensemble else 'track_line'
+
+        if ensemble and (self.unroll_line or self.profile):
+            raise NotImplementedError('Ensemble tracking is not available '
+                                      'for unrolled or profiled kernels')
 
         kernels = {}
         headers = []
@@ -568,11 +1121,57 @@ class Tracker:
                 f"#define XTRACK_GLOBAL_POSLIMIT ({self.global_xy_limit})")
         headers.append(_pkg_root.joinpath("headers/constants.h"))
 
+        # Local variables of the element kernels using the types of
+        # headers/real_types.h (drift, multipole, rotation, shift). The data
+        # stays in double, so the gain is expected only on devices with low
+        # double-precision throughput
+        if self.precision == 'float32':
+            headers.extend(["#define XT_REAL float",
+                            "#define XT_REAL_LONG float"])
+        elif self.precision == 'mixed':
+            headers.append("#define XT_REAL float")
+
+        # Monitors that can be passed as turn_by_turn_monitor are called by
+        # the kernel only if compiled in it (see _get_monitor)
+        if MomentsMonitor._XoStruct in self.element_classes:
+            headers.append("#define XTRACK_KERNEL_MOMENTS_MONITOR")
+        if CompactParticlesMonitor._XoStruct in self.element_classes:
+            headers.append("#define XTRACK_KERNEL_COMPACT_MONITOR")
+
         src_lines = []
+
+        if self._at_element_steps is not None:
+            # Elements of an optimized line can stand for several elements of
+            # the original line
+            src_lines.append(
+                """
+            /*gpufun*/
+            void increment_at_element_by(LocalParticle* part0, int64_t step){
+                //start_per_particle_block (part0->part)
+                    LocalParticle_add_to_at_element(part, step);
+                //end_per_particle_block
+            }
+            """
+            )
+
+        if ensemble:
+            # Moves the per-particle pointers of a local particle by `shift`
+            # slots
+            shift_lines = [f"    part->{nn} += shift;" for _, nn in
+                           self.particles_class._structure['per_particle_vars']]
+            src_lines.append(
+                """
+            /*gpufun*/
+            void LocalParticle_move_to_slot(LocalParticle* part, int64_t shift){
+            """ + "\n".join(shift_lines) + """
+            }
+            """
+            )
+
         src_lines.append(
-            r"""
+            f"""
             /*gpukern*/
-            void track_line(
+            void {kernel_name}(
                 /*gpuglmem*/ int8_t* buffer,
                 /*gpuglmem*/ int64_t* ele_offsets,
                 /*gpuglmem*/ int64_t* ele_typeids,
@@ -585,7 +1184,27 @@ class Tracker:
                              int flag_monitor,
                 /*gpuglmem*/ int8_t* buffer_tbt_monitor,
                              int64_t offset_tbt_monitor,
-                /*gpuglmem*/ int8_t* io_buffer){
+                /*gpuglmem*/ int8_t* io_buffer,
+                             int64_t num_threads"""
+        )
+        if self.profile:
+            src_lines.append(
+                """,
+                /*gpuglmem*/ int64_t* profile_data"""
+            )
+        if self._at_element_steps is not None and not self.unroll_line:
+            src_lines.append(
+                """,
+                /*gpuglmem*/ int64_t* at_element_steps"""
+            )
+        if ensemble:
+            src_lines.append(
+                """,
+                /*gpuglmem*/ int64_t* variant_index,
+                             int64_t num_elements_variant"""
+            )
+        src_lines.append(
+            r"""){
 
 
             LocalParticle lpart;
@@ -603,8 +1222,41 @@ class Tracker:
 
             int64_t part_capacity = ParticlesData_get__capacity(particles);
             if (part_id<part_capacity){
+        """
+        )
+
+        if ensemble:
+            # On CPU the slots are tracked in runs of consecutive slots with
+            # the same variant, the local particle being moved to the start
+            # of the run. Lost particles are exchanged within their run.
+            src_lines.append(
+                """
+            int64_t run_start = part_id;
+            int64_t run_stop = part_capacity; //only_for_context cpu_serial cpu_openmp
+            int64_t run_stop = part_id + 1;   //only_for_context cuda opencl
+            while (run_start < run_stop){
+            int64_t run_end = run_start + 1;
+            while (run_end < run_stop
+                    && variant_index[run_end] == variant_index[run_start]){
+                run_end++;
+            }
             Particles_to_LocalParticle(particles, &lpart, part_id);
+            LocalParticle_move_to_slot(&lpart, run_start - part_id);
+            lpart._capacity = run_end - run_start;            //only_for_context cpu_serial cpu_openmp
+            lpart._num_active_particles = run_end - run_start; //only_for_context cpu_serial cpu_openmp
+            lpart._num_lost_particles = 0;                    //only_for_context cpu_serial cpu_openmp
+            int64_t ee_variant = variant_index[run_start] * num_elements_variant;
+        """
+            )
+        else:
+            src_lines.append(
+                """
+            Particles_to_LocalParticle(particles, &lpart, part_id);
+        """
+            )
 
+        src_lines.append(
+            r"""
             int64_t isactive = check_is_active(&lpart);
 
             for (int64_t iturn=0; iturn<num_turns; iturn++){
@@ -616,64 +1268,70 @@ class Tracker:
                 if (flag_monitor==1){
                     ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
                 }
-
-                for (int64_t ee=ele_start; ee<ele_start+num_ele_track; ee++){
-
-                        if (flag_monitor==2){
-                            ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
-                        }
-
-                        /*gpuglmem*/ int8_t* el = buffer + ele_offsets[ee];
-                        int64_t ee_type = ele_typeids[ee];
-
-                        switch(ee_type){
+                #ifdef XTRACK_KERNEL_MOMENTS_MONITOR
+                if (flag_monitor==3){
+                    MomentsMonitor_track_local_particle(
+                        (MomentsMonitorData) tbt_mon_pointer, &lpart);
+                }
+                #endif
+                #ifdef XTRACK_KERNEL_COMPACT_MONITOR
+                if (flag_monitor==4){
+                    CompactParticlesMonitor_track_local_particle(
+                        (CompactParticlesMonitorData) tbt_mon_pointer, &lpart);
+                }
+                #endif
         """
         )
 
-        for ii, cc in enumerate(self.element_classes):
-            ccnn = cc.__name__.replace("Data", "")
-            src_lines.append(
-                f"""
-                        case {ii}:
-"""
-            )
-            if ccnn == "Drift":
-                src_lines.append(
-                    """
-                            #ifdef XTRACK_GLOBAL_POSLIMIT
-                            global_aperture_check(&lpart);
-                            #endif
-
-                            """
-                )
-            src_lines.append(
-                f"""
-                            {ccnn}_track_local_particle(({ccnn}Data) el, &lpart);
-                            break;"""
-            )
+        if self.unroll_line:
+            src_lines.extend(self._unrolled_element_loop_source())
+        else:
+            src_lines.extend(
+                self._generic_element_loop_source(ensemble=ensemble))
 
         src_lines.append(
             """
-                        } //switch
-                    isactive = check_is_active(&lpart);
-                    if (!isactive){
-                        break;
-                    }
-                    increment_at_element(&lpart);
-                } // for elements
                 if (flag_monitor==2){
                     // End of turn (element-by-element mode)
                     ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
                 }
+                #ifdef XTRACK_KERNEL_COMPACT_MONITOR
+                if (flag_monitor==5){
+                    // End of turn (element-by-element mode)
+                    CompactParticlesMonitor_track_local_particle(
+                        (CompactParticlesMonitorData) tbt_mon_pointer, &lpart);
+                }
+                #endif
                 if (flag_end_turn_actions>0){
                     if (isactive){
                         increment_at_turn(&lpart, flag_reset_s_at_end_turn);
                     }
                 }
             } // for turns
+        """
+        )
 
+        if ensemble:
+            # On CPU the data is updated in place and the particles need to be
+            # reorganized after tracking
+            src_lines.append(
+                """
+            LocalParticle_to_Particles(&lpart, particles, part_id, 1); //only_for_context cuda opencl
+            run_start = run_end;
+            } // while runs
+            ParticlesData_set__num_active_particles(particles, -1); //only_for_context cpu_serial cpu_openmp
+            ParticlesData_set__num_lost_particles(particles, -1);   //only_for_context cpu_serial cpu_openmp
+        """
+            )
+        else:
+            src_lines.append(
+                """
             LocalParticle_to_Particles(&lpart, particles, part_id, 1);
+        """
+            )
 
+        src_lines.append(
+            """
             }// if partid
         }//kernel
         """
@@ -682,7 +1340,7 @@ class Tracker:
         source_track = "\n".join(src_lines)
 
         kernel_descriptions = {
-            "track_line": xo.Kernel(
+            kernel_name: xo.Kernel(
                 args=[
                     xo.Arg(xo.Int8, pointer=True, name="buffer"),
                     xo.Arg(xo.Int64, pointer=True, name="ele_offsets"),
@@ -697,9 +1355,22 @@ class Tracker:
                     xo.Arg(xo.Int8, pointer=True, name="buffer_tbt_monitor"),
                     xo.Arg(xo.Int64, name="offset_tbt_monitor"),
                     xo.Arg(xo.Int8, pointer=True, name="io_buffer"),
+                    xo.Arg(xo.Int64, name="num_threads"),
                 ],
+                n_threads="num_threads",
             )
         }
+        if self.profile:
+            kernel_descriptions[kernel_name].args.append(
+                xo.Arg(xo.Int64, pointer=True, name="profile_data"))
+            headers.insert(0, "#include <time.h>")
+        if self._at_element_steps is not None and not self.unroll_line:
+            kernel_descriptions[kernel_name].args.append(
+                xo.Arg(xo.Int64, pointer=True, name="at_element_steps"))
+        if ensemble:
+            kernel_descriptions[kernel_name].args.extend([
+                xo.Arg(xo.Int64, pointer=True, name="variant_index"),
+                xo.Arg(xo.Int64, name="num_elements_variant")])
 
         # Internal API can be exposed only on CPU
         if not isinstance(context, xo.ContextCpu):
@@ -709,21 +1380,238 @@ class Tracker:
         # Random number generator init kernel
         kernels.update(self.particles_class._kernels)
 
+        apply_to_source = [
+            partial(_handle_per_particle_blocks,
+                    local_particle_src=self.local_particle_src)]
+
         # Compile!
-        context.add_kernels(
-            [source_track],
-            kernels,
-            extra_headers=headers,
-            extra_classes=self.element_classes,
-            apply_to_source=[
-                partial(_handle_per_particle_blocks,
-                        local_particle_src=self.local_particle_src)],
-            save_source_as=save_source_as,
-            specialize=True,
-            compile=compile
+        with _compile_lock:
+            if (self.use_kernel_cache and compile
+                    and isinstance(context, xo.ContextCpu)):
+                add_kernels_with_cache(
+                    context,
+                    [source_track],
+                    kernels,
+                    extra_headers=headers,
+                    extra_classes=self.element_classes,
+                    apply_to_source=apply_to_source,
+                    save_source_as=save_source_as)
+            else:
+                context.add_kernels(
+                    [source_track],
+                    kernels,
+                    extra_headers=headers,
+                    extra_classes=self.element_classes,
+                    apply_to_source=apply_to_source,
+                    save_source_as=save_source_as,
+                    specialize=True,
+                    compile=compile
+                )
+
+            if ensemble:
+                return context.kernels[kernel_name]
+            self.track_kernel = context.kernels.track_line
+
+    def _generic_element_loop_source(self, ensemble=False):
+
+        src_lines = []
+        src_lines.append(
+            """
+                for (int64_t ee=ele_start; ee<ele_start+num_ele_track; ee++){
+
+                        if (flag_monitor==2){
+                            ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
+                        }
+                        #ifdef XTRACK_KERNEL_COMPACT_MONITOR
+                        if (flag_monitor==5){
+                            CompactParticlesMonitor_track_local_particle(
+                                (CompactParticlesMonitorData) tbt_mon_pointer,
+                                &lpart);
+                        }
+                        #endif
+
+        """
+        )
+
+        if ensemble:
+            src_lines.append(
+                """
+                        /*gpuglmem*/ int8_t* el =
+                                buffer + ele_offsets[ee_variant + ee];
+        """
+            )
+        else:
+            src_lines.append(
+                """
+                        /*gpuglmem*/ int8_t* el = buffer + ele_offsets[ee];
+        """
+            )
+
+        src_lines.append(
+            """
+                        int64_t ee_type = ele_typeids[ee];
+        """
+        )
+
+        if self.profile:
+            src_lines.append(
+                """
+                        int64_t n_active_before =
+                                LocalParticle_get__num_active_particles(&lpart);
+                        struct timespec t_start, t_stop;
+                        clock_gettime(CLOCK_MONOTONIC, &t_start);
+        """
+            )
+
+        src_lines.append(
+            """
+                        switch(ee_type){
+        """
+        )
+
+        for ii, cc in enumerate(self.element_classes):
+            ccnn = cc.__name__.replace("Data", "")
+            src_lines.append(
+                f"""
+                        case {ii}:
+"""
+            )
+            if ccnn == "Drift":
+                src_lines.append(
+                    """
+                            #ifdef XTRACK_GLOBAL_POSLIMIT
+                            global_aperture_check(&lpart);
+                            #endif
+
+                            """
+                )
+            src_lines.append(
+                f"""
+                            {ccnn}_track_local_particle(({ccnn}Data) el, &lpart);
+                            break;"""
+            )
+
+        src_lines.append(
+            """
+                        } //switch
+        """
+        )
+
+        if self.profile:
+            src_lines.append(
+                """
+                    clock_gettime(CLOCK_MONOTONIC, &t_stop);
+        """
+            )
+
+        src_lines.append(
+            """
+                    isactive = check_is_active(&lpart);
+        """
+        )
+
+        if self.profile:
+            src_lines.append(
+                """
+                    profile_data[3*ee] +=
+                        (int64_t) (t_stop.tv_sec - t_start.tv_sec) * 1000000000
+                        + (int64_t) (t_stop.tv_nsec - t_start.tv_nsec);
+                    profile_data[3*ee + 1] += n_active_before;
+                    profile_data[3*ee + 2] += n_active_before
+                            - LocalParticle_get__num_active_particles(&lpart);
+        """
+            )
+
+        src_lines.append(
+            """
+                    if (!isactive){
+                        break;
+                    }
+        """
+        )
+
+        if self._at_element_steps is not None:
+            src_lines.append(
+                """
+                    increment_at_element_by(&lpart, at_element_steps[ee]);
+        """
+            )
+        else:
+            src_lines.append(
+                """
+                    increment_at_element(&lpart);
+        """
+            )
+
+        src_lines.append(
+            """
+                } // for elements
+        """
+        )
+
+        return src_lines
+
+    def _unrolled_element_loop_source(self):
+
+        # The elements are called in tracking order with their offsets
+        # hardcoded. The switch is used only to jump to ele_start (the cases
+        # fall through), and the loop stops when ele_stop is reached.
+
+        src_lines = []
+        src_lines.append(
+            """
+                int64_t const ele_stop = ele_start + num_ele_track;
+                switch(ele_start){
+        """
+        )
+
+        for ii, ee in enumerate(self._line_frozen.elements):
+            ccnn = ee._xobject.__class__.__name__.replace("Data", "")
+            if self._at_element_steps is not None:
+                increment = (f"increment_at_element_by(&lpart, "
+                             f"{self._at_element_steps[ii]});")
+            else:
+                increment = "increment_at_element(&lpart);"
+            src_lines.append(
+                f"""
+                    case {ii}:
+                        if ({ii} >= ele_stop) goto end_elements;
+                        if (flag_monitor==2){{
+                            ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
+                        }}
+                        #ifdef XTRACK_KERNEL_COMPACT_MONITOR
+                        if (flag_monitor==5){{
+                            CompactParticlesMonitor_track_local_particle(
+                                (CompactParticlesMonitorData) tbt_mon_pointer,
+                                &lpart);
+                        }}
+                        #endif"""
+            )
+            if ccnn == "Drift":
+                src_lines.append(
+                    """
+                        #ifdef XTRACK_GLOBAL_POSLIMIT
+                        global_aperture_check(&lpart);
+                        #endif"""
+                )
+            src_lines.append(
+                f"""
+                        {ccnn}_track_local_particle(({ccnn}Data) (buffer + {ee._offset}), &lpart);
+                        isactive = check_is_active(&lpart);
+                        if (!isactive) goto end_elements;
+                        {increment}"""
+            )
+
+        src_lines.append(
+            """
+                    default:
+                        ;
+                } // switch (unrolled elements)
+                end_elements: ;
+        """
         )
 
-        self.track_kernel = context.kernels.track_line
+        return src_lines
 
     def _prepare_collective_track_session(self, particles, ele_start, ele_stop,
                                        num_elements, num_turns, turn_by_turn_monitor):
@@ -887,11 +1775,19 @@ class Tracker:
         num_elements=None, # defaults to full lattice
         num_turns=None,    # defaults to 1
         turn_by_turn_monitor=None,
+        checkpoint_every=None,
+        checkpoint_path=None,
+        resume_from=None,
         _session_to_resume=None
     ):
 
         self._check_invalidated()
 
+        if (checkpoint_every is not None or checkpoint_path is not None
+                or resume_from is not None):
+            raise NotImplementedError('Checkpointing is not available for '
+                                      'lines with collective elements')
+
         if (isinstance(self._buffer.context, xo.ContextCpu)
             and _session_to_resume is None):
             assert (particles._num_active_particles >= 0 and
@@ -1037,6 +1933,22 @@ class Tracker:
         self.record_last_track = monitor
 
 
+    def _tracked_element_index(self, ele):
+
+        # Element indices and names given by the user (including loss
+        # locations and at_element values) refer to the original line, also
+        # when the tracked line is optimized
+        if isinstance(ele, str):
+            ele = self.original_line.element_names.index(ele)
+        if self._at_element_steps is None:
+            return ele
+        i_tracked = int(np.searchsorted(self.original_element_index, ele))
+        if (i_tracked == len(self.original_element_index)
+                or self.original_element_index[i_tracked] != ele):
+            raise ValueError(f'Element {ele} of the original line is merged '
+                             'or removed in the optimized line')
+        return i_tracked
+
     def _track_no_collective(
         self,
         particles,
@@ -1044,11 +1956,53 @@ class Tracker:
         ele_stop=None,     # defaults to full lattice
         num_elements=None, # defaults to full lattice
         num_turns=None,    # defaults to 1
-        turn_by_turn_monitor=None
+        turn_by_turn_monitor=None,
+        checkpoint_every=None,
+        checkpoint_path=None,
+        resume_from=None,
+        compact_every=None
     ):
 
         self._check_invalidated()
 
+        if compact_every is not None:
+            assert compact_every > 0
+            if not isinstance(particles._buffer.context,
+                              (xo.ContextCpu, xo.ContextCupy)):
+                raise NotImplementedError(
+                    '`compact_every` is available only on ContextCpu and '
+                    'ContextCupy')
+
+        if checkpoint_every is not None:
+            assert checkpoint_every > 0
+            if checkpoint_path is None:
+                raise ValueError(
+                    '`checkpoint_path` must be provided with `checkpoint_every`')
+
+        if resume_from is not None:
+            checkpoint = load_checkpoint(resume_from)
+            restore_particles(particles, checkpoint)
+        else:
+            checkpoint = None
+
+        if (checkpoint_every is not None
+                and isinstance(turn_by_turn_monitor,
+                               (MomentsMonitor, CompactParticlesMonitor))):
+            raise NotImplementedError('Checkpointing is not available with '
+                                      'this monitor type')
+
+        if isinstance(turn_by_turn_monitor, StreamingParticlesMonitor):
+            if checkpoint_every is not None or checkpoint is not None:
+                raise NotImplementedError('Checkpointing is not available '
+                                          'with a streaming monitor')
+            if self.skip_end_turn_actions:
+                raise NotImplementedError('A streaming monitor cannot be used '
+                                          'with `skip_end_turn_actions`')
+            stream = turn_by_turn_monitor
+            turn_by_turn_monitor = stream.device_monitor
+        else:
+            stream = None
+
         if isinstance(self._buffer.context, xo.ContextCpu):
             assert (particles._num_active_particles >= 0 and
                     particles._num_lost_particles >= 0), (
@@ -1063,8 +2017,7 @@ class Tracker:
                                 + "Please use only one of those methods.")
             ele_start = particles.start_tracking_at_element
             particles.start_tracking_at_element = -1
-        if isinstance(ele_start,str):
-            ele_start = self.line.element_names.index(ele_start)
+        ele_start = self._tracked_element_index(ele_start)
 
         assert ele_start >= 0
         assert ele_start <= self.num_elements
@@ -1089,6 +2042,9 @@ class Tracker:
         if num_elements is not None:
             # We are using ele_start and num_elements
             assert num_elements >= 0
+            if self._at_element_steps is not None:
+                raise NotImplementedError('`num_elements` is not available '
+                                          'for optimized lines, use `ele_stop`')
             if ele_stop is not None:
                 raise ValueError("Cannot use both num_elements and ele_stop!")
             if num_turns is not None:
@@ -1116,8 +2072,7 @@ class Tracker:
                 num_elements_first_turn = self.num_elements - ele_start
                 num_middle_turns = num_turns - 1
             else:
-                if isinstance(ele_stop, str):
-                    ele_stop = self.line.element_names.index(ele_stop)
+                ele_stop = self._tracked_element_index(ele_stop)
                 assert ele_stop >= 0
                 assert ele_stop < self.num_elements
                 if ele_stop <= ele_start:
@@ -1150,39 +2105,110 @@ class Tracker:
             # One monitor record for the initial turn, and num_middle_turns record for the middle turns
             monitor_turns = num_middle_turns + 1
 
-        (flag_monitor, monitor, buffer_monitor, offset_monitor
-            ) = self._get_monitor(particles, turn_by_turn_monitor, monitor_turns)
+        track_info = {
+            'ele_start': ele_start,
+            'num_elements_first_turn': num_elements_first_turn,
+            'num_middle_turns': num_middle_turns,
+            'num_elements_last_turn': num_elements_last_turn,
+            'num_middle_turns_done': 0,
+        }
+
+        if checkpoint is not None:
+            for kk in ['ele_start', 'num_elements_first_turn',
+                       'num_middle_turns', 'num_elements_last_turn']:
+                if checkpoint['track_info'][kk] != track_info[kk]:
+                    raise ValueError('The tracking settings are not the same as '
+                                     f'in the checkpoint ({kk})')
+            track_info['num_middle_turns_done'] = checkpoint['track_info'][
+                                                    'num_middle_turns_done']
+            if (checkpoint['monitor'] is not None
+                    and (turn_by_turn_monitor is True
+                         or turn_by_turn_monitor == 'ONE_TURN_EBE')):
+                # Rebuild the monitor generated by the interrupted run
+                settings = checkpoint['monitor']['settings']
+                turn_by_turn_monitor = self.particles_monitor_class(
+                    _context=particles._buffer.context,
+                    start_at_turn=settings['start_at_turn'],
+                    stop_at_turn=settings['stop_at_turn'],
+                    particle_id_range=(settings['part_id_start'],
+                                       settings['part_id_end']))
+                turn_by_turn_monitor.ebe_mode = settings['ebe_mode']
+            (flag_monitor, monitor, buffer_monitor, offset_monitor
+                ) = self._get_monitor(particles, turn_by_turn_monitor,
+                                      monitor_turns)
+            if checkpoint['monitor'] is not None:
+                if monitor is None:
+                    raise ValueError('The checkpoint contains monitor data, '
+                                     'please provide `turn_by_turn_monitor`')
+                restore_monitor(monitor, checkpoint)
+                if monitor.ebe_mode:
+                    flag_monitor = 2
+        else:
+            (flag_monitor, monitor, buffer_monitor, offset_monitor
+                ) = self._get_monitor(particles, turn_by_turn_monitor,
+                                      monitor_turns)
 
         if self.line._needs_rng and not particles._has_valid_rng_state():
             particles._init_random_number_generator()
 
-        self.track_kernel.description.n_threads = particles._capacity
+        for mm in self._moments_monitors_in_line:
+            if not mm.has_reference:
+                mm._set_reference_from_particles(particles)
+
+        if stream is not None:
+            # Turn of the particles at the start of each middle turn is
+            # turn_first_middle + i_turn
+            turn_first_middle = (
+                int(particles._buffer.context.nparray_from_context_array(
+                    particles.at_turn).max())
+                + int(flag_end_first_turn_actions))
+
+        # Passed to each launch (the kernel may be shared with other trackers)
+        num_threads = particles._capacity
 
         # First turn
-        self.track_kernel(
-            buffer=self._line_frozen._buffer.buffer,
-            ele_offsets=self.ele_offsets_dev,
-            ele_typeids=self.ele_typeids_dev,
-            particles=particles._xobject,
-            num_turns=1,
-            ele_start=ele_start,
-            num_ele_track=num_elements_first_turn,
-            flag_end_turn_actions=flag_end_first_turn_actions,
-            flag_reset_s_at_end_turn=self.reset_s_at_end_turn,
-            flag_monitor=flag_monitor,
-            buffer_tbt_monitor=buffer_monitor,
-            offset_tbt_monitor=offset_monitor,
-            io_buffer=self.io_buffer.buffer,
-        )
+        if checkpoint is None:
+            self.track_kernel(
+                buffer=self._line_frozen._buffer.buffer,
+                ele_offsets=self.ele_offsets_dev,
+                ele_typeids=self.ele_typeids_dev,
+                particles=particles._xobject,
+                num_turns=1,
+                ele_start=ele_start,
+                num_ele_track=num_elements_first_turn,
+                flag_end_turn_actions=flag_end_first_turn_actions,
+                flag_reset_s_at_end_turn=self.reset_s_at_end_turn,
+                flag_monitor=flag_monitor,
+                buffer_tbt_monitor=buffer_monitor,
+                offset_tbt_monitor=offset_monitor,
+                io_buffer=self.io_buffer.buffer,
+                num_threads=num_threads,
+                **self._extra_kernel_args,
+            )
 
-        # Middle turns
-        if num_middle_turns > 0:
+        if stream is not None and (
+                turn_first_middle >= stream.device_monitor.stop_at_turn):
+            stream.flush(at_turn=turn_first_middle)
+
+        # Middle turns (split in chunks if checkpointing, compaction or
+        # streaming are enabled)
+        while track_info['num_middle_turns_done'] < num_middle_turns:
+            i_turn = track_info['num_middle_turns_done']
+            i_turn_stop = num_middle_turns
+            for every in [checkpoint_every, compact_every]:
+                if every is not None:
+                    i_turn_stop = min(i_turn_stop, (i_turn // every + 1) * every)
+            if stream is not None:
+                # Stop at the end of the window of the streaming monitor
+                i_turn_stop = min(i_turn_stop, max(i_turn + 1,
+                    int(stream.device_monitor.stop_at_turn) - turn_first_middle))
+            num_turns_chunk = i_turn_stop - i_turn
             self.track_kernel(
                 buffer=self._line_frozen._buffer.buffer,
                 ele_offsets=self.ele_offsets_dev,
                 ele_typeids=self.ele_typeids_dev,
                 particles=particles._xobject,
-                num_turns=num_middle_turns,
+                num_turns=num_turns_chunk,
                 ele_start=0, # always full turn
                 num_ele_track=self.num_elements, # always full turn
                 flag_end_turn_actions=flag_end_middle_turn_actions,
@@ -1191,7 +2217,25 @@ class Tracker:
                 buffer_tbt_monitor=buffer_monitor,
                 offset_tbt_monitor=offset_monitor,
                 io_buffer=self.io_buffer.buffer,
+                num_threads=num_threads,
+                **self._extra_kernel_args,
             )
+            track_info['num_middle_turns_done'] += num_turns_chunk
+            i_turn = track_info['num_middle_turns_done']
+
+            if compact_every is not None and (i_turn % compact_every == 0):
+                # Move lost particles to the end of the arrays, such that the
+                # next kernel launches cover only the active ones
+                n_active, _ = particles.reorganize()
+                num_threads = max(n_active, 1)
+
+            if checkpoint_every is not None and (
+                    i_turn % checkpoint_every == 0 or i_turn == num_middle_turns):
+                save_checkpoint(checkpoint_path, particles, monitor, track_info)
+
+            if stream is not None and (turn_first_middle + i_turn
+                                       >= stream.device_monitor.stop_at_turn):
+                stream.flush(at_turn=turn_first_middle + i_turn)
 
         # Last turn, only if incomplete
         if num_elements_last_turn > 0:
@@ -1209,8 +2253,14 @@ class Tracker:
                 buffer_tbt_monitor=buffer_monitor,
                 offset_tbt_monitor=offset_monitor,
                 io_buffer=self.io_buffer.buffer,
+                num_threads=num_threads,
+                **self._extra_kernel_args,
             )
 
+        if stream is not None:
+            stream.flush(at_turn=turn_first_middle + num_middle_turns)
+            monitor = stream
+
         self.record_last_track = monitor
 
     def _get_monitor(self, particles, turn_by_turn_monitor, num_turns):
@@ -1234,7 +2284,7 @@ class Tracker:
         elif turn_by_turn_monitor == 'ONE_TURN_EBE':
             (_, monitor, buffer_monitor, offset_monitor
                 ) = self._get_monitor(particles, turn_by_turn_monitor=True,
-                                      num_turns=len(self.line.elements)+1)
+                        num_turns=int(self.original_element_index[-1]) + 1)
             monitor.ebe_mode = 1
             flag_monitor = 2
         elif isinstance(turn_by_turn_monitor, self.particles_monitor_class):
@@ -1242,11 +2292,48 @@ class Tracker:
             monitor = turn_by_turn_monitor
             buffer_monitor = monitor._buffer.buffer
             offset_monitor = monitor._offset
+        elif isinstance(turn_by_turn_monitor, MomentsMonitor):
+            self._add_monitor_class_to_kernel(MomentsMonitor)
+            flag_monitor = 3
+            monitor = turn_by_turn_monitor
+            if not monitor.has_reference:
+                monitor._set_reference_from_particles(particles)
+            buffer_monitor = monitor._buffer.buffer
+            offset_monitor = monitor._offset
+        elif isinstance(turn_by_turn_monitor, CompactParticlesMonitor):
+            self._add_monitor_class_to_kernel(CompactParticlesMonitor)
+            # Records at each element in element-by-element mode
+            flag_monitor = 5 if turn_by_turn_monitor.ebe_mode else 4
+            monitor = turn_by_turn_monitor
+            buffer_monitor = monitor._buffer.buffer
+            offset_monitor = monitor._offset
         else:
             raise ValueError('Please provide a valid monitor object')
 
         return flag_monitor, monitor, buffer_monitor, offset_monitor
 
+    def _add_monitor_class_to_kernel(self, monitor_class):
+
+        # In collective mode the monitor is called outside the kernel
+        if self.iscollective:
+            return
+
+        if monitor_class._XoStruct in self.element_classes:
+            return
+
+        # The class is appended, such that the type ids of the elements are
+        # unchanged. The list can be shared with other trackers and is not
+        # modified in place.
+        self.track_kernel # wait for pending compilations
+        self.element_classes = (list(self.element_classes)
+                                + [monitor_class._XoStruct])
+        with _compile_lock:
+            self._build_kernel(save_source_as=None, compile=True)
+            if self._kernel_registry_key is not None:
+                _register_kernel(self._buffer.context,
+                                 self._kernel_registry_key,
+                                 self.element_classes, self._track_kernel)
+
     def start_internal_logging_for_elements_of_type(self,
                                                     element_type, capacity):
         return start_internal_logging_for_elements_of_type(self,
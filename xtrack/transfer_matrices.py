@@ -0,0 +1,330 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import math
+
+import numpy as np
+
+import xpart as xp
+
+from . import beam_elements
+
+# Linear transfer matrices of the elements of a line around the closed orbit,
+# in the coordinates (x, px, y, py, zeta, pzeta). Drifts and multipoles are
+# handled with NumPy versions of their maps, vectorized over the elements of
+# the same type, SRotation, XYShift, DipoleEdge and apertures are linear and
+# are written directly, all other elements are tracked by finite differences.
+
+# Elements not changing the coordinates of the particles they do not lose
+_identity_classes = (beam_elements.XYShift, beam_elements.LimitRect,
+                     beam_elements.LimitRacetrack, beam_elements.LimitEllipse,
+                     beam_elements.LimitPolygon, beam_elements.LimitRectEllipse,
+                     beam_elements.LongitudinalLimitRect)
+
+_steps = np.array([1e-7, 1e-10, 1e-7, 1e-10, 1e-6, 1e-7])
+
+def _delta_from_ptau(ptau, beta0):
+    return np.sqrt(ptau**2 + 2*ptau/beta0 + 1) - 1
+
+def _drift_numpy(x, px, y, py, zeta, delta, ptau, beta0, length):
+    # Same map as the Drift element
+    rpp = 1. / (1. + delta)
+    rv0v = (1. + beta0 * ptau) / (1. + delta)
+    xp = px * rpp
+    yp = py * rpp
+    dzeta = 1 - rv0v * (1. + (xp*xp + yp*yp) / 2.)
+    return x + xp * length, y + yp * length, zeta + length * dzeta
+
+def _multipole_numpy(x, px, y, py, zeta, delta, ptau, beta0, chi,
+                     knl, ksl, hxl, hyl, length):
+    # Same map as the Multipole element without radiation. knl and ksl have
+    # shape (max_order + 1, ...) and are zero-padded above the element order.
+    max_order = knl.shape[0] - 1
+    inv_factorial = 1. / math.factorial(max_order)
+    dpx = knl[max_order] * inv_factorial
+    dpy = ksl[max_order] * inv_factorial
+    for index in range(max_order, 0, -1):
+        zre = dpx * x - dpy * y
+        zim = dpx * y + dpy * x
+        inv_factorial *= index
+        dpx = knl[index - 1] * inv_factorial + zre
+        dpy = ksl[index - 1] * inv_factorial + zim
+
+    dpx = -chi * dpx
+    dpy = chi * dpy
+
+    rv0v = (1. + beta0 * ptau) / (1. + delta)
+    zeta = zeta + rv0v * chi * (hyl * y - hxl * x)
+    dpx = dpx + hxl + hxl * delta
+    dpy = dpy - hyl - hyl * delta
+    inv_length = np.divide(1., length, out=np.zeros_like(length),
+                           where=(length != 0))
+    dpx = dpx - chi * knl[0] * hxl * x * inv_length
+    dpy = dpy + chi * ksl[0] * hyl * y * inv_length
+
+    return px + dpx, py + dpy, zeta
+
+def _numpy_map_matrices(co, beta0, track_function):
+
+    # Central finite differences of a NumPy map for many elements at once.
+    # co has shape (6, n_elements).
+
+    n_elements = co.shape[1]
+    coords = np.zeros(shape=(6, 12, n_elements), dtype=np.float64)
+    coords[:, :, :] = co[:, None, :]
+    for jj in range(6):
+        coords[jj, jj, :] += _steps[jj]
+        coords[jj, jj + 6, :] -= _steps[jj]
+
+    ptau = beta0 * coords[5]
+    delta = _delta_from_ptau(ptau, beta0)
+    track_function(coords, delta, ptau)
+
+    return np.transpose((coords[:, :6, :] - coords[:, 6:, :])
+                        / (2 * _steps[None, :, None]), (2, 0, 1))
+
+def _drift_matrices(elements, co, beta0, chi):
+    length = np.array([ee.length for ee in elements])
+    def track_function(coords, delta, ptau):
+        coords[0], coords[2], coords[4] = _drift_numpy(
+            x=coords[0], px=coords[1], y=coords[2], py=coords[3],
+            zeta=coords[4], delta=delta, ptau=ptau, beta0=beta0,
+            length=length[None, :])
+    return _numpy_map_matrices(co, beta0, track_function)
+
+def _multipole_matrices(elements, co, beta0, chi, ctx2np):
+    max_order = max(int(ee.order) for ee in elements)
+    knl = np.zeros(shape=(max_order + 1, len(elements)), dtype=np.float64)
+    ksl = np.zeros(shape=(max_order + 1, len(elements)), dtype=np.float64)
+    for ii, ee in enumerate(elements):
+        knl[:int(ee.order) + 1, ii] = ctx2np(ee.knl)
+        ksl[:int(ee.order) + 1, ii] = ctx2np(ee.ksl)
+    hxl = np.array([ee.hxl for ee in elements])
+    hyl = np.array([ee.hyl for ee in elements])
+    length = np.array([ee.length for ee in elements])
+    def track_function(coords, delta, ptau):
+        coords[1], coords[3], coords[4] = _multipole_numpy(
+            x=coords[0], px=coords[1], y=coords[2], py=coords[3],
+            zeta=coords[4], delta=delta, ptau=ptau, beta0=beta0, chi=chi,
+            knl=knl[:, None, :], ksl=ksl[:, None, :], hxl=hxl[None, :],
+            hyl=hyl[None, :], length=length[None, :])
+    return _numpy_map_matrices(co, beta0, track_function)
+
+def _srotation_matrices(elements, co, beta0, chi):
+    out = np.zeros(shape=(len(elements), 6, 6), dtype=np.float64)
+    for ii, ee in enumerate(elements):
+        cc = ee.cos_z
+        ss = ee.sin_z
+        out[ii, :, :] = np.eye(6)
+        out[ii, 0, 0] = cc
+        out[ii, 0, 2] = ss
+        out[ii, 2, 0] = -ss
+        out[ii, 2, 2] = cc
+        out[ii, 1, 1] = cc
+        out[ii, 1, 3] = ss
+        out[ii, 3, 1] = -ss
+        out[ii, 3, 3] = cc
+    return out
+
+def _identity_matrices(elements, co, beta0, chi):
+    return np.tile(np.eye(6), (len(elements), 1, 1))
+
+def _dipole_edge_matrices(elements, co, beta0, chi):
+    out = np.tile(np.eye(6), (len(elements), 1, 1))
+    out[:, 1, 0] = [ee.r21 for ee in elements]
+    out[:, 3, 2] = [ee.r43 for ee in elements]
+    return out
+
+def _tracked_matrix(tracker, i_element, co, particle_on_co):
+
+    # Finite differences through a single element of the tracker
+    beta0 = particle_on_co._xobject.beta0[0]
+    context = tracker._buffer.context
+    part_co = particle_on_co.copy(_context=context)
+    part_co.x = co[0]
+    part_co.px = co[1]
+    part_co.y = co[2]
+    part_co.py = co[3]
+    part_co.zeta = co[4]
+    part_co.delta = _delta_from_ptau(co[5] * beta0, beta0)
+
+    part = xp.build_particles(_context=context,
+            particle_ref=part_co, mode='shift',
+            x  =    [_steps[0],  0., 0.,  0., 0., 0., -_steps[0], 0., 0., 0., 0., 0.],
+            px =    [0., _steps[1], 0.,  0., 0., 0., 0., -_steps[1], 0., 0., 0., 0.],
+            y  =    [0.,  0., _steps[2],  0., 0., 0., 0., 0., -_steps[2], 0., 0., 0.],
+            py =    [0.,  0., 0., _steps[3], 0., 0., 0., 0., 0., -_steps[3], 0., 0.],
+            zeta =  [0.,  0., 0.,  0., _steps[4], 0., 0., 0., 0., 0., -_steps[4], 0.],
+            delta = [0.,  0., 0.,  0., 0., _steps[5], 0., 0., 0., 0., 0., -_steps[5]],
+            )
+    ctx2np = context.nparray_from_context_array
+    pzeta_in = ctx2np(part.ptau) / beta0
+    dpzeta = (pzeta_in[5] - pzeta_in[11]) / 2
+    tracker.track(part, ele_start=i_element, num_elements=1)
+
+    temp_mat = np.array([ctx2np(part.x), ctx2np(part.px), ctx2np(part.y),
+                         ctx2np(part.py), ctx2np(part.zeta),
+                         ctx2np(part.ptau) / beta0])
+    RR = np.zeros(shape=(6, 6), dtype=np.float64)
+    for jj, dd in enumerate(list(_steps[:5]) + [dpzeta]):
+        RR[:, jj] = (temp_mat[:, jj] - temp_mat[:, jj+6])/(2*dd)
+    return RR
+
+def _element_keys(tracker, i_elements, co, beta0, chi):
+    buffer = tracker._line_frozen._buffer
+    data = buffer.context.nparray_from_context_array(buffer.buffer)
+    elements = tracker.line.elements
+    co_rounded = np.round(co, 12)
+    keys = []
+    for kk, ii in enumerate(i_elements):
+        xobj = elements[ii]._xobject
+        keys.append((data[xobj._offset:xobj._offset + xobj._size].tobytes(),
+                     co_rounded[:, kk].tobytes(), beta0, chi))
+    return keys
+
+def get_element_transfer_matrices(tracker, i_elements, co, particle_on_co):
+
+    '''
+    Returns the transfer matrices, with shape (len(i_elements), 6, 6), of the
+    elements of index `i_elements` around the closed orbit `co` (shape
+    (6, len(i_elements)), in x, px, y, py, zeta, pzeta) at their entrance.
+    Matrices are cached on the tracker and recomputed only for elements whose
+    parameters or closed orbit have changed.
+    '''
+
+    ctx2np = tracker._buffer.context.nparray_from_context_array
+    beta0 = float(particle_on_co._xobject.beta0[0])
+    chi = float(particle_on_co._xobject.chi[0])
+
+    i_elements = np.array(i_elements, dtype=np.int64)
+    keys = _element_keys(tracker, i_elements, co, beta0, chi)
+    cache = tracker._element_matrix_cache
+
+    out = np.zeros(shape=(len(i_elements), 6, 6), dtype=np.float64)
+    to_compute = {}
+    for kk, (ii, key) in enumerate(zip(i_elements, keys)):
+        cached = cache.get(ii, None)
+        if cached is not None and cached[0] == key:
+            out[kk] = cached[1]
+            continue
+        ee = tracker.line.elements[ii]
+        if ee.__class__ is beam_elements.Drift:
+            group = 'drift'
+        elif (ee.__class__ is beam_elements.Multipole
+                and ee.radiation_flag == 0):
+            group = 'multipole'
+        elif ee.__class__ is beam_elements.SRotation:
+            group = 'srotation'
+        elif ee.__class__ in _identity_classes:
+            group = 'identity'
+        elif ee.__class__ is beam_elements.DipoleEdge:
+            group = 'dipole_edge'
+        else:
+            group = 'tracked'
+        to_compute.setdefault(group, []).append(kk)
+
+    for group, kks in to_compute.items():
+        kks = np.array(kks, dtype=np.int64)
+        elements = [tracker.line.elements[ii] for ii in i_elements[kks]]
+        co_group = co[:, kks]
+        if group == 'drift':
+            mats = _drift_matrices(elements, co_group, beta0, chi)
+        elif group == 'multipole':
+            mats = _multipole_matrices(elements, co_group, beta0, chi, ctx2np)
+        elif group == 'srotation':
+            mats = _srotation_matrices(elements, co_group, beta0, chi)
+        elif group == 'identity':
+            mats = _identity_matrices(elements, co_group, beta0, chi)
+        elif group == 'dipole_edge':
+            mats = _dipole_edge_matrices(elements, co_group, beta0, chi)
+        else:
+            mats = np.array([_tracked_matrix(tracker, ii, co_group[:, jj],
+                                             particle_on_co)
+                             for jj, ii in enumerate(i_elements[kks])])
+        for jj, kk in enumerate(kks):
+            out[kk] = mats[jj]
+            cache[i_elements[kk]] = (keys[kk], mats[jj])
+
+    return out
+
+def cumulative_matrix_products(matrices):
+
+    '''
+    Returns the products matrices[k] @ ... @ matrices[0] for all k, computed
+    with log2(n) batched matrix multiplications.
+    '''
+
+    out = np.array(matrices, dtype=np.float64)
+    shift = 1
+    while shift < len(out):
+        out[shift:] = np.matmul(out[shift:], out[:-shift])
+        shift *= 2
+    return out
+
+class TransferMatrixTree:
+
+    '''
+    Segment tree of transfer matrices. Leaf i holds the matrix of element i
+    and each node holds the product of the matrices of its children, such
+    that changing a few elements updates only O(log N) nodes and the map of
+    any section of the line is obtained from O(log N) nodes.
+    '''
+
+    def __init__(self, matrices):
+        matrices = np.array(matrices, dtype=np.float64)
+        self.num_elements = len(matrices)
+        size = 1
+        while size < self.num_elements:
+            size *= 2
+        self._size = size
+        self._nodes = np.tile(np.eye(6), (2 * size, 1, 1))
+        self._nodes[size:size + self.num_elements] = matrices
+
+        # Build one level at a time
+        level = size // 2
+        while level >= 1:
+            self._update_nodes(np.arange(level, 2 * level))
+            level //= 2
+
+    @property
+    def leaves(self):
+        return self._nodes[self._size:self._size + self.num_elements]
+
+    def _update_nodes(self, nodes):
+        # The right child follows the left child along the line
+        self._nodes[nodes] = np.matmul(self._nodes[2 * nodes + 1],
+                                       self._nodes[2 * nodes])
+
+    def update(self, indices, matrices):
+        indices = np.atleast_1d(np.array(indices, dtype=np.int64))
+        if len(indices) == 0:
+            return
+        nodes = indices + self._size
+        self._nodes[nodes] = matrices
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self._update_nodes(nodes)
+            nodes = np.unique(nodes // 2)
+
+    def section_matrix(self, i_start, i_stop):
+        # Matrix of the elements i_start, ..., i_stop - 1
+        left = np.eye(6)
+        right = np.eye(6)
+        lo = i_start + self._size
+        hi = i_stop + self._size
+        while lo < hi:
+            if lo & 1:
+                left = self._nodes[lo] @ left
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                right = right @ self._nodes[hi]
+            lo //= 2
+            hi //= 2
+        return right @ left
+
+    def one_turn_matrix_at(self, index):
+        return (self.section_matrix(0, index)
+                @ self.section_matrix(index, self.num_elements))
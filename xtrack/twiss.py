@@ -3,8 +3,10 @@
 # Copyright (c) CERN, 2021.                 #
 # ######################################### #
 
+import os
 import logging
 import warnings
+import multiprocessing
 from functools import partial
 from operator import ne
 import numpy as np
@@ -17,6 +19,9 @@ from scipy.constants import c as clight
 
 from . import linear_normal_form as lnf
 from .general import Table
+from .base_element import _get_lattice_version
+from .transfer_matrices import (_drift_numpy, get_element_transfer_matrices,
+                                cumulative_matrix_products, TransferMatrixTree)
 
 import xtrack as xt # To avoid circular imports
 
@@ -28,6 +33,9 @@ DEFAULT_STEPS_R_MATRIX = {
 
 DEFAULT_CO_SEARCH_TOL = [1e-12, 1e-12, 1e-12, 1e-12, 1e-5, 1e-12]
 
+# Coordinates recorded element by element to propagate the optics
+_optics_probe_fields = ('x', 'px', 'y', 'py', 'zeta', 'ptau', 's')
+
 log = logging.getLogger(__name__)
 
 
@@ -44,9 +52,20 @@ def twiss_from_tracker(tracker, particle_ref=None, method='6d',
         skip_global_quantities=False,
         matrix_responsiveness_tol=None,
         matrix_stability_tol=None,
-        symplectify=False):
+        symplectify=False,
+        engine='tracking',
+        only_global_quantities=False):
 
     assert method in ['6d', '4d'], 'Method must be `6d` or `4d`'
+    assert engine in ['tracking', 'matrix'], (
+        'Engine must be `tracking` or `matrix`')
+    if only_global_quantities:
+        assert not skip_global_quantities
+        assert at_s is None and at_elements is None
+        assert ele_start == 0 and ele_stop is None and twiss_init is None, (
+            'Global quantities are available only for the full ring')
+
+    use_cache = tracker.use_twiss_cache
 
     if matrix_responsiveness_tol is None:
         matrix_responsiveness_tol = tracker.matrix_responsiveness_tol
@@ -71,25 +90,112 @@ def twiss_from_tracker(tracker, particle_ref=None, method='6d',
     if method == '4d' and delta0 is None:
         delta0 = 0
 
+    if only_global_quantities and tracker._reference_tunes is None:
+        # The integer part of the tunes cannot be obtained from the one-turn
+        # matrix, it is taken from a full twiss computed once
+        kwargs = locals().copy()
+        kwargs.pop('tracker')
+        kwargs.pop('use_cache')
+        kwargs.pop('only_global_quantities')
+        twiss_from_tracker(tracker=tracker, **kwargs)
+
+    # Results are cached on the tracker and reused until the lattice is
+    # modified (see base_element._lattice_version and
+    # Tracker._get_lattice_fingerprint)
+    cache_key = None
+    R_matrix_guess = None
+    if use_cache and particle_on_co is None and R_matrix is None and (
+            W_matrix is None and particle_co_guess is None
+            and twiss_init is None):
+        cache_key = _twiss_cache_key(particle_ref=particle_ref, method=method,
+            delta0=delta0, r_sigma=r_sigma, nemitt_x=nemitt_x,
+            nemitt_y=nemitt_y, delta_disp=delta_disp, delta_chrom=delta_chrom,
+            steps_r_matrix=steps_r_matrix,
+            co_search_settings=co_search_settings, at_elements=at_elements,
+            at_s=at_s,
+            continue_on_closed_orbit_error=continue_on_closed_orbit_error,
+            values_at_element_exit=values_at_element_exit,
+            eneloss_and_damping=eneloss_and_damping,
+            skip_global_quantities=skip_global_quantities,
+            matrix_responsiveness_tol=matrix_responsiveness_tol,
+            matrix_stability_tol=matrix_stability_tol,
+            symplectify=symplectify, engine=engine,
+            only_global_quantities=only_global_quantities)
+    if cache_key is not None:
+        cache = tracker._twiss_cache
+        if cache is not None and cache['key'] == cache_key:
+            if (cache['lattice_version'] == _get_lattice_version()
+                and cache['lattice_fingerprint']
+                        == tracker._get_lattice_fingerprint()):
+                return _copy_twiss_table(cache['twiss_res'])
+            # The lattice has changed, the previous solution is used as
+            # starting point for the closed orbit search
+            particle_co_guess = cache['particle_on_co']
+            R_matrix_guess = cache['R_matrix']
+
     if at_s is not None:
         # Get all arguments
         kwargs = locals().copy()
         if np.isscalar(at_s):
             at_s = [at_s]
         assert at_elements is None
-        (auxtracker, names_inserted_markers
-            ) = _build_auxiliary_tracker_with_extra_markers(
-            tracker=tracker, at_s=at_s, marker_prefix='inserted_twiss_marker')
         kwargs.pop('tracker')
         kwargs.pop('at_s')
         kwargs.pop('at_elements')
         kwargs.pop('matrix_responsiveness_tol')
         kwargs.pop('matrix_stability_tol')
-        return twiss_from_tracker(tracker=auxtracker,
+        kwargs.pop('use_cache')
+        # The result is cached on this tracker, the auxiliary tracker below
+        # being rebuilt at each call
+        kwargs.pop('cache_key')
+        kwargs.pop('cache', None)
+        kwargs.pop('R_matrix_guess')
+
+        # Points in drifts are obtained by propagating analytically the
+        # optics computed at the element boundaries, the other points through
+        # an auxiliary tracker with markers inserted at those points only
+        names = [f'inserted_twiss_marker{ii}' for ii in range(len(at_s))]
+        i_ele_drift, ds_drift, mask_drift = _locate_points_in_drifts(
+                                                        tracker.line, at_s)
+        if not (ele_start == 0 and ele_stop is None
+                and not values_at_element_exit):
+            mask_drift[:] = False
+
+        if np.any(mask_drift):
+            tw = twiss_from_tracker(tracker=tracker,
+                        matrix_responsiveness_tol=matrix_responsiveness_tol,
+                        matrix_stability_tol=matrix_stability_tol,
+                        **kwargs)
+            twiss_res = _twiss_in_drifts(tw, i_ele=i_ele_drift[mask_drift],
+                ds=ds_drift[mask_drift],
+                names=[nn for nn, mm in zip(names, mask_drift) if mm],
+                method=method)
+
+        if not np.all(mask_drift):
+            i_aux = np.where(~mask_drift)[0]
+            (auxtracker, names_inserted_markers
+                ) = _build_auxiliary_tracker_with_extra_markers(
+                tracker=tracker, at_s=np.array(at_s)[i_aux],
+                marker_prefix='inserted_twiss_marker')
+            tw_aux = twiss_from_tracker(tracker=auxtracker,
                         at_elements=names_inserted_markers,
                         matrix_responsiveness_tol=matrix_responsiveness_tol,
                         matrix_stability_tol=matrix_stability_tol,
                         **kwargs)
+            # The markers are numbered within the subset of points, they are
+            # renamed after the index of the points in `at_s`
+            i_aux = i_aux[[names_inserted_markers.index(nn)
+                           for nn in tw_aux.name]]
+            tw_aux['name'] = tuple(names[ii] for ii in i_aux)
+            if np.any(mask_drift):
+                twiss_res = _merge_twiss_at_points(
+                    twiss_res, np.where(mask_drift)[0], tw_aux, i_aux)
+            else:
+                twiss_res = tw_aux
+        if cache_key is not None and 'R_matrix' in twiss_res.keys():
+            _store_twiss_cache(tracker, cache_key, twiss_res,
+                               twiss_res.particle_on_co, twiss_res.R_matrix)
+        return twiss_res
 
     mux0 = 0
     muy0 = 0
@@ -127,7 +233,7 @@ def twiss_from_tracker(tracker, particle_ref=None, method='6d',
                                 particle_ref=particle_ref,
                                 co_search_settings=co_search_settings,
                                 continue_on_closed_orbit_error=continue_on_closed_orbit_error,
-                                delta0=delta0)
+                                delta0=delta0, R_matrix_guess=R_matrix_guess)
 
     if W_matrix is not None:
         W = W_matrix
@@ -147,39 +253,52 @@ def twiss_from_tracker(tracker, particle_ref=None, method='6d',
                                 stability_tol=matrix_stability_tol)
 
     if method == '4d' and W_matrix is None: # the matrix was not provided by the user
-        p_disp_minus = tracker.find_closed_orbit(
+        # Both off-momentum closed orbits are searched at once starting from
+        # the on-momentum one
+        p_disp = _find_closed_orbits_4d_batched(tracker,
+                            particle_on_co=part_on_co,
+                            delta0_values=[delta0-delta_disp, delta0+delta_disp])
+        if p_disp is not None:
+            p_disp_minus, p_disp_plus = p_disp
+        else:
+            p_disp_minus = tracker.find_closed_orbit(
                             particle_co_guess=particle_co_guess,
                             particle_ref=particle_ref,
                             co_search_settings=co_search_settings,
                             continue_on_closed_orbit_error=continue_on_closed_orbit_error,
-                            delta0=delta0-delta_disp)
-        p_disp_plus = tracker.find_closed_orbit(particle_co_guess=particle_co_guess,
+                            delta0=delta0-delta_disp,
+                            R_matrix_guess=R_matrix_guess)
+            p_disp_plus = tracker.find_closed_orbit(particle_co_guess=particle_co_guess,
                             particle_ref=particle_ref,
                             co_search_settings=co_search_settings,
                             continue_on_closed_orbit_error=continue_on_closed_orbit_error,
-                            delta0=delta0+delta_disp)
-        p_disp_minus.move(_context=xo.context_default)
-        p_disp_plus.move(_context=xo.context_default)
-        dx_dpzeta = ((p_disp_plus.x[0] - p_disp_minus.x[0])
-                     /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/part_on_co._xobject.beta0[0]
-        dpx_dpzeta = ((p_disp_plus.px[0] - p_disp_minus.px[0])
-                     /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/part_on_co._xobject.beta0[0]
-        dy_dpzeta = ((p_disp_plus.y[0] - p_disp_minus.y[0])
-                     /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/part_on_co._xobject.beta0[0]
-        dpy_dpzeta = ((p_disp_plus.py[0] - p_disp_minus.py[0])
-                      /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/part_on_co._xobject.beta0[0]
-
-        W[4:, :] = 0
-        W[:, 4:] = 0
-        W[4, 4] = 1
-        W[5, 5] = 1
-        W[0, 5] = dx_dpzeta
-        W[1, 5] = dpx_dpzeta
-        W[2, 5] = dy_dpzeta
-        W[3, 5] = dpy_dpzeta
-
-
-    twiss_res_element_by_element = _propagate_optics(
+                            delta0=delta0+delta_disp,
+                            R_matrix_guess=R_matrix_guess)
+        W = _W_matrix_4d(W, p_disp_minus=p_disp_minus,
+                         p_disp_plus=p_disp_plus,
+                         beta0=part_on_co._xobject.beta0[0])
+
+    if only_global_quantities:
+        if RR is None:
+            RR = tracker.compute_one_turn_matrix_finite_differences(
+                                                steps_r_matrix=steps_r_matrix,
+                                                particle_on_co=part_on_co)
+        twiss_res = _compute_global_quantities(tracker=tracker,
+            W_matrix=W, R_matrix=RR, particle_on_co=part_on_co, method=method,
+            delta_chrom=delta_chrom, nemitt_x=nemitt_x, nemitt_y=nemitt_y,
+            matrix_responsiveness_tol=matrix_responsiveness_tol,
+            matrix_stability_tol=matrix_stability_tol,
+            symplectify=symplectify, steps_r_matrix=steps_r_matrix)
+        if cache_key is not None:
+            _store_twiss_cache(tracker, cache_key, twiss_res, part_on_co,
+                               RR)
+        return twiss_res
+
+    if engine == 'matrix':
+        propagate_optics = _propagate_optics_with_matrices
+    else:
+        propagate_optics = _propagate_optics
+    twiss_res_element_by_element = propagate_optics(
         tracker=tracker,
         W_matrix=W,
         particle_on_co=part_on_co,
@@ -237,6 +356,7 @@ def twiss_from_tracker(tracker, particle_ref=None, method='6d',
             twiss_res['particle_on_co']._fsolve_info = None
 
         twiss_res['R_matrix'] = RR
+        tracker._reference_tunes = (mux[-1], muy[-1])
 
         if method == '4d':
             twiss_res.qs = 0
@@ -258,11 +378,265 @@ def twiss_from_tracker(tracker, particle_ref=None, method='6d',
     if at_elements is not None:
         twiss_res._keep_only_elements(at_elements)
 
+    if cache_key is not None and RR is not None:
+        _store_twiss_cache(tracker, cache_key, twiss_res, part_on_co, RR)
+
+    return twiss_res
+
+def _store_twiss_cache(tracker, cache_key, twiss_res, particle_on_co,
+                       R_matrix):
+    # The version is read after the computation, as building auxiliary
+    # trackers (e.g. for `at_s`) creates new elements
+    tracker._twiss_cache = {
+        'key': cache_key,
+        'lattice_version': _get_lattice_version(),
+        'lattice_fingerprint': tracker._get_lattice_fingerprint(),
+        'twiss_res': _copy_twiss_table(twiss_res),
+        'particle_on_co': particle_on_co.copy(_context=xo.context_default),
+        'R_matrix': R_matrix}
+
+def _compute_global_quantities(tracker, W_matrix, R_matrix, particle_on_co,
+                               method, delta_chrom, nemitt_x, nemitt_y,
+                               matrix_responsiveness_tol, matrix_stability_tol,
+                               symplectify, steps_r_matrix):
+
+    # Tunes, chromaticities and slip factor from the one-turn matrices only,
+    # without propagating the optics element by element
+
+    _, _, Rot = lnf.compute_linear_normal_form(R_matrix,
+                                only_4d_block=(method == '4d'),
+                                symplectify=symplectify,
+                                responsiveness_tol=matrix_responsiveness_tol,
+                                stability_tol=matrix_stability_tol)
+
+    # The fractional tunes are the phases of the normal form, the integer
+    # part is the one closest to the previously computed tunes
+    qx_ref, qy_ref = tracker._reference_tunes
+    qx_frac = np.mod(np.arctan2(Rot[0, 1], Rot[0, 0])/(2*np.pi), 1)
+    qy_frac = np.mod(np.arctan2(Rot[2, 3], Rot[2, 2])/(2*np.pi), 1)
+    qx = np.round(qx_ref - qx_frac) + qx_frac
+    qy = np.round(qy_ref - qy_frac) + qy_frac
+    tracker._reference_tunes = (qx, qy)
+    if method == '4d':
+        qs = 0
+    else:
+        qs = np.abs(np.arctan2(Rot[4, 5], Rot[4, 4]))/(2*np.pi)
+
+    dqx, dqy = _compute_chromaticity(
+        tracker=tracker,
+        W_matrix=W_matrix, method=method,
+        particle_on_co=particle_on_co,
+        delta_chrom=delta_chrom,
+        tune_x=qx, tune_y=qy,
+        nemitt_x=nemitt_x, nemitt_y=nemitt_y,
+        matrix_responsiveness_tol=matrix_responsiveness_tol,
+        matrix_stability_tol=matrix_stability_tol,
+        symplectify=symplectify, steps_r_matrix=steps_r_matrix)
+
+    # Path lengthening over one turn on the periodic dispersion (first order,
+    # the last coordinate of the R matrix is pzeta)
+    RR = R_matrix
+    disp = np.linalg.solve(np.eye(4) - RR[:4, :4], RR[:4, 5])
+    dzeta = RR[4, 5] + np.dot(RR[4, :4], disp)
+
+    circumference = tracker.line.get_length()
+    eta = -dzeta/circumference
+    alpha = eta + 1/particle_on_co._xobject.gamma0[0]**2
+
+    beta0 = particle_on_co._xobject.beta0[0]
+    T_rev = circumference/clight/beta0
+    betz0 = W_matrix[4, 4]**2 + W_matrix[4, 5]**2
+
+    twiss_res = TwissTable()
+    twiss_res.update({
+        'qx': qx, 'qy': qy, 'qs': qs, 'dqx': dqx, 'dqy': dqy,
+        'slip_factor': eta, 'momentum_compaction_factor': alpha,
+        'betz0': betz0, 'circumference': circumference, 'T_rev': T_rev,
+        'particle_on_co': particle_on_co.copy(_context=xo.context_default),
+        'R_matrix': R_matrix,
+    })
+    if hasattr(particle_on_co, '_fsolve_info'):
+        twiss_res['particle_on_co']._fsolve_info = particle_on_co._fsolve_info
+    else:
+        twiss_res['particle_on_co']._fsolve_info = None
+    twiss_res._ebe_fields = []
+
     return twiss_res
 
+def twiss_delta_scan_from_tracker(tracker, deltas, particle_ref=None,
+        r_sigma=0.01, nemitt_x=1e-6, nemitt_y=1e-6, delta_disp=1e-5,
+        steps_r_matrix=None, matrix_responsiveness_tol=None,
+        matrix_stability_tol=None, symplectify=False):
 
+    # 4d twiss for several momentum offsets. The closed orbits, the one-turn
+    # matrices and the element-by-element propagation are computed for all
+    # the momenta together, each with a single batch of particles.
 
+    if matrix_responsiveness_tol is None:
+        matrix_responsiveness_tol = tracker.matrix_responsiveness_tol
+    if matrix_stability_tol is None:
+        matrix_stability_tol = tracker.matrix_stability_tol
 
+    if particle_ref is None and hasattr(tracker, 'particle_ref'):
+        particle_ref = tracker.particle_ref
+
+    if tracker.iscollective:
+        warnings.warn(
+            'The tracker has collective elements.\n'
+            'In the twiss computation collective elements are'
+            ' replaced by drifts')
+        tracker = tracker._supertracker
+
+    if particle_ref is None:
+        raise ValueError("`particle_ref` must be provided")
+
+    deltas = np.atleast_1d(np.array(deltas, dtype=np.float64))
+    n_deltas = len(deltas)
+
+    # Closed orbits at the requested momenta and at the points used for the
+    # dispersion
+    delta0_values = np.concatenate(
+                    [deltas, deltas - delta_disp, deltas + delta_disp])
+    particle_co_guess = particle_ref.copy()
+    particle_co_guess.x = 0
+    particle_co_guess.px = 0
+    particle_co_guess.y = 0
+    particle_co_guess.py = 0
+    particle_co_guess.zeta = 0
+    particle_co_guess.delta = 0
+    particle_co_guess.s = 0
+    particle_co_guess.at_element = 0
+    particle_co_guess.at_turn = 0
+    parts_co = _find_closed_orbits_4d_batched(tracker,
+                particle_on_co=particle_co_guess, delta0_values=delta0_values)
+    if parts_co is None:
+        parts_co = [tracker.find_closed_orbit(particle_ref=particle_ref,
+                                              delta0=dd)
+                    for dd in delta0_values]
+    parts_on_co = parts_co[:n_deltas]
+    parts_disp_minus = parts_co[n_deltas:2*n_deltas]
+    parts_disp_plus = parts_co[2*n_deltas:]
+
+    RRs = _compute_one_turn_matrices_finite_differences(tracker,
+                        particles_on_co=parts_on_co,
+                        steps_r_matrix=steps_r_matrix)
+
+    parts_for_twiss = []
+    for ii in range(n_deltas):
+        W, _, _ = lnf.compute_linear_normal_form(
+                                RRs[ii], only_4d_block=True,
+                                symplectify=symplectify,
+                                responsiveness_tol=matrix_responsiveness_tol,
+                                stability_tol=matrix_stability_tol)
+        W = _W_matrix_4d(W, p_disp_minus=parts_disp_minus[ii],
+                         p_disp_plus=parts_disp_plus[ii],
+                         beta0=parts_on_co[ii]._xobject.beta0[0])
+        part_for_twiss, scale_eigen = _build_optics_probe_particles(
+            tracker=tracker, W_matrix=W, particle_on_co=parts_on_co[ii],
+            nemitt_x=nemitt_x, nemitt_y=nemitt_y, r_sigma=r_sigma,
+            delta_disp=delta_disp)
+        parts_for_twiss.append(part_for_twiss)
+    n_probe = parts_for_twiss[0]._capacity
+
+    if n_deltas > 1:
+        part_for_twiss = xp.Particles.merge(parts_for_twiss)
+    else:
+        part_for_twiss = parts_for_twiss[0]
+    rec, i_start, i_stop = _track_optics_probe_particles(
+        tracker=tracker, part_for_twiss=part_for_twiss,
+        ele_start=0, ele_stop=None)
+
+    res_ebe = [_optics_from_probe_record(tracker=tracker,
+                    rec=rec[:, ii*n_probe:(ii+1)*n_probe, :],
+                    beta0=parts_on_co[ii]._xobject.beta0[0],
+                    scale_eigen=scale_eigen, mux0=0, muy0=0, muzeta0=0,
+                    i_start=i_start, i_stop=i_stop)
+               for ii in range(n_deltas)]
+
+    # Element-by-element quantities have shape (n_deltas, n_points)
+    twiss_res = TwissTable()
+    for nn in res_ebe[0].keys():
+        if nn == 'name':
+            twiss_res[nn] = res_ebe[0][nn]
+        else:
+            twiss_res[nn] = np.array([rr[nn] for rr in res_ebe])
+    twiss_res._ebe_fields = res_ebe[0].keys()
+    twiss_res.muzeta[:] = 0
+
+    twiss_res['delta0'] = deltas
+    twiss_res['qx'] = twiss_res.mux[:, -1]
+    twiss_res['qy'] = twiss_res.muy[:, -1]
+    twiss_res['circumference'] = tracker.line.get_length()
+    twiss_res['R_matrix'] = np.array(RRs)
+    twiss_res['values_at'] = 'entry'
+
+    return twiss_res
+
+def _hashable_twiss_arg(vv):
+    if vv is None or isinstance(vv, (bool, int, float, str)):
+        return vv
+    if isinstance(vv, np.ndarray):
+        return tuple(vv.tolist())
+    if isinstance(vv, (list, tuple)):
+        return tuple(_hashable_twiss_arg(ii) for ii in vv)
+    if isinstance(vv, dict):
+        return tuple(sorted((kk, _hashable_twiss_arg(ii))
+                            for kk, ii in vv.items()))
+    raise TypeError(f'Cannot build a cache key from {type(vv)}')
+
+_particle_ref_key_fields = ('p0c', 'mass0', 'q0', 'x', 'px', 'y', 'py',
+                            'zeta', 'delta', 's', 'chi', 'charge_ratio')
+
+def _twiss_cache_key(particle_ref, **kwargs):
+    # Returns None if the arguments cannot be used as a cache key
+    if particle_ref is None:
+        return None
+    try:
+        key = tuple(sorted((kk, _hashable_twiss_arg(vv))
+                           for kk, vv in kwargs.items()))
+    except TypeError:
+        return None
+    # mass0 and q0 are scalars
+    ref = tuple(float(np.atleast_1d(getattr(particle_ref._xobject, nn))[0])
+                for nn in _particle_ref_key_fields)
+    return (ref, key)
+
+def _copy_twiss_table(twiss_res):
+    out = TwissTable()
+    for kk, vv in twiss_res.items():
+        if isinstance(vv, (np.ndarray, list)):
+            vv = vv.copy()
+        out[kk] = vv
+    return out
+
+
+
+
+
+def _W_matrix_4d(W, p_disp_minus, p_disp_plus, beta0):
+    # Decouples the longitudinal plane and introduces the dispersion obtained
+    # from the two off-momentum closed orbits
+    p_disp_minus.move(_context=xo.context_default)
+    p_disp_plus.move(_context=xo.context_default)
+    dx_dpzeta = ((p_disp_plus.x[0] - p_disp_minus.x[0])
+                 /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/beta0
+    dpx_dpzeta = ((p_disp_plus.px[0] - p_disp_minus.px[0])
+                 /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/beta0
+    dy_dpzeta = ((p_disp_plus.y[0] - p_disp_minus.y[0])
+                 /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/beta0
+    dpy_dpzeta = ((p_disp_plus.py[0] - p_disp_minus.py[0])
+                  /(p_disp_plus.ptau[0] - p_disp_minus.ptau[0]))/beta0
+
+    W[4:, :] = 0
+    W[:, 4:] = 0
+    W[4, 4] = 1
+    W[5, 5] = 1
+    W[0, 5] = dx_dpzeta
+    W[1, 5] = dpx_dpzeta
+    W[2, 5] = dy_dpzeta
+    W[3, 5] = dpy_dpzeta
+
+    return W
 
 def _propagate_optics(tracker, W_matrix, particle_on_co,
                       mux0, muy0, muzeta0,
@@ -271,8 +645,199 @@ def _propagate_optics(tracker, W_matrix, particle_on_co,
                       matrix_responsiveness_tol, matrix_stability_tol,
                       symplectify):
 
+    part_for_twiss, scale_eigen = _build_optics_probe_particles(
+        tracker=tracker, W_matrix=W_matrix, particle_on_co=particle_on_co,
+        nemitt_x=nemitt_x, nemitt_y=nemitt_y, r_sigma=r_sigma,
+        delta_disp=delta_disp)
+
+    rec, i_start, i_stop = _track_optics_probe_particles(
+        tracker=tracker, part_for_twiss=part_for_twiss,
+        ele_start=ele_start, ele_stop=ele_stop)
+
+    return _optics_from_probe_record(tracker=tracker, rec=rec,
+        beta0=particle_on_co._xobject.beta0[0], scale_eigen=scale_eigen,
+        mux0=mux0, muy0=muy0, muzeta0=muzeta0,
+        i_start=i_start, i_stop=i_stop)
+
+def _propagate_optics_with_matrices(tracker, W_matrix, particle_on_co,
+                      mux0, muy0, muzeta0,
+                      ele_start, ele_stop,
+                      nemitt_x, nemitt_y, r_sigma, delta_disp,
+                      matrix_responsiveness_tol, matrix_stability_tol,
+                      symplectify):
+
+    # Only the closed orbit is tracked element by element. The probe
+    # particles are propagated with the linear transfer matrices of the
+    # elements.
+
     ctx2np = tracker._context.nparray_from_context_array
 
+    part_for_twiss, scale_eigen = _build_optics_probe_particles(
+        tracker=tracker, W_matrix=W_matrix, particle_on_co=particle_on_co,
+        nemitt_x=nemitt_x, nemitt_y=nemitt_y, r_sigma=r_sigma,
+        delta_disp=delta_disp)
+    beta0 = particle_on_co._xobject.beta0[0]
+    coords_start = np.array([ctx2np(part_for_twiss.x),
+                             ctx2np(part_for_twiss.px),
+                             ctx2np(part_for_twiss.y),
+                             ctx2np(part_for_twiss.py),
+                             ctx2np(part_for_twiss.zeta),
+                             ctx2np(part_for_twiss.ptau) / beta0])
+    offsets_start = coords_start - coords_start[:, 6:7] # 6: closed orbit
+
+    part_co = particle_on_co.copy(_context=tracker._context)
+    part_co.s = particle_on_co._xobject.s[0]
+    part_co.at_element = particle_on_co._xobject.at_element[0]
+    rec_co, i_start, i_stop = _track_optics_probe_particles(
+        tracker=tracker, part_for_twiss=part_co,
+        ele_start=ele_start, ele_stop=ele_stop)
+    rec_co = rec_co[:, 0, :]
+
+    n_points = rec_co.shape[1]
+    i_elements = (i_start + np.arange(n_points - 1)) % len(tracker.line.elements)
+    co = rec_co[:6, :-1].copy()
+    co[5] /= beta0 # pzeta
+    matrices = get_element_transfer_matrices(tracker, i_elements=i_elements,
+                                    co=co, particle_on_co=particle_on_co)
+    RR_cumulative = np.zeros(shape=(n_points, 6, 6), dtype=np.float64)
+    RR_cumulative[0] = np.eye(6)
+    RR_cumulative[1:] = cumulative_matrix_products(matrices)
+
+    # Shape (n_points, 6, n_particles)
+    offsets = np.matmul(RR_cumulative, offsets_start)
+
+    # Same layout as the record of the tracked probe particles
+    rec = np.zeros(shape=(rec_co.shape[0], offsets_start.shape[1], n_points),
+                   dtype=np.float64)
+    rec[:, :, :] = rec_co[:, None, :]
+    rec[:5, :, :] += np.transpose(offsets[:, :5, :], (1, 2, 0))
+    rec[5, :, :] += beta0 * offsets[:, 5, :].T
+
+    return _optics_from_probe_record(tracker=tracker, rec=rec,
+        beta0=beta0, scale_eigen=scale_eigen,
+        mux0=mux0, muy0=muy0, muzeta0=muzeta0,
+        i_start=i_start, i_stop=i_stop)
+
+def one_turn_matrix_from_element_matrices(tracker, element_index,
+                                          particle_on_co=None, co_tol=1e-9):
+
+    # The one-turn matrix is obtained from the segment tree of the element
+    # matrices kept by the tracker. At each call the element data in the
+    # buffer is compared with a snapshot taken at the previous call (which
+    # also catches in-place writes of array items, not counted by
+    # base_element._lattice_version) and only the leaves of the elements
+    # whose data has changed are updated.
+    #
+    # The matrices are linearized around the closed orbit found at the first
+    # call. Without `particle_on_co` this orbit is kept after lattice changes
+    # (the change of the matrices of unchanged elements due to the orbit
+    # shift is neglected) and no tracking is done. With `particle_on_co`, the
+    # orbit is tracked again if the lattice or the orbit at the start have
+    # changed, and the elements where it moved by more than `co_tol` are
+    # linearized again.
+
+    state = tracker._transfer_matrix_tree_state
+    num_elements = len(tracker.line.elements)
+    if state is not None and state['tree'].num_elements != num_elements:
+        state = None
+
+    if particle_on_co is not None:
+        if particle_on_co._xobject.at_element[0] != 0:
+            raise ValueError('`particle_on_co` must be at the start of the '
+                             'line (at_element 0)')
+
+    ctx2np = tracker._buffer.context.nparray_from_context_array
+    data = ctx2np(tracker._buffer.buffer)
+
+    if state is None:
+        if particle_on_co is None:
+            cache = tracker._twiss_cache
+            particle_on_co = tracker.find_closed_orbit(
+                particle_co_guess=(cache['particle_on_co'] if cache else None),
+                R_matrix_guess=(cache['R_matrix'] if cache else None))
+        co = _co_along_line(tracker, particle_on_co)
+        matrices = get_element_transfer_matrices(tracker,
+                            i_elements=np.arange(num_elements),
+                            co=co, particle_on_co=particle_on_co)
+
+        # Elements sharing the same data are updated together
+        ele_offset = np.array([ee._xobject._offset
+                               for ee in tracker.line.elements], dtype=np.int64)
+        ele_size = np.array([ee._xobject._size
+                             for ee in tracker.line.elements], dtype=np.int64)
+        offsets, i_unique, i_inverse = np.unique(ele_offset,
+                                        return_index=True, return_inverse=True)
+        ranges = tracker._get_element_byte_ranges()
+        tracker._transfer_matrix_tree_state = {
+            'tree': TransferMatrixTree(matrices),
+            'co': co,
+            'particle_on_co': particle_on_co.copy(_context=xo.context_default),
+            'ranges': ranges,
+            'snapshot': [data[i_start:i_end].copy()
+                         for i_start, i_end in ranges],
+            'offsets': offsets,
+            'offset_end': offsets + ele_size[i_unique],
+            'elements_at_offset': i_inverse}
+        return tracker._transfer_matrix_tree_state['tree'].one_turn_matrix_at(
+                                                                element_index)
+
+    # Elements whose data has changed since the previous call
+    dirty = np.zeros(num_elements, dtype=bool)
+    for (i_start, i_end), snapshot in zip(state['ranges'], state['snapshot']):
+        current = data[i_start:i_end]
+        if np.array_equal(current, snapshot):
+            continue
+        i_changed = np.nonzero(current != snapshot)[0] + i_start
+        i_pos = np.searchsorted(state['offsets'], i_changed, side='right') - 1
+        valid = i_pos >= 0
+        i_pos = i_pos[valid]
+        i_pos = np.unique(i_pos[i_changed[valid] < state['offset_end'][i_pos]])
+        dirty[np.isin(state['elements_at_offset'], i_pos)] = True
+        snapshot[:] = current
+
+    if particle_on_co is not None:
+        co_start = state['co'][:, 0]
+        if (np.any(dirty) or np.any(np.abs(
+                _co_at_start(particle_on_co) - co_start) > co_tol)):
+            co = _co_along_line(tracker, particle_on_co)
+            dirty |= np.any(np.abs(co - state['co']) > co_tol, axis=0)
+            state['co'][:, dirty] = co[:, dirty]
+            state['particle_on_co'] = particle_on_co.copy(
+                                                _context=xo.context_default)
+
+    i_dirty = np.where(dirty)[0]
+    if len(i_dirty) > 0:
+        state['tree'].update(i_dirty, get_element_transfer_matrices(tracker,
+                        i_elements=i_dirty, co=state['co'][:, i_dirty],
+                        particle_on_co=state['particle_on_co']))
+
+    return state['tree'].one_turn_matrix_at(element_index)
+
+def _co_at_start(particle_on_co):
+    # Closed orbit in (x, px, y, py, zeta, pzeta)
+    ctx2np = particle_on_co._buffer.context.nparray_from_context_array
+    beta0 = particle_on_co._xobject.beta0[0]
+    return np.array([ctx2np(getattr(particle_on_co, nn))[0]
+                     for nn in ['x', 'px', 'y', 'py', 'zeta']]
+                    + [ctx2np(particle_on_co.ptau)[0] / beta0])
+
+def _co_along_line(tracker, particle_on_co):
+    # Closed orbit in (x, px, y, py, zeta, pzeta) at the entrance of each
+    # element, shape (6, n_elements)
+    beta0 = particle_on_co._xobject.beta0[0]
+    part_co = particle_on_co.copy(_context=tracker._context)
+    rec_co, _, _ = _track_optics_probe_particles(
+        tracker=tracker, part_for_twiss=part_co, ele_start=0, ele_stop=None)
+    co = rec_co[:6, 0, :-1].copy()
+    co[5] /= beta0 # pzeta
+    return co
+
+def _build_optics_probe_particles(tracker, W_matrix, particle_on_co,
+                                  nemitt_x, nemitt_y, r_sigma, delta_disp):
+
+    # Returns 9 particles: 6 along the eigenvectors, the closed orbit and two
+    # off-momentum particles for the dispersion
+
     gemitt_x = nemitt_x/particle_on_co._xobject.beta0[0]/particle_on_co._xobject.gamma0[0]
     gemitt_y = nemitt_y/particle_on_co._xobject.beta0[0]/particle_on_co._xobject.gamma0[0]
     scale_transverse_x = np.sqrt(gemitt_x)*r_sigma
@@ -304,79 +869,64 @@ def _propagate_optics(tracker, W_matrix, particle_on_co,
     part_for_twiss = xp.Particles.merge([part_for_twiss, part_disp])
     part_for_twiss.s = particle_on_co._xobject.s[0]
     part_for_twiss.at_element = particle_on_co._xobject.at_element[0]
+
+    return part_for_twiss, scale_eigen
+
+def _track_optics_probe_particles(tracker, part_for_twiss, ele_start, ele_stop):
+
+    if tracker._at_element_steps is not None:
+        raise NotImplementedError('Element-by-element twiss is not available '
+                                  'for optimized lines')
+
+    ctx2np = tracker._context.nparray_from_context_array
+
+    # The probe identifies the particles by their id
+    part_for_twiss.particle_id = tracker._context.nparray_to_context_array(
+                        np.arange(part_for_twiss._capacity, dtype=np.int64))
+
     i_start = part_for_twiss._xobject.at_element[0]
 
     assert np.all(ctx2np(part_for_twiss.at_turn) == 0)
-    tracker.track(part_for_twiss, turn_by_turn_monitor='ONE_TURN_EBE',
+
+    # Element-by-element probe recording only the coordinates needed here
+    probe = xt.CompactParticlesMonitor(_context=tracker._context,
+                fields=_optics_probe_fields,
+                turns=np.arange(len(tracker.line.element_names) + 1),
+                particle_id_range=(0, part_for_twiss._capacity),
+                ebe_mode=True)
+    tracker.track(part_for_twiss, turn_by_turn_monitor=probe,
                   ele_start=ele_start, ele_stop=ele_stop)
     assert np.all(ctx2np(part_for_twiss.state) == 1), (
         'Some test particles were lost during twiss!')
     i_stop = part_for_twiss._xobject.at_element[0] + (
         part_for_twiss._xobject.at_turn[0] * len(tracker.line.element_names))
 
-    x_co = tracker.record_last_track.x[6, i_start:i_stop+1].copy()
-    y_co = tracker.record_last_track.y[6, i_start:i_stop+1].copy()
-    px_co = tracker.record_last_track.px[6, i_start:i_stop+1].copy()
-    py_co = tracker.record_last_track.py[6, i_start:i_stop+1].copy()
-    zeta_co = tracker.record_last_track.zeta[6, i_start:i_stop+1].copy()
-    delta_co = tracker.record_last_track.delta[6, i_start:i_stop+1].copy()
-    ptau_co = tracker.record_last_track.ptau[6, i_start:i_stop+1].copy()
-    s_co = tracker.record_last_track.s[6, i_start:i_stop+1].copy()
-
-    x_disp_minus = tracker.record_last_track.x[7, i_start:i_stop+1].copy()
-    y_disp_minus = tracker.record_last_track.y[7, i_start:i_stop+1].copy()
-    zeta_disp_minus = tracker.record_last_track.zeta[7, i_start:i_stop+1].copy()
-    px_disp_minus = tracker.record_last_track.px[7, i_start:i_stop+1].copy()
-    py_disp_minus = tracker.record_last_track.py[7, i_start:i_stop+1].copy()
-    delta_disp_minus = tracker.record_last_track.delta[7, i_start:i_stop+1].copy()
-
-    x_disp_plus = tracker.record_last_track.x[8, i_start:i_stop+1].copy()
-    y_disp_plus = tracker.record_last_track.y[8, i_start:i_stop+1].copy()
-    zeta_disp_plus = tracker.record_last_track.zeta[8, i_start:i_stop+1].copy()
-    px_disp_plus = tracker.record_last_track.px[8, i_start:i_stop+1].copy()
-    py_disp_plus = tracker.record_last_track.py[8, i_start:i_stop+1].copy()
-    delta_disp_plus = tracker.record_last_track.delta[8, i_start:i_stop+1].copy()
-
-    dx = (x_disp_plus-x_disp_minus)/(delta_disp_plus - delta_disp_minus)
-    dy = (y_disp_plus-y_disp_minus)/(delta_disp_plus - delta_disp_minus)
-    dzeta = (zeta_disp_plus-zeta_disp_minus)/(delta_disp_plus - delta_disp_minus)
-    dpx = (px_disp_plus-px_disp_minus)/(delta_disp_plus - delta_disp_minus)
-    dpy = (py_disp_plus-py_disp_minus)/(delta_disp_plus - delta_disp_minus)
+    # Shape (n_fields, n_particles, n_points)
+    rec = np.array([getattr(probe, nn)[:, i_start:i_stop+1]
+                    for nn in _optics_probe_fields])
 
-    Ws = np.zeros(shape=(len(s_co), 6, 6), dtype=np.float64)
-    Ws[:, 0, :] = (tracker.record_last_track.x[:6, i_start:i_stop+1] - x_co).T / scale_eigen
-    Ws[:, 1, :] = (tracker.record_last_track.px[:6, i_start:i_stop+1] - px_co).T / scale_eigen
-    Ws[:, 2, :] = (tracker.record_last_track.y[:6, i_start:i_stop+1] - y_co).T / scale_eigen
-    Ws[:, 3, :] = (tracker.record_last_track.py[:6, i_start:i_stop+1] - py_co).T / scale_eigen
-    Ws[:, 4, :] = (tracker.record_last_track.zeta[:6, i_start:i_stop+1] - zeta_co).T / scale_eigen
-    Ws[:, 5, :] = (tracker.record_last_track.ptau[:6, i_start:i_stop+1] - ptau_co).T / particle_on_co._xobject.beta0[0] / scale_eigen
+    return rec, i_start, i_stop
 
-    # Rotate eigenvectors to the Courant-Snyder basis
-    phix = np.arctan2(Ws[:, 0, 1], Ws[:, 0, 0])
-    phiy = np.arctan2(Ws[:, 2, 3], Ws[:, 2, 2])
-    phizeta = np.arctan2(Ws[:, 4, 5], Ws[:, 4, 4])
-    v1 = Ws[:, :, 0] + 1j * Ws[:, :, 1]
-    v2 = Ws[:, :, 2] + 1j * Ws[:, :, 3]
-    v3 = Ws[:, :, 4] + 1j * Ws[:, :, 5]
-    for ii in range(6):
-        v1[:, ii] *= np.exp(-1j * phix)
-        v2[:, ii] *= np.exp(-1j * phiy)
-        v3[:, ii] *= np.exp(-1j * phizeta)
-    Ws[:, :, 0] = np.real(v1)
-    Ws[:, :, 1] = np.imag(v1)
-    Ws[:, :, 2] = np.real(v2)
-    Ws[:, :, 3] = np.imag(v2)
-    Ws[:, :, 4] = np.real(v3)
-    Ws[:, :, 5] = np.imag(v3)
+def _optics_from_probe_record(tracker, rec, beta0, scale_eigen,
+                              mux0, muy0, muzeta0, i_start, i_stop):
 
-    betx = Ws[:, 0, 0]**2 + Ws[:, 0, 1]**2
-    bety = Ws[:, 2, 2]**2 + Ws[:, 2, 3]**2
+    ptau = rec[5]
+    delta = np.sqrt(ptau**2 + 2*ptau/beta0 + 1) - 1
 
-    gamx = Ws[:, 1, 0]**2 + Ws[:, 1, 1]**2
-    gamy = Ws[:, 3, 2]**2 + Ws[:, 3, 3]**2
+    x_co, px_co, y_co, py_co, zeta_co, ptau_co, s_co = rec[:, 6, :]
+    delta_co = delta[6, :]
 
-    alfx = - Ws[:, 0, 0] * Ws[:, 1, 0] - Ws[:, 0, 1] * Ws[:, 1, 1]
-    alfy = - Ws[:, 2, 2] * Ws[:, 3, 2] - Ws[:, 2, 3] * Ws[:, 3, 3]
+    # Dispersion from the off-momentum particles (7: minus, 8: plus)
+    d_rec = (rec[:, 8, :] - rec[:, 7, :]) / (delta[8, :] - delta[7, :])
+    dx, dpx, dy, dpy, dzeta = d_rec[:5]
+
+    Ws = np.zeros(shape=(len(s_co), 6, 6), dtype=np.float64)
+    Ws[:, :, :] = np.transpose(rec[:6, :6, :] - rec[:6, 6:7, :],
+                               (2, 0, 1)) / scale_eigen
+    Ws[:, 5, :] /= beta0
+
+    (Ws, phix, phiy, phizeta, betx, bety, alfx, alfy, gamx, gamy
+        ) = _courant_snyder_from_eigenvectors(Ws)
 
     mux = np.unwrap(phix)/2/np.pi
     muy = np.unwrap(phiy)/2/np.pi
@@ -419,6 +969,37 @@ def _propagate_optics(tracker, W_matrix, particle_on_co,
 
     return twiss_res_element_by_element
 
+def _courant_snyder_from_eigenvectors(Ws):
+
+    # Rotate eigenvectors to the Courant-Snyder basis
+    phix = np.arctan2(Ws[:, 0, 1], Ws[:, 0, 0])
+    phiy = np.arctan2(Ws[:, 2, 3], Ws[:, 2, 2])
+    phizeta = np.arctan2(Ws[:, 4, 5], Ws[:, 4, 4])
+    v1 = Ws[:, :, 0] + 1j * Ws[:, :, 1]
+    v2 = Ws[:, :, 2] + 1j * Ws[:, :, 3]
+    v3 = Ws[:, :, 4] + 1j * Ws[:, :, 5]
+    for ii in range(6):
+        v1[:, ii] *= np.exp(-1j * phix)
+        v2[:, ii] *= np.exp(-1j * phiy)
+        v3[:, ii] *= np.exp(-1j * phizeta)
+    Ws[:, :, 0] = np.real(v1)
+    Ws[:, :, 1] = np.imag(v1)
+    Ws[:, :, 2] = np.real(v2)
+    Ws[:, :, 3] = np.imag(v2)
+    Ws[:, :, 4] = np.real(v3)
+    Ws[:, :, 5] = np.imag(v3)
+
+    betx = Ws[:, 0, 0]**2 + Ws[:, 0, 1]**2
+    bety = Ws[:, 2, 2]**2 + Ws[:, 2, 3]**2
+
+    gamx = Ws[:, 1, 0]**2 + Ws[:, 1, 1]**2
+    gamy = Ws[:, 3, 2]**2 + Ws[:, 3, 3]**2
+
+    alfx = - Ws[:, 0, 0] * Ws[:, 1, 0] - Ws[:, 0, 1] * Ws[:, 1, 1]
+    alfy = - Ws[:, 2, 2] * Ws[:, 3, 2] - Ws[:, 2, 3] * Ws[:, 3, 3]
+
+    return Ws, phix, phiy, phizeta, betx, bety, alfx, alfy, gamx, gamy
+
 def _compute_chromaticity(tracker, W_matrix, particle_on_co, delta_chrom,
                     tune_x, tune_y,
                     nemitt_x, nemitt_y, matrix_responsiveness_tol,
@@ -428,43 +1009,31 @@ def _compute_chromaticity(tracker, W_matrix, particle_on_co, delta_chrom,
 
     context = tracker._context
 
-    part_chrom_plus = xp.build_particles(
-                _context=context,
-                x_norm=0,
-                zeta=particle_on_co._xobject.zeta[0], delta=delta_chrom,
-                particle_on_co=particle_on_co,
-                nemitt_x=nemitt_x, nemitt_y=nemitt_y,
-                W_matrix=W_matrix)
-    RR_chrom_plus = tracker.compute_one_turn_matrix_finite_differences(
-                                        particle_on_co=part_chrom_plus.copy(),
-                                        steps_r_matrix=steps_r_matrix)
-    (WW_chrom_plus, WWinv_chrom_plus, Rot_chrom_plus
-        ) = lnf.compute_linear_normal_form(RR_chrom_plus,
-                            only_4d_block=method=='4d',
-                            responsiveness_tol=matrix_responsiveness_tol,
-                            stability_tol=matrix_stability_tol,
-                            symplectify=symplectify)
-    qx_chrom_plus = np.angle(np.linalg.eig(Rot_chrom_plus)[0][0])/(2*np.pi)
-    qy_chrom_plus = np.angle(np.linalg.eig(Rot_chrom_plus)[0][2])/(2*np.pi)
-
-    part_chrom_minus = xp.build_particles(
+    parts_chrom = [xp.build_particles(
                 _context=context,
                 x_norm=0,
-                zeta=particle_on_co._xobject.zeta[0], delta=-delta_chrom,
+                zeta=particle_on_co._xobject.zeta[0], delta=dd,
                 particle_on_co=particle_on_co,
                 nemitt_x=nemitt_x, nemitt_y=nemitt_y,
-                W_matrix=W_matrix)
-    RR_chrom_minus = tracker.compute_one_turn_matrix_finite_differences(
-                                        particle_on_co=part_chrom_minus.copy(),
+                W_matrix=W_matrix) for dd in [delta_chrom, -delta_chrom]]
+
+    # The matrices for both momenta are obtained from a single tracking call
+    RRs_chrom = _compute_one_turn_matrices_finite_differences(tracker,
+                                        particles_on_co=parts_chrom,
                                         steps_r_matrix=steps_r_matrix)
-    (WW_chrom_minus, WWinv_chrom_minus, Rot_chrom_minus
-        ) = lnf.compute_linear_normal_form(RR_chrom_minus,
-                            only_4d_block=(method=='4d'),
-                            symplectify=symplectify,
-                            stability_tol=matrix_stability_tol,
-                            responsiveness_tol=matrix_responsiveness_tol)
-    qx_chrom_minus = np.angle(np.linalg.eig(Rot_chrom_minus)[0][0])/(2*np.pi)
-    qy_chrom_minus = np.angle(np.linalg.eig(Rot_chrom_minus)[0][2])/(2*np.pi)
+    Rots_chrom = []
+    for RR_chrom in RRs_chrom:
+        (WW_chrom, WWinv_chrom, Rot_chrom
+            ) = lnf.compute_linear_normal_form(RR_chrom,
+                                only_4d_block=(method=='4d'),
+                                symplectify=symplectify,
+                                stability_tol=matrix_stability_tol,
+                                responsiveness_tol=matrix_responsiveness_tol)
+        Rots_chrom.append(Rot_chrom)
+
+    eigenvalues = np.linalg.eig(np.array(Rots_chrom))[0]
+    qx_chrom_plus, qx_chrom_minus = np.angle(eigenvalues[:, 0])/(2*np.pi)
+    qy_chrom_plus, qy_chrom_minus = np.angle(eigenvalues[:, 2])/(2*np.pi)
 
     dist_from_half_integer_x = np.modf(tune_x)[0] - 0.5
     dist_from_half_integer_y = np.modf(tune_y)[0] - 0.5
@@ -521,7 +1090,8 @@ class ClosedOrbitSearchError(Exception):
 
 def find_closed_orbit(tracker, particle_co_guess=None, particle_ref=None,
                       co_search_settings=None, delta_zeta=0, delta0=None,
-                      continue_on_closed_orbit_error=False):
+                      continue_on_closed_orbit_error=False,
+                      R_matrix_guess=None):
 
     if particle_co_guess is None:
         if particle_ref is None:
@@ -576,6 +1146,23 @@ def find_closed_orbit(tracker, particle_co_guess=None, particle_ref=None,
             ier = 1
             break
 
+        if shift_factor == 0 and R_matrix_guess is not None:
+            res = _co_search_with_jacobian_guess(
+                lambda p: _error_for_co(p, particle_co_guess, tracker, delta_zeta, delta0),
+                x0=x0, R_matrix=R_matrix_guess, only_4d=(delta0 is not None))
+            if res is not None:
+                fsolve_info = 'jacobian_guess'
+                ier = 1
+                break
+
+        if shift_factor == 0:
+            res = _co_search_batched_newton(tracker, particle_co_guess, x0=x0,
+                                            delta_zeta=delta_zeta, delta0=delta0)
+            if res is not None:
+                fsolve_info = 'batched_newton'
+                ier = 1
+                break
+
         (res, infodict, ier, mesg
             ) = fsolve(lambda p: _error_for_co(p, particle_co_guess, tracker, delta_zeta, delta0),
                 x0=x0,
@@ -601,6 +1188,128 @@ def find_closed_orbit(tracker, particle_co_guess=None, particle_ref=None,
 
     return particle_on_co
 
+def _find_closed_orbits_4d_batched(tracker, particle_on_co, delta0_values):
+    # Returns None if the search does not converge
+    particle_on_co = particle_on_co.copy(_context=tracker._buffer.context)
+    x0 = np.array([[particle_on_co._xobject.x[0],
+                    particle_on_co._xobject.px[0],
+                    particle_on_co._xobject.y[0],
+                    particle_on_co._xobject.py[0],
+                    particle_on_co._xobject.zeta[0],
+                    dd] for dd in delta0_values])
+    res = _co_search_batched_newton(tracker, particle_on_co, x0=x0,
+                        delta_zeta=0, delta0=np.array(delta0_values))
+    if res is None:
+        return None
+
+    out = []
+    for rr in res:
+        part = particle_on_co.copy()
+        part.x = rr[0]
+        part.px = rr[1]
+        part.y = rr[2]
+        part.py = rr[3]
+        part.zeta = rr[4]
+        part.delta = rr[5]
+        part._fsolve_info = 'batched_newton'
+        out.append(part)
+    return out
+
+def _co_search_with_jacobian_guess(error_function, x0, R_matrix, only_4d,
+                                   max_iterations=5):
+    # Newton iterations using I - R, with R the one-turn matrix from a
+    # previous computation, as approximate Jacobian of the closed orbit error.
+    # Returns None if the search does not converge.
+    n_dim = 4 if only_4d else 6 # in 4d delta is fixed and zeta is free
+    jac = np.eye(n_dim) - R_matrix[:n_dim, :n_dim]
+    pp = x0.copy()
+    for _ in range(max_iterations):
+        err = error_function(pp)
+        if np.all(np.abs(err) < DEFAULT_CO_SEARCH_TOL):
+            return pp
+        try:
+            pp[:n_dim] -= np.linalg.solve(jac, err[:n_dim])
+        except np.linalg.LinAlgError:
+            return None
+        if not np.all(np.isfinite(pp)):
+            return None
+    return None
+
+def _co_search_batched_newton(tracker, particle_co_guess, x0, delta_zeta,
+                              delta0, max_iterations=10):
+    # Newton search in which, at each iteration, the guesses and their
+    # displaced neighbours (used for the finite-difference Jacobian) are
+    # tracked together in a single call. Several closed orbits can be searched
+    # at once by passing x0 with shape (n_points, 6) and, in 4d, one delta0
+    # per point. Returns None if the search does not converge.
+
+    context = tracker._buffer.context
+    ctx2np = context.nparray_from_context_array
+
+    single_point = (np.ndim(x0) == 1)
+    pp = np.atleast_2d(np.array(x0, dtype=np.float64))
+    n_points = pp.shape[0]
+
+    n_dim = 4 if delta0 is not None else 6 # in 4d delta is fixed and zeta is free
+    if delta0 is not None:
+        delta0 = np.broadcast_to(delta0, (n_points,))
+    steps = np.array([DEFAULT_STEPS_R_MATRIX[nn] for nn in
+                      ['dx', 'dpx', 'dy', 'dpy', 'dzeta', 'ddelta']])
+    n_per_point = 2 * n_dim + 1
+    offsets = np.zeros(shape=(n_per_point, 6), dtype=np.float64)
+    for jj in range(n_dim):
+        offsets[1 + jj, jj] = steps[jj]
+        offsets[1 + n_dim + jj, jj] = -steps[jj]
+
+    part_ref = particle_co_guess.copy()
+    part_ref.x = 0
+    part_ref.px = 0
+    part_ref.y = 0
+    part_ref.py = 0
+    part_ref.zeta = 0
+    part_ref.delta = 0
+
+    for _ in range(max_iterations):
+        coords = (pp[:, None, :] + offsets[None, :, :]).reshape(-1, 6)
+        coords[:, 4] += delta_zeta
+        part = xp.build_particles(_context=context,
+                    particle_ref=part_ref, mode='shift',
+                    x=coords[:, 0], px=coords[:, 1],
+                    y=coords[:, 2], py=coords[:, 3],
+                    zeta=coords[:, 4], delta=coords[:, 5])
+        tracker.track(part)
+
+        if not np.all(ctx2np(part.state) == 1):
+            return None
+
+        # Restore the original order
+        part_id = ctx2np(part.particle_id)
+        part_id -= part_id.min()
+        out = np.zeros(shape=(n_points * n_per_point, 6), dtype=np.float64)
+        for ii, nn in enumerate(['x', 'px', 'y', 'py', 'zeta', 'delta']):
+            out[part_id, ii] = ctx2np(getattr(part, nn))
+        out = out.reshape(n_points, n_per_point, 6)
+
+        err = pp - out[:, 0, :]
+        if n_dim == 4:
+            err[:, 4] = 0
+            err[:, 5] = pp[:, 5] - delta0
+        if np.all(np.abs(err) < DEFAULT_CO_SEARCH_TOL):
+            return pp[0] if single_point else pp
+
+        # One-turn matrices, shape (n_points, n_dim, n_dim)
+        RR = ((out[:, 1:n_dim+1, :n_dim] - out[:, n_dim+1:, :n_dim])
+              / (2 * steps[None, :n_dim, None])).transpose(0, 2, 1)
+        try:
+            pp[:, :n_dim] -= np.linalg.solve(np.eye(n_dim) - RR,
+                                             err[:, :n_dim, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            return None
+        if not np.all(np.isfinite(pp)):
+            return None
+
+    return None
+
 def _one_turn_map(p, particle_ref, tracker, delta_zeta):
     part = particle_ref.copy()
     part.x = p[0]
@@ -637,6 +1346,16 @@ def compute_one_turn_matrix_finite_differences(
         tracker, particle_on_co,
         steps_r_matrix=None):
 
+    return _compute_one_turn_matrices_finite_differences(
+        tracker, particles_on_co=[particle_on_co],
+        steps_r_matrix=steps_r_matrix)[0]
+
+def _compute_one_turn_matrices_finite_differences(
+        tracker, particles_on_co, steps_r_matrix=None):
+
+    # The finite-difference particles for all the given reference particles
+    # are tracked together in a single call
+
     if steps_r_matrix is not None:
         steps_in = steps_r_matrix.copy()
         for nn in steps_in.keys():
@@ -651,39 +1370,51 @@ def compute_one_turn_matrix_finite_differences(
 
     context = tracker._buffer.context
 
-    particle_on_co = particle_on_co.copy(
-                        _context=context)
-
     dx = steps_r_matrix["dx"]
     dpx = steps_r_matrix["dpx"]
     dy = steps_r_matrix["dy"]
     dpy = steps_r_matrix["dpy"]
     dzeta = steps_r_matrix["dzeta"]
     ddelta = steps_r_matrix["ddelta"]
-    part_temp = xp.build_particles(_context=context,
-            particle_ref=particle_on_co, mode='shift',
-            x  =    [dx,  0., 0.,  0.,    0.,     0., -dx,   0.,  0.,   0.,     0.,      0.],
-            px =    [0., dpx, 0.,  0.,    0.,     0.,  0., -dpx,  0.,   0.,     0.,      0.],
-            y  =    [0.,  0., dy,  0.,    0.,     0.,  0.,   0., -dy,   0.,     0.,      0.],
-            py =    [0.,  0., 0., dpy,    0.,     0.,  0.,   0.,  0., -dpy,     0.,      0.],
-            zeta =  [0.,  0., 0.,  0., dzeta,     0.,  0.,   0.,  0.,   0., -dzeta,      0.],
-            delta = [0.,  0., 0.,  0.,    0., ddelta,  0.,   0.,  0.,   0.,     0., -ddelta],
-            )
-    dpzeta = float(context.nparray_from_context_array(
-        (part_temp.ptau[5] - part_temp.ptau[11])/2/part_temp.beta0[0]))
-    if particle_on_co._xobject.at_element[0]>0:
-        part_temp.s[:] = particle_on_co._xobject.s[0]
-        part_temp.at_element[:] = particle_on_co._xobject.at_element[0]
-
-    if particle_on_co._xobject.at_element[0]>0:
-        i_start = particle_on_co._xobject.at_element[0]
+
+    parts_temp = []
+    dpzetas = []
+    for particle_on_co in particles_on_co:
+        particle_on_co = particle_on_co.copy(
+                            _context=context)
+        part_temp = xp.build_particles(_context=context,
+                particle_ref=particle_on_co, mode='shift',
+                x  =    [dx,  0., 0.,  0.,    0.,     0., -dx,   0.,  0.,   0.,     0.,      0.],
+                px =    [0., dpx, 0.,  0.,    0.,     0.,  0., -dpx,  0.,   0.,     0.,      0.],
+                y  =    [0.,  0., dy,  0.,    0.,     0.,  0.,   0., -dy,   0.,     0.,      0.],
+                py =    [0.,  0., 0., dpy,    0.,     0.,  0.,   0.,  0., -dpy,     0.,      0.],
+                zeta =  [0.,  0., 0.,  0., dzeta,     0.,  0.,   0.,  0.,   0., -dzeta,      0.],
+                delta = [0.,  0., 0.,  0.,    0., ddelta,  0.,   0.,  0.,   0.,     0., -ddelta],
+                )
+        dpzetas.append(float(context.nparray_from_context_array(
+            (part_temp.ptau[5] - part_temp.ptau[11])/2/part_temp.beta0[0])))
+        if particle_on_co._xobject.at_element[0]>0:
+            part_temp.s[:] = particle_on_co._xobject.s[0]
+            part_temp.at_element[:] = particle_on_co._xobject.at_element[0]
+        parts_temp.append(part_temp)
+
+    i_start = particles_on_co[0]._xobject.at_element[0]
+    assert np.all([pp._xobject.at_element[0] == i_start
+                   for pp in particles_on_co])
+
+    if len(parts_temp) > 1:
+        part_temp = xp.Particles.merge(parts_temp)
+    else:
+        part_temp = parts_temp[0]
+
+    if i_start>0:
         tracker.track(part_temp, ele_start=i_start)
         tracker.track(part_temp, num_elements=i_start)
     else:
-        assert particle_on_co._xobject.at_element[0] == 0
+        assert i_start == 0
         tracker.track(part_temp)
 
-    temp_mat = np.zeros(shape=(6, 12), dtype=np.float64)
+    temp_mat = np.zeros(shape=(6, 12 * len(parts_temp)), dtype=np.float64)
     temp_mat[0, :] = context.nparray_from_context_array(part_temp.x)
     temp_mat[1, :] = context.nparray_from_context_array(part_temp.px)
     temp_mat[2, :] = context.nparray_from_context_array(part_temp.y)
@@ -692,16 +1423,144 @@ def compute_one_turn_matrix_finite_differences(
     temp_mat[5, :] = context.nparray_from_context_array(
                                 part_temp.ptau/part_temp.beta0) # pzeta
 
-    RR = np.zeros(shape=(6, 6), dtype=np.float64)
+    RRs = []
+    for ii, dpzeta in enumerate(dpzetas):
+        mat = temp_mat[:, 12*ii:12*(ii+1)]
+        RR = np.zeros(shape=(6, 6), dtype=np.float64)
+        for jj, dd in enumerate([dx, dpx, dy, dpy, dzeta, dpzeta]):
+            RR[:, jj] = (mat[:, jj] - mat[:, jj+6])/(2*dd)
+        RRs.append(RR)
 
-    for jj, dd in enumerate([dx, dpx, dy, dpy, dzeta, dpzeta]):
-        RR[:, jj] = (temp_mat[:, jj] - temp_mat[:, jj+6])/(2*dd)
-
-    return RR
+    return RRs
 
 def _behaves_like_drift(ee):
     return (hasattr(ee, 'behaves_like_drift') and ee.behaves_like_drift)
 
+def _locate_points_in_drifts(line, at_s, s_tol=1e-10):
+
+    # Returns, for each point, the index of the element at whose entry or
+    # inside which the point is located, the distance from the entry of the
+    # element and a mask that is False for points inside elements that do
+    # not behave like a drift (or outside the line)
+
+    at_s = np.array(at_s, dtype=np.float64)
+    s_entry = np.array(list(line.get_s_elements()) + [line.get_length()])
+
+    i_ele = np.searchsorted(s_entry, at_s - s_tol, side='left')
+    mask = (i_ele < len(s_entry)) & (at_s >= -s_tol)
+    i_ele[~mask] = 0
+    at_entry = mask & (np.abs(s_entry[i_ele] - at_s) <= s_tol)
+    i_ele[mask & ~at_entry] -= 1
+    ds = at_s - s_entry[i_ele]
+    ds[at_entry | ~mask] = 0
+
+    for ii in np.unique(i_ele[mask & ~at_entry]):
+        if not _behaves_like_drift(line.elements[ii]):
+            mask[(i_ele == ii) & ~at_entry] = False
+
+    return i_ele, ds, mask
+
+def _merge_twiss_at_points(tw_a, i_a, tw_b, i_b):
+
+    # Element-by-element quantities of two twiss tables computed at
+    # different points are merged, in the order given by the point indices
+    # `i_a` and `i_b`. Global quantities are taken from `tw_a`.
+
+    order = np.argsort(np.concatenate([i_a, i_b]))
+
+    twiss_res = TwissTable()
+    twiss_res.update({kk: vv for kk, vv in tw_a.items()
+                      if kk not in tw_a._ebe_fields})
+    for kk in tw_a._ebe_fields:
+        vv = list(tw_a[kk]) + list(tw_b[kk])
+        vv = [vv[ii] for ii in order]
+        if isinstance(tw_a[kk], np.ndarray):
+            vv = np.array(vv)
+        elif isinstance(tw_a[kk], tuple):
+            vv = tuple(vv)
+        twiss_res[kk] = vv
+    twiss_res._ebe_fields = tw_a._ebe_fields
+
+    return twiss_res
+
+def _twiss_in_drifts(tw, i_ele, ds, names, method, eps=1e-6):
+
+    # The closed orbit, the eigenvectors (by central differences) and the
+    # dispersion at the entry of the drifts are propagated over the
+    # distances `ds`
+
+    beta0 = tw.particle_on_co._xobject.beta0[0]
+    n_points = len(i_ele)
+
+    W0 = np.array(tw.W_matrix)[i_ele]
+    co = np.array([np.array(tw[nn])[i_ele]
+                   for nn in ['x', 'px', 'y', 'py', 'zeta', 'ptau']])
+    co[5] /= beta0 # pzeta
+
+    # Probes: closed orbit, +/- eps along the six eigenvectors, two
+    # off-momentum particles on the dispersive orbit
+    coords = np.zeros(shape=(6, 15, n_points), dtype=np.float64)
+    coords[:, :, :] = co[:, None, :]
+    for kk in range(6):
+        coords[:, 1 + kk, :] += eps * W0[:, :, kk].T
+        coords[:, 7 + kk, :] -= eps * W0[:, :, kk].T
+    ptau = beta0 * coords[5]
+    delta = np.sqrt(ptau**2 + 2*ptau/beta0 + 1) - 1
+
+    delta_co = np.array(tw.delta)[i_ele]
+    for i_probe, sign in [(13, -1), (14, 1)]:
+        for i_coord, nn in enumerate(['dx', 'dpx', 'dy', 'dpy']):
+            coords[i_coord, i_probe, :] += sign * eps * np.array(tw[nn])[i_ele]
+        delta[i_probe, :] = delta_co + sign * eps
+        ptau[i_probe, :] = (np.sqrt(1/beta0**2 - 1 + (1 + delta[i_probe])**2)
+                            - 1/beta0)
+    coords[5] = ptau / beta0
+
+    coords[0], coords[2], coords[4] = _drift_numpy(
+        x=coords[0], px=coords[1], y=coords[2], py=coords[3], zeta=coords[4],
+        delta=delta, ptau=ptau, beta0=beta0, length=ds[None, :])
+
+    Ws = np.transpose(coords[:, 1:7, :] - coords[:, 7:13, :], (2, 0, 1)) / (2*eps)
+    (Ws, phix, phiy, phizeta, betx, bety, alfx, alfy, gamx, gamy
+        ) = _courant_snyder_from_eigenvectors(Ws)
+
+    d_rec = (coords[:, 14, :] - coords[:, 13, :]) / (delta[14] - delta[13])
+
+    twiss_res = TwissTable()
+    twiss_res.update({kk: vv for kk, vv in tw.items()
+                      if kk not in tw._ebe_fields})
+    twiss_res.update({
+        'name': tuple(names),
+        's': np.array(tw.s)[i_ele] + ds,
+        'x': coords[0, 0, :],
+        'px': coords[1, 0, :],
+        'y': coords[2, 0, :],
+        'py': coords[3, 0, :],
+        'zeta': coords[4, 0, :],
+        'delta': delta[0, :],
+        'ptau': ptau[0, :],
+        'betx': betx,
+        'bety': bety,
+        'alfx': alfx,
+        'alfy': alfy,
+        'gamx': gamx,
+        'gamy': gamy,
+        'dx': d_rec[0],
+        'dpx': d_rec[1],
+        'dy': d_rec[2],
+        'dpy': d_rec[3],
+        'dzeta': d_rec[4],
+        'mux': np.array(tw.mux)[i_ele] + phix/2/np.pi,
+        'muy': np.array(tw.muy)[i_ele] + phiy/2/np.pi,
+        'muzeta': np.array(tw.muzeta)[i_ele] + phizeta/2/np.pi,
+        'W_matrix': [Ws[ii, :, :] for ii in range(n_points)],
+    })
+    twiss_res._ebe_fields = tw._ebe_fields
+    if method == '4d':
+        twiss_res.muzeta[:] = 0
+
+    return twiss_res
+
 
 def _build_auxiliary_tracker_with_extra_markers(tracker, at_s, marker_prefix,
                                                 algorithm='auto'):
@@ -757,13 +1616,22 @@ def _build_auxiliary_tracker_with_extra_markers(tracker, at_s, marker_prefix,
                 i_new_drift += 1
                 s_curr = ss
             new_enames.append(nn)
+        # Drift after the last point, such that the length is unchanged
+        # (the points do not necessarily extend to the end of the line)
+        length = tracker.line.get_length()
+        if length > s_curr + 1e-6:
+            new_dname = f'_auxrift_{i_new_drift}'
+            new_ele_dict[new_dname] = xt.Drift(length=length-s_curr)
+            new_enames.append(new_dname)
         auxline = xt.Line(elements=new_ele_dict, element_names=new_enames)
 
+    track_kernel, element_classes = tracker._get_shareable_kernel()
+
     auxtracker = xt.Tracker(
         _buffer=tracker._buffer,
         line=auxline,
-        track_kernel=tracker.track_kernel,
-        element_classes=tracker.element_classes,
+        track_kernel=track_kernel,
+        element_classes=element_classes,
         particles_class=tracker.particles_class,
         skip_end_turn_actions=tracker.skip_end_turn_actions,
         reset_s_at_end_turn=tracker.reset_s_at_end_turn,
@@ -976,14 +1844,50 @@ def _error_for_match(knob_values, vary, targets, tracker, tw_kwargs):
             res.append(tt[0](tw) - tt[1])
     return np.array(res)
 
-def match_tracker(tracker, vary, targets, **kwargs):
+
+# Targets that can be evaluated with `only_global_quantities=True`
+_global_twiss_quantities = ('qx', 'qy', 'qs', 'dqx', 'dqy', 'slip_factor',
+                            'momentum_compaction_factor')
+
+def match_tracker(tracker, vary, targets, solver='fsolve', weights=None,
+                  limits=None, n_workers=None, max_iterations=30, tol=1e-12,
+                  xtol=1.49012e-08, **kwargs):
+
+    assert solver in ['fsolve', 'least_squares'], (
+        'Solver must be `fsolve` or `least_squares`')
+
+    if ('only_global_quantities' not in kwargs
+            and kwargs.get('at_elements', None) is None
+            and kwargs.get('at_s', None) is None
+            and kwargs.get('ele_start', 0) == 0
+            and not kwargs.get('eneloss_and_damping', False)
+            and all(isinstance(tt[0], str) and tt[0] in _global_twiss_quantities
+                    for tt in targets)):
+        # The element-by-element optics are not needed for the targets (the
+        # integer tunes are followed through tracker._reference_tunes)
+        kwargs['only_global_quantities'] = True
+
     _err = partial(_error_for_match, vary=vary, targets=targets,
                    tracker=tracker, tw_kwargs=kwargs)
     x0 = [tracker.vars[vv]._value for vv in vary]
     try:
-        (res, infodict, ier, mesg) = fsolve(_err, x0=x0.copy(), full_output=True)
-        if ier != 1:
-            raise RuntimeError("fsolve failed: %s" % mesg)
+        if solver == 'fsolve':
+            assert weights is None and limits is None, (
+                '`weights` and `limits` are supported only by the '
+                '`least_squares` solver')
+            (res, infodict, ier, mesg) = fsolve(_err, x0=x0.copy(), full_output=True)
+            if ier != 1:
+                raise RuntimeError("fsolve failed: %s" % mesg)
+        else:
+            (res, infodict, ier, mesg) = _match_least_squares(
+                tracker=tracker, vary=vary, targets=targets, tw_kwargs=kwargs,
+                x0=np.array(x0, dtype=np.float64), weights=weights,
+                limits=limits, n_workers=n_workers,
+                max_iterations=max_iterations, tol=tol, xtol=xtol)
+            # ier = 2: the targets cannot be reached within the limits, the
+            # knobs are left at the best point found
+            if ier not in (1, 2):
+                raise RuntimeError("Least squares matching failed: %s" % mesg)
         for kk, vv in zip(vary, res):
             tracker.vars[kk] = vv
         fsolve_info = {
@@ -993,3 +1897,158 @@ def match_tracker(tracker, vary, targets, **kwargs):
             tracker.vars[vv] = x0[ii]
         raise err
     return fsolve_info
+
+# Set before forking the worker processes evaluating the twiss for different
+# knob values, which inherit the tracker with its line and its compiled kernel
+_function_for_workers = None
+
+def _call_function_for_workers(knob_values):
+    return _function_for_workers(knob_values)
+
+def _fork_pool_for_knob_evaluations(function, tracker, n_tasks, n_workers):
+
+    # Returns None if the evaluations cannot be done in parallel
+
+    global _function_for_workers
+
+    if (n_workers == 1 or n_tasks < 2 or tracker.iscollective
+            or not isinstance(tracker._buffer.context, xo.ContextCpu)
+            or 'fork' not in multiprocessing.get_all_start_methods()):
+        return None
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    tracker.track_kernel # the compilation needs to be completed
+    _function_for_workers = function
+    return multiprocessing.get_context('fork').Pool(min(n_workers, n_tasks))
+
+def _close_pool_for_knob_evaluations(pool):
+    global _function_for_workers
+    if pool is not None:
+        pool.close()
+        pool.join()
+    _function_for_workers = None
+
+def _match_least_squares(tracker, vary, targets, tw_kwargs, x0, weights,
+                         limits, n_workers, max_iterations, tol, xtol):
+
+    # Gauss-Newton iterations on the weighted residuals. The finite-difference
+    # Jacobian is computed with the columns evaluated in parallel worker
+    # processes and is then kept up to date with Broyden updates, being
+    # recomputed only when a step fails to reduce the residuals.
+    # `tol` applies to the weighted residuals, such that the weights also set
+    # the scale of targets having different units. Returned status (ier):
+    # 1 if the weighted residuals are below tol, 2 if they cannot be reduced
+    # further because of the limits of the knobs, 0 otherwise.
+
+    _err = partial(_error_for_match, vary=vary, targets=targets,
+                   tracker=tracker, tw_kwargs=tw_kwargs)
+
+    if weights is None:
+        weights = np.ones(len(targets))
+    weights = np.array(weights, dtype=np.float64)
+    assert len(weights) == len(targets)
+
+    lower = np.full(len(vary), -np.inf)
+    upper = np.full(len(vary), np.inf)
+    if limits is not None:
+        if isinstance(limits, dict):
+            limits = [limits.get(vv, None) for vv in vary]
+        for ii, ll in enumerate(limits):
+            if ll is not None:
+                lower[ii] = -np.inf if ll[0] is None else ll[0]
+                upper[ii] = np.inf if ll[1] is None else ll[1]
+    x0 = np.clip(x0, lower, upper)
+
+    pool = _fork_pool_for_knob_evaluations(_err, tracker,
+                                   n_tasks=len(vary), n_workers=n_workers)
+
+    nfev = 0
+    njev = 0
+    def jacobian(xx, ff):
+        steps = np.sqrt(np.finfo(np.float64).eps) * np.maximum(np.abs(xx), 1.)
+        steps = np.where(xx + steps > upper, -steps, steps)
+        x_cols = [xx + np.eye(len(xx))[jj] * steps[jj] for jj in range(len(xx))]
+        if pool is not None:
+            f_cols = pool.map(_call_function_for_workers, x_cols)
+        else:
+            f_cols = [_err(xc) for xc in x_cols]
+        return np.array([(fc - ff) / hh for fc, hh in zip(f_cols, steps)]).T
+
+    def stop_status(knobs_at_limits):
+        if np.any(knobs_at_limits):
+            return 2, ('The residuals cannot be reduced further within the '
+                       'limits of the knobs')
+        return 0, 'The residuals cannot be reduced below the tolerance'
+
+    try:
+        xx = x0.copy()
+        ff = _err(xx)
+        nfev += 1
+        jac = None
+        jac_is_fresh = False
+        ier = 0
+        mesg = 'Maximum number of iterations reached'
+        for _ in range(max_iterations):
+            if np.all(np.abs(ff * weights) < tol):
+                ier = 1
+                mesg = 'The residuals are below the tolerance'
+                break
+            if jac is None:
+                jac = jacobian(xx, ff)
+                njev += 1
+                nfev += len(xx)
+                jac_is_fresh = True
+            dx = np.linalg.lstsq(jac * weights[:, None], -ff * weights,
+                                 rcond=None)[0]
+
+            # Knobs at their limits and pushed outwards are kept fixed
+            at_limits = (((xx <= lower) & (dx < 0))
+                         | ((xx >= upper) & (dx > 0)))
+            if np.any(at_limits):
+                dx = np.zeros_like(xx)
+                if not np.all(at_limits):
+                    dx[~at_limits] = np.linalg.lstsq(
+                        jac[:, ~at_limits] * weights[:, None],
+                        -ff * weights, rcond=None)[0]
+
+            # Backtracking on the weighted residuals
+            step = 1.
+            for _ in range(6):
+                x_new = np.clip(xx + step * dx, lower, upper)
+                f_new = _err(x_new)
+                nfev += 1
+                if (np.linalg.norm(f_new * weights)
+                        < np.linalg.norm(ff * weights)):
+                    break
+                step /= 2
+            else:
+                if jac_is_fresh:
+                    ier, mesg = stop_status(at_limits)
+                    break
+                jac = None
+                continue
+
+            # Broyden update of the Jacobian
+            sx = x_new - xx
+            jac = jac + np.outer((f_new - ff) - jac @ sx, sx) / np.dot(sx, sx)
+            jac_is_fresh = False
+
+            converged_x = np.all(np.abs(sx) <= xtol * (np.abs(x_new) + xtol))
+            clipped = x_new != xx + step * dx
+            xx = x_new
+            ff = f_new
+            if converged_x:
+                # Small steps are a success only if the residuals are below
+                # the tolerance
+                if np.all(np.abs(ff * weights) < tol):
+                    ier = 1
+                    mesg = 'The residuals are below the tolerance'
+                else:
+                    ier, mesg = stop_status(at_limits | clipped)
+                break
+    finally:
+        _close_pool_for_knob_evaluations(pool)
+
+    infodict = {'nfev': nfev, 'njev': njev, 'fvec': ff}
+    return xx, infodict, ier, mesg